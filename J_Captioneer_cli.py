@@ -0,0 +1,241 @@
+"""Caption image datasets from the command line, without the GUI.
+
+    python J_Captioneer_cli.py DATASET_DIR "more/*.jpg" --model BLIP --batch-size 8
+
+Captions are written next to each image as `<image name>.txt`, the same way
+the app does, or with --caption-store sqlite to the caption database of the
+directory given, which the app reads when it opens that directory (see
+caption_store.py).  Progress is printed to stdout as one JSON object per line,
+with the current images/s and ETA once they are known.  --trace writes a
+per-stage timing trace and --timeline the same as a Chrome/Perfetto trace.
+--server captions through a running caption_server.py instead of loading the
+model in this process, if one is listening.  --cache-features keeps each
+image's encoder output, so running again with another --max-length or
+--num-beams only runs the text decoder.  Given several models (--model
+VIT-GPT2 --model BLIP), every image is decoded once and captioned by all
+of them, and --merge says how their captions are combined.
+Images that can't be read are reported with a "failed" event and skipped.
+The exit status is 0 when every image was captioned, 1 when no images were
+found, some couldn't be read or captioning failed, and 2 for usage errors.  Does not import PyQt5.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import captioning
+import image_directory
+from caption_cache import CAPTION_CACHE_FILE, CaptionCache
+from caption_store import CAPTION_STORES, open_caption_store
+from feature_cache import FEATURE_CACHE_DIR, FEATURE_DTYPES, MAX_FEATURE_CACHE_BYTES, FeatureCache
+
+def emit(event, **fields):
+    print(json.dumps(dict(event=event, **fields)), flush=True)
+
+
+def collect_images(sources, recursive=False):
+    """Expand directories and glob patterns into a sorted, de-duplicated list of images."""
+    images = set()
+    for source in sources:
+        if os.path.isdir(source):
+            images.update(image_directory.scan(source, recursive))
+        else:
+            images.update(path for path in glob.glob(source, recursive=True)
+                          if image_directory.is_image(path) and os.path.isfile(path))
+    return sorted(images, key=image_directory.natural_key)
+
+
+class CaptionStores:
+    """
+    The caption store of each directory given on the command line, opened on
+    first use and keyed by path relative to it, like the store the app opens
+    for the directory it browses: with --recursive, subfolders' images go
+    to their source directory's store.  Images matched by a glob pattern use
+    their own folder's.
+    """
+
+    def __init__(self, kind, directories=()):
+        self.kind = kind
+        # Outermost first, so a source inside another shares the enclosing one's store.
+        self.directories = sorted({os.path.abspath(directory) for directory in directories}, key=len)
+        self.stores = {}
+
+    def directory(self, image_path):
+        image_path = os.path.abspath(image_path)
+        for directory in self.directories:
+            if image_path.startswith(os.path.join(directory, "")):
+                return directory
+        return os.path.dirname(image_path)
+
+    def __getitem__(self, image_path):
+        directory = self.directory(image_path)
+        if directory not in self.stores:
+            self.stores[directory] = open_caption_store(directory, self.kind)
+        return self.stores[directory]
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Generate captions for images without opening the GUI.")
+    parser.add_argument("sources", nargs="+", help="image directories or glob patterns")
+    parser.add_argument("--model", action="append", choices=["VIT-GPT2", "BLIP"],
+                        help="captioning model (default VIT-GPT2); repeat to caption with several in one pass")
+    parser.add_argument("--merge", default="lines", choices=captioning.MERGE_STRATEGIES,
+                        help="how the captions of several models are combined: one per line, one per line "
+                             "starting with the model's name, comma-separated, or only the longest")
+    parser.add_argument("--batch-size", type=int, default=0, help="images per generate() call, 0 = auto")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="CPU worker processes, 0 = caption in this process")
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--precision", default="fp32", choices=captioning.PRECISIONS,
+                        help="bf16 = bfloat16 autocast, int8 = dynamically quantized linear layers (CPU)")
+    parser.add_argument("--runtime", default="eager", choices=captioning.RUNTIMES,
+                        help="run the model eagerly or from graphs exported on first use (CPU)")
+    parser.add_argument("--max-length", type=int, default=16)
+    parser.add_argument("--num-beams", type=int, default=4)
+    parser.add_argument("--recursive", action="store_true", help="also caption images in subdirectories")
+    parser.add_argument("--keep-existing", action="store_true", help="skip images that already have a caption")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the caption cache")
+    parser.add_argument("--cache-file", default=CAPTION_CACHE_FILE)
+    parser.add_argument("--cache-features", action="store_true",
+                        help="keep the image encoder's output, so later runs with other generation settings only "
+                             "decode (in-process captioning only)")
+    parser.add_argument("--feature-cache-dir", default=FEATURE_CACHE_DIR)
+    parser.add_argument("--feature-cache-size", type=int, default=MAX_FEATURE_CACHE_BYTES // 2**20, metavar="MB",
+                        help="least recently used features are evicted past this size")
+    parser.add_argument("--feature-cache-dtype", default="float32", choices=FEATURE_DTYPES,
+                        help="float16 halves the cache's size, but may rarely change a word of a caption")
+    parser.add_argument("--caption-store", default="txt", choices=CAPTION_STORES,
+                        help="txt = a .txt next to each image, sqlite = one caption database per source directory")
+    parser.add_argument("--trace", metavar="PATH", help="write one JSON line per timed stage span to PATH")
+    parser.add_argument("--timeline", metavar="PATH",
+                        help="also write the spans to PATH in Chrome trace format (chrome://tracing, Perfetto)")
+    parser.add_argument("--server", nargs="?", const="", metavar="ADDRESS",
+                        help="caption through a running caption_server.py (default address: "
+                             f"${captioning.CAPTION_SERVER_ENV} or {captioning.default_server_address()})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    start = time.perf_counter()
+    images = collect_images(args.sources, args.recursive)
+    gen_kwargs = {"max_length": args.max_length, "num_beams": args.num_beams}
+    model_names = list(dict.fromkeys(args.model or ["VIT-GPT2"]))
+    model_name = captioning.MODEL_SEPARATOR.join(model_names)
+    emit("start", model=model_name, images=len(images))
+    if not images:
+        emit("error", message="No images found.")
+        return 1
+
+    caption_cache = None if args.no_cache else CaptionCache(args.cache_file)
+    caption_stores = CaptionStores(args.caption_store, [source for source in args.sources if os.path.isdir(source)])
+    feature_cache = None
+    if args.cache_features:
+        feature_cache = FeatureCache(args.feature_cache_dir, args.feature_cache_size * 2**20, args.feature_cache_dtype)
+    trace = None
+    if args.trace or args.timeline:
+        trace = captioning.StageTrace(args.trace or args.timeline + ".jsonl", args.timeline)
+    models = captioning.create_registry()
+    for name in model_names:
+        models.set_precision(name, args.precision)
+        models.set_runtime(name, args.runtime)
+    if args.server is not None:
+        models.server_address = captioning.server_address(args.server or None)
+    pipeline = captioning.create_pipeline(models, model_name, gen_kwargs, args.batch_size, args.workers,
+                                          args.threads_per_worker, trace=trace, feature_cache=feature_cache)
+    if isinstance(pipeline, captioning.RemoteCaptionPipeline):
+        emit("server", address=str(pipeline.client.address))
+    elif args.server is not None:
+        emit("server_unavailable", address=str(models.server_address))
+    stats = pipeline.stats
+    summary = {"computed": 0, "cached": 0, "kept": 0, "failed": 0}
+    done = 0
+    to_compute = []
+    cache_keys = {}
+
+    def timed_write(image_path, captions):
+        write_start = time.perf_counter()
+        caption = captioning.merge_captions(captions, args.merge)
+        caption_stores[image_path].save(image_path, caption)
+        if caption_cache is not None:
+            for name, model_caption in captions.items():
+                caption_cache.put(cache_keys[image_path, name], model_caption)
+        stats.add("write", time.perf_counter() - write_start, 1, write_start)
+        return caption
+
+    try:
+        for image_path in images:
+            if args.keep_existing and caption_stores[image_path].has_caption(image_path):
+                summary["kept"] += 1
+                done += 1
+                emit("skipped", path=image_path, done=done, total=len(images))
+                continue
+            captions = {}
+            if caption_cache is not None:
+                lookup_start = time.perf_counter()
+                for name in model_names:
+                    cache_keys[image_path, name] = caption_cache.key(image_path, name, gen_kwargs, args.precision,
+                                                                     models.effective_runtime(name))
+                    caption = caption_cache.get(cache_keys[image_path, name])
+                    if caption is not None:
+                        captions[name] = caption
+                stats.add("cache lookup", time.perf_counter() - lookup_start, 1, lookup_start)
+            if len(captions) < len(model_names):
+                to_compute.append(image_path)
+                continue
+            caption = captioning.merge_captions(captions, args.merge)
+            caption_stores[image_path].save(image_path, caption)
+            summary["cached"] += 1
+            done += 1
+            emit("caption", path=image_path, caption=caption, source="cache", done=done, total=len(images))
+
+        if to_compute:
+            def progress(message):
+                emit("status", message=message)
+
+            for batch, captions in pipeline.run(to_compute, progress=progress):
+                if len(model_names) == 1:
+                    captions = {model_name: captions}
+                rate = stats.rate()
+                for index, image_path in enumerate(batch):
+                    image_captions = {name: captions[name][index] for name in model_names}
+                    done += 1
+                    if None in image_captions.values():
+                        summary["failed"] += 1
+                        emit("failed", path=image_path, message=pipeline.errors.get(image_path, ""), done=done,
+                             total=len(images))
+                        continue
+                    caption = timed_write(image_path, image_captions)
+                    summary["computed"] += 1
+                    emit("caption", path=image_path, caption=caption, source="model", done=done, total=len(images),
+                         images_per_second=rate, eta_seconds=(len(images) - done) / rate if rate else None)
+                if caption_cache is not None:
+                    caption_cache.flush()
+    except Exception as e:
+        summary["failed"] += len(images) - done
+        emit("error", message=f"{type(e).__name__}: {e}", **summary)
+        return 1
+    finally:
+        if caption_cache is not None:
+            caption_cache.close()
+        if feature_cache is not None:
+            feature_cache.close()
+        caption_stores.close()
+        if trace is not None:
+            trace.close()
+
+    stages = {stage: {"seconds": stats.seconds[stage], "items": stats.items[stage]} for stage in stats.stages}
+    emit("done", seconds=time.perf_counter() - start, stages=stages, **summary)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -1,9 +1,33 @@
+import bisect
 import json
+import multiprocessing
 import os
+import re
 import sys
-
-from PyQt5.QtCore import Qt, QRectF, QSize, QSizeF, QThreadPool, QRunnable, pyqtSignal, QObject, QTimer, QRect
-from PyQt5.QtGui import QIcon, QPixmap, QPainter
+import time
+
+from collections import OrderedDict
+
+from PyQt5.QtCore import (
+    Qt,
+    QRectF,
+    QSize,
+    QSizeF,
+    QThreadPool,
+    QRunnable,
+    pyqtSignal,
+    QObject,
+    QTimer,
+    QRect,
+    QBuffer,
+    QIODevice,
+    QAbstractListModel,
+    QModelIndex,
+    QThread,
+    QFileSystemWatcher,
+    QEvent,
+)
+from PyQt5.QtGui import QIcon, QPixmap, QPainter, QPen, QImage, QImageReader
 
 from PyQt5.QtWidgets import (
     QApplication,
@@ -16,10 +40,11 @@ from PyQt5.QtWidgets import (
     QVBoxLayout,
     QHBoxLayout,
     QLabel,
+    QLineEdit,
+    QListView,
     QTextEdit,
     QPushButton,
     QScrollArea,
-    QGridLayout,
     QSizePolicy,
     QInputDialog,
     QComboBox,
@@ -33,19 +58,32 @@ from PyQt5.QtWidgets import (
     QGraphicsItem,
     QSpinBox,
     QGraphicsPixmapItem,
+    QProgressBar,
 )
 from PIL import Image
-from transformers import VisionEncoderDecoderModel, ViTImageProcessor, AutoTokenizer, BlipProcessor, BlipForConditionalGeneration
-import torch
-model = VisionEncoderDecoderModel.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
-feature_extractor = ViTImageProcessor.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
-tokenizer = AutoTokenizer.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
-blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large")
-
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model.to(device)
+
+import caption_transforms
+import captioning
+import image_crops
+import image_directory
+from caption_cache import CaptionCache
+from feature_cache import FEATURE_CACHE_DIR, FeatureCache
+from caption_index import CaptionIndex, text_file_signature
+from caption_store import CAPTION_STORES, TextFileStore, open_caption_store
+from caption_jobs import CaptionJob
+from preview_cache import PreviewCache
+from thumbnail_cache import ThumbnailCache
+
 icon_path = os.path.join(os.path.dirname(__file__), "icon.ico")
+THUMBNAIL_SIZE = 150
+THUMBNAIL_SPACING = 10
+THUMBNAILS_IN_MEMORY = 500
+CROP_PROXY_SIZE = 400
+PREVIEW_SIZE = 400
+PREFETCH_AHEAD = 4
+PREFETCH_BEHIND = 1
+CROP_PROXIES_IN_MEMORY = 64
+MAX_LISTED_FAILURES = 20
 
 class DeselectableTextEdit(QTextEdit):
     def focusOutEvent(self, event):
@@ -61,6 +99,478 @@ class CustomMessageBox(QMessageBox):
             self.setWindowFlags(self.windowFlags() | Qt.FramelessWindowHint)
             QTimer.singleShot(0, lambda: self.setWindowFlags(self.windowFlags() & ~Qt.FramelessWindowHint))
         super(CustomMessageBox, self).showEvent(event)
+def load_thumbnail_image(image_path, thumbnail_cache, size=THUMBNAIL_SIZE):
+    """
+    Return a QImage thumbnail of `image_path` no larger than `size`.  Safe to
+    call off the GUI thread.  The image is decoded straight at the target
+    size, which lets the JPEG decoder skip most of the work on large files.
+    """
+    data = thumbnail_cache.get(image_path, size) if thumbnail_cache is not None else None
+    if data is not None:
+        image = QImage.fromData(data)
+        if not image.isNull():
+            return image
+
+    reader = QImageReader(image_path)
+    original_size = reader.size()
+    if original_size.isValid():
+        reader.setScaledSize(original_size.scaled(size, size, Qt.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        return image
+    if image.width() > size or image.height() > size:
+        image = image.scaled(size, size, Qt.KeepAspectRatio, Qt.FastTransformation)
+
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    if thumbnail_cache is not None:
+        image.save(buffer, "PNG")
+        thumbnail_cache.put(image_path, size, bytes(buffer.data()))
+    return image
+
+
+def load_preview(image_path, caption_store, size=PREVIEW_SIZE):
+    """
+    (QImage scaled to fit `size`, caption) for the image view.  Safe to call
+    off the GUI thread.  A .txt caption comes as (file signature, text) so a
+    later edit is noticed when it is shown; other stores give None and are
+    read when the image is shown.
+    """
+    reader = QImageReader(image_path)
+    original_size = reader.size()
+    if original_size.isValid():
+        reader.setScaledSize(original_size.scaled(size, size, Qt.KeepAspectRatio))
+    image = reader.read()
+    caption = None
+    if caption_store.kind == "txt":
+        signature = text_file_signature(image_path)
+        caption = (signature, caption_store.load(image_path))
+    return image, caption
+
+
+class PreviewWorker(QRunnable):
+    def __init__(self, image_path, caption_store, loader):
+        super(PreviewWorker, self).__init__()
+        self.image_path = image_path
+        self.caption_store = caption_store
+        self.loader = loader
+
+    def run(self):
+        image, caption = load_preview(self.image_path, self.caption_store)
+        self.loader.loaded.emit(self.image_path, image, caption)
+
+
+class PreviewLoader(QObject):
+    """
+    Prefetches the images around the one on screen into a PreviewCache.
+    Like ThumbnailLoader, the newest request runs first and requests still
+    queued are dropped when the user moves on.
+    """
+
+    loaded = pyqtSignal(str, QImage, object)
+
+    def __init__(self, preview_cache, parent=None):
+        super().__init__(parent)
+        self.preview_cache = preview_cache
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(2)
+        self.pending = set()
+        self.priority = 0
+        self.loaded.connect(self.preview_loaded)
+
+    def request(self, image_path, caption_store):
+        if image_path in self.pending or image_path in self.preview_cache:
+            return
+        self.pending.add(image_path)
+        self.priority += 1
+        self.thread_pool.start(PreviewWorker(image_path, caption_store, self), self.priority)
+
+    def preview_loaded(self, image_path, image, caption):
+        if not image.isNull():
+            self.preview_cache.put(image_path, (image, caption), image.sizeInBytes())
+        self.pending.discard(image_path)
+
+    def clear_pending(self):
+        self.thread_pool.clear()
+        self.pending.clear()
+
+
+class ThumbnailWorker(QRunnable):
+    def __init__(self, image_path, loader):
+        super(ThumbnailWorker, self).__init__()
+        self.image_path = image_path
+        self.loader = loader
+
+    def run(self):
+        image = load_thumbnail_image(self.image_path, self.loader.thumbnail_cache, self.loader.size)
+        self.loader.loaded.emit(self.image_path, image)
+
+
+class ThumbnailLoader(QObject):
+    """
+    Decodes thumbnails on its own thread pool and hands them back through
+    `loaded` as they finish.  Newer requests run first, and anything still
+    queued is dropped when the grid scrolls, so the cells on screen always
+    come before ones the user has already scrolled past.
+    """
+
+    loaded = pyqtSignal(str, QImage)
+
+    def __init__(self, thumbnail_cache, parent=None, size=THUMBNAIL_SIZE):
+        super().__init__(parent)
+        self.thumbnail_cache = thumbnail_cache
+        self.size = size
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(max(2, QThread.idealThreadCount() // 2))
+        self.pending = set()
+        self.priority = 0
+        self.loaded.connect(lambda image_path, image: self.pending.discard(image_path))
+
+    def request(self, image_path):
+        if image_path in self.pending:
+            return
+        self.pending.add(image_path)
+        self.priority += 1
+        self.thread_pool.start(ThumbnailWorker(image_path, self), self.priority)
+
+    def clear_pending(self):
+        self.thread_pool.clear()
+        self.pending.clear()
+
+
+class ThumbnailListModel(QAbstractListModel):
+    """
+    List model behind the thumbnail grid.  The view only asks for the cells
+    it is about to paint; thumbnails that aren't in memory yet are requested
+    from the loader and filled in as they arrive.  Only the most recently
+    painted ones are kept in memory.
+    """
+
+    def __init__(self, loader, parent=None):
+        super().__init__(parent)
+        self.images = []
+        self.rows = {}
+        self.loader = loader
+        self.pixmaps = OrderedDict()
+        self.loader.loaded.connect(self.thumbnail_loaded)
+
+    def set_images(self, images):
+        self.beginResetModel()
+        self.loader.clear_pending()
+        self.images = list(images)
+        self.rows = {image_path: row for row, image_path in enumerate(self.images)}
+        self.pixmaps.clear()
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.images)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.images):
+            return None
+        image_path = self.images[index.row()]
+        if role == Qt.DecorationRole:
+            return self.thumbnail(image_path)
+        if role == Qt.ToolTipRole:
+            return os.path.basename(image_path)
+        if role == Qt.SizeHintRole:
+            return QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        return None
+
+    def thumbnail(self, image_path):
+        pixmap = self.pixmaps.get(image_path)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(image_path)
+            return pixmap
+        self.loader.request(image_path)
+        return None
+
+    def thumbnail_loaded(self, image_path, image):
+        row = self.rows.get(image_path)
+        if row is None:
+            return
+        self.pixmaps[image_path] = QPixmap.fromImage(image)
+        if len(self.pixmaps) > THUMBNAILS_IN_MEMORY:
+            self.pixmaps.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def insert_images(self, images):
+        """Insert `images` at their natural order positions; a block that sorts last is appended in one go."""
+        if not images:
+            return
+        images = sorted(images, key=image_directory.natural_key)
+        if not self.images or image_directory.natural_key(images[0]) > image_directory.natural_key(self.images[-1]):
+            first = len(self.images)
+            self.beginInsertRows(QModelIndex(), first, first + len(images) - 1)
+            for row, image_path in enumerate(images, first):
+                self.images.append(image_path)
+                self.rows[image_path] = row
+            self.endInsertRows()
+            return
+        for image_path in images:
+            row = bisect.bisect(self.images, image_directory.natural_key(image_path), key=image_directory.natural_key)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.images.insert(row, image_path)
+            self.endInsertRows()
+        self.rows = {image_path: row for row, image_path in enumerate(self.images)}
+
+    def remove_images(self, images):
+        rows = sorted((self.rows[image_path] for image_path in images if image_path in self.rows), reverse=True)
+        for row in rows:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            self.pixmaps.pop(self.images.pop(row), None)
+            self.endRemoveRows()
+        if rows:
+            self.rows = {image_path: row for row, image_path in enumerate(self.images)}
+
+    def refresh_image(self, image_path):
+        """Drop the thumbnail of a changed image so the view asks for it again."""
+        row = self.rows.get(image_path)
+        if row is None:
+            return
+        self.pixmaps.pop(image_path, None)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class DirectoryWatcher(QObject):
+    """
+    Keeps a scan of the open directory current and reports only what
+    changed.  QFileSystemWatcher says which folder changed; after a short
+    delay (so a burst of writes costs one rescan) just that folder's subtree
+    is walked again by a RescanWorker, through the scan cache so unchanged
+    subfolders are only stat'ed, and compared with the previous scan.
+    Folders that can't be watched (some network file systems) are polled
+    instead.
+
+    The app's own caption writes (temporary file, then rename) change their
+    folder too; expect_writes() holds back that folder's changes until the
+    writes stop, so captioning a dataset doesn't rescan it every RESCAN_DELAY.
+    """
+
+    changed = pyqtSignal(list, list, list)
+    RESCAN_DELAY = 250
+    POLL_INTERVAL = 5000
+    OWN_WRITE_QUIET = 2000
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.directory = None
+        self.recursive = False
+        self.cache = None
+        self.images = {}
+        self.pending = set()
+        self.fresh = False
+        self.check = set()
+        self.unwatched = set()
+        self.own_writes = {}
+        self.deferred = set()
+        self.worker = None
+        self.rescan_requested = False
+        # One rescan at a time: each one starts from the result of the last.
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(1)
+        self.watcher = QFileSystemWatcher(self)
+        self.rescan_timer = QTimer(self)
+        self.rescan_timer.setSingleShot(True)
+        self.rescan_timer.setInterval(self.RESCAN_DELAY)
+        self.rescan_timer.timeout.connect(self.rescan)
+        self.watcher.directoryChanged.connect(self.directory_changed)
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(self.POLL_INTERVAL)
+        self.poll_timer.timeout.connect(self.poll)
+        self.quiet_timer = QTimer(self)
+        self.quiet_timer.setSingleShot(True)
+        self.quiet_timer.timeout.connect(self.own_writes_stopped)
+
+    def watch(self, directory, recursive=False, cache=None, scan=None):
+        """Start watching `directory`; `scan` is a finished DirectoryScan of it (one is run if not given)."""
+        self.stop()
+        if scan is None:
+            scan = image_directory.DirectoryScan(directory, recursive, cache)
+            scan.run()
+        self.directory = directory
+        self.recursive = recursive
+        self.cache = cache
+        self.images = dict(scan.images)
+        self._start_watching(scan.folders)
+        return self.images
+
+    def stop(self):
+        """Stop watching, waiting for a running rescan so the scan cache is free to be saved."""
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+        self.poll_timer.stop()
+        self.rescan_timer.stop()
+        self.quiet_timer.stop()
+        self.thread_pool.waitForDone()
+        self.worker = None
+        self.rescan_requested = False
+        self.pending.clear()
+        self.fresh = False
+        self.check.clear()
+        self.unwatched.clear()
+        self.own_writes.clear()
+        self.deferred.clear()
+        self.directory = None
+        self.images = {}
+
+    def _start_watching(self, folders):
+        watched = set(self.watcher.directories())
+        folders = [folder for folder in folders if folder not in watched and folder not in self.unwatched]
+        if folders:
+            self.unwatched.update(self.watcher.addPaths(folders))
+        if self.unwatched:
+            self.poll_timer.start()
+
+    def directory_changed(self, path):
+        if self.own_writes.get(path, 0) > time.monotonic():
+            self.deferred.add(path)
+            return
+        self.pending.add(path)
+        self.rescan_timer.start()
+
+    def expect_writes(self, folder):
+        """The app is about to write a caption (or caption database) in `folder`."""
+        self.own_writes[folder] = time.monotonic() + self.OWN_WRITE_QUIET / 1000
+        self.quiet_timer.start(self.OWN_WRITE_QUIET)
+
+    def own_writes_stopped(self):
+        now = time.monotonic()
+        self.own_writes = {folder: until for folder, until in self.own_writes.items() if until > now}
+        released = {folder for folder in self.deferred if folder not in self.own_writes}
+        self.deferred -= released
+        if self.own_writes:
+            # Timers may fire a little early; wait out the rest.
+            self.quiet_timer.start(max(1, int((min(self.own_writes.values()) - now) * 1000) + 1))
+        if released:
+            self.pending.update(released)
+            self.rescan_timer.start()
+
+    def poll(self):
+        self.pending.update(self.unwatched)
+        self.rescan()
+
+    def rescan(self, fresh=False, images=()):
+        """
+        Walk the folders reported as changed (the whole directory if none
+        were, or if `fresh`, which also re-stats every image) off the GUI
+        thread, re-stat `images` too, and emit what differs from the
+        previous scan.  A rescan asked for while one runs follows it.
+        """
+        if self.directory is None:
+            return
+        self.fresh = self.fresh or fresh
+        self.check.update(images)
+        if self.worker is not None:
+            self.rescan_requested = True
+            return
+        roots = [self.directory] if self.fresh or not self.pending else sorted(self.pending)
+        worker = RescanWorker(self.directory, self.recursive, self.cache, self.images, roots, self.fresh,
+                              sorted(self.check))
+        self.pending.clear()
+        self.fresh = False
+        self.check.clear()
+        worker.signals.finished.connect(lambda images, folders: self.rescan_finished(worker, images, folders))
+        self.worker = worker
+        self.thread_pool.start(worker)
+
+    def rescan_finished(self, worker, images, folders):
+        if worker is not self.worker:
+            return
+        self.worker = None
+        # New subfolders, or the directory itself if it was deleted and recreated.
+        self._start_watching(folders)
+        added, removed, modified = image_directory.compare(self.images, images)
+        self.images = images
+        if self.rescan_requested:
+            self.rescan_requested = False
+            self.rescan()
+        if added or removed or modified:
+            self.changed.emit(added, removed, modified)
+
+
+class RescanSignals(QObject):
+    finished = pyqtSignal(dict, list)
+
+
+class RescanWorker(QRunnable):
+    """One DirectoryWatcher rescan: walks `roots` and re-stats `check`, starting from the previous `images`."""
+
+    def __init__(self, directory, recursive, cache, images, roots, fresh=False, check=()):
+        super(RescanWorker, self).__init__()
+        self.directory = directory
+        self.recursive = recursive
+        self.cache = cache
+        self.images = images
+        self.roots = roots
+        self.fresh = fresh
+        self.check = check
+        self.signals = RescanSignals()
+
+    def run(self):
+        images = dict(self.images)
+        folders = []
+        try:
+            for root in self.roots:
+                if root != self.directory and not self.recursive:
+                    continue
+                prefix = os.path.join(root, "")
+                for image_path in [image_path for image_path in images if image_path.startswith(prefix)]:
+                    del images[image_path]
+                scan = image_directory.DirectoryScan(root, self.recursive, self.cache, self.fresh)
+                images.update(scan.run())
+                folders.extend(scan.folders)
+            # Images rewritten in place don't change their folder's mtime.
+            for image_path in self.check:
+                if image_path not in images:
+                    continue
+                try:
+                    stat = os.stat(image_path)
+                except OSError:
+                    continue
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if signature != images[image_path]:
+                    images[image_path] = signature
+                    if self.cache is not None:
+                        self.cache.update(image_path, signature)
+        except Exception:
+            images = dict(self.images)
+        self.signals.finished.emit(images, folders)
+
+
+class ScanSignals(QObject):
+    found = pyqtSignal(list)
+    finished = pyqtSignal()
+    error = pyqtSignal(str)
+
+
+class ScanWorker(QRunnable):
+    """Runs a DirectoryScan off the GUI thread and hands its images out chunk by chunk."""
+
+    def __init__(self, scan):
+        super(ScanWorker, self).__init__()
+        self.scan = scan
+        self.cancelled = False
+        self.signals = ScanSignals()
+
+    def run(self):
+        try:
+            for chunk in self.scan:
+                if self.cancelled:
+                    return
+                self.signals.found.emit([image_path for image_path, _ in chunk])
+            if self.scan.cache is not None:
+                self.scan.cache.save()
+        except Exception as e:
+            self.signals.error.emit(str(e))
+            return
+        self.signals.finished.emit()
+
+
 class ImageBrowser(QMainWindow):
     max_length = 16
     num_beams = 4
@@ -68,7 +578,10 @@ class ImageBrowser(QMainWindow):
     def show_settings_dialog(self):
         settings_dialog_instance = SettingsDialog(self)
         if settings_dialog_instance.exec_() == QDialog.Accepted:
-            pass
+            self.settings_dialog.load_from_json("settings.json")
+            self.apply_model_settings()
+            if self.directory:
+                self.open_caption_store()
 
     def __init__(self):
         super().__init__()
@@ -82,22 +595,31 @@ class ImageBrowser(QMainWindow):
         self.directory = None
         self.images = []
         self.current_image = None
-        self.text_filename = None
+        self.text_image = None
         self.remember_last_directory = True
         self.default_directory = None
         self.thread_pool = QThreadPool()
-        self.models = {
-            "VIT-GPT2": {
-                "name": "VIT-GPT2",
-                "model": model,
-                "tokenizer": tokenizer,
-            },
-            "BLIP": {
-                "name": "BLIP",
-                "model": blip_model,
-                "tokenizer": blip_processor,
-            },
-        }
+        self.caption_pipeline = None
+        self.caption_trace = None
+        self.models = captioning.create_registry()
+        self.thumbnail_cache = ThumbnailCache()
+        self.preview_cache = PreviewCache()
+        self.preview_loader = PreviewLoader(self.preview_cache, self)
+        self.caption_cache = CaptionCache()
+        self.feature_cache = None
+        self.caption_summary = None
+        self.caption_failures = {}
+        self.last_caption_report = None
+        self.caption_job = None
+        self.caption_store = TextFileStore()
+        self.caption_stores = {}
+        self.caption_index = CaptionIndex(self.caption_store)
+        self.directory_watcher = DirectoryWatcher(self)
+        self.directory_watcher.changed.connect(self.images_changed)
+        self.scan_thread_pool = QThreadPool(self)
+        self.scan_thread_pool.setMaxThreadCount(1)
+        self.scan_worker = None
+        self.scan_cache = None
 
         self.init_ui()
 
@@ -152,13 +674,30 @@ class ImageBrowser(QMainWindow):
         self.back_button = QPushButton("Back")
         self.back_button.clicked.connect(self.show_thumbnails)
 
-        self.thumbnail_frame = QWidget()
-        self.thumbnail_layout = QGridLayout()
-        self.thumbnail_layout.setSpacing(10)  # Set spacing between grid items
-        self.thumbnail_frame.setLayout(self.thumbnail_layout)
-        self.thumbnail_scroll_area = QScrollArea()
-        self.thumbnail_scroll_area.setWidget(self.thumbnail_frame)
-        self.thumbnail_scroll_area.setWidgetResizable(True)
+        self.thumbnail_loader = ThumbnailLoader(self.thumbnail_cache, self)
+        self.thumbnail_model = ThumbnailListModel(self.thumbnail_loader, self)
+        self.thumbnail_view = QListView()
+        self.thumbnail_view.setViewMode(QListView.IconMode)
+        self.thumbnail_view.setMovement(QListView.Static)
+        self.thumbnail_view.setResizeMode(QListView.Adjust)
+        self.thumbnail_view.setUniformItemSizes(True)
+        self.thumbnail_view.setLayoutMode(QListView.Batched)
+        self.thumbnail_view.setBatchSize(500)
+        self.thumbnail_view.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.thumbnail_view.setGridSize(QSize(THUMBNAIL_SIZE + THUMBNAIL_SPACING, THUMBNAIL_SIZE + THUMBNAIL_SPACING))
+        self.thumbnail_view.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.thumbnail_view.setModel(self.thumbnail_model)
+        self.thumbnail_view.clicked.connect(self.thumbnail_clicked)
+        self.thumbnail_view.verticalScrollBar().valueChanged.connect(self.thumbnail_loader.clear_pending)
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText("Search captions")
+        self.search_box.setClearButtonEnabled(True)
+        self.search_label = QLabel()
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.apply_caption_filter)
+        self.search_box.textChanged.connect(self.search_timer.start)
         self.status_label = QLabel(self)
         self.status_label.setGeometry(QRect(10, 470, 600, 30))
         self.status_label.setStyleSheet("font-weight: bold; color: green;")
@@ -173,6 +712,24 @@ class ImageBrowser(QMainWindow):
         self.find_replace_all_action = self.file_menu.addAction("Find & Replace All")
         self.find_replace_all_action.triggered.connect(self.find_replace_all)
 
+        self.bulk_edit_action = self.file_menu.addAction("Bulk Edit Captions...")
+        self.bulk_edit_action.triggered.connect(self.bulk_edit_captions)
+
+        self.undo_bulk_edit_action = self.file_menu.addAction("Undo Last Bulk Edit")
+        self.undo_bulk_edit_action.triggered.connect(self.undo_bulk_edit)
+
+        self.import_captions_action = self.file_menu.addAction("Import Captions From .txt Files")
+        self.import_captions_action.triggered.connect(self.import_text_captions)
+
+        self.export_captions_action = self.file_menu.addAction("Export Captions To .txt Files")
+        self.export_captions_action.triggered.connect(self.export_text_captions)
+
+        self.resume_caption_job_action = self.file_menu.addAction("Resume Captioning Job")
+        self.resume_caption_job_action.triggered.connect(self.resume_caption_job)
+
+        self.performance_action = self.file_menu.addAction("Performance Statistics")
+        self.performance_action.triggered.connect(self.show_performance_statistics)
+
         self.dark_mode_action = self.file_menu.addAction("Dark Mode")
         self.dark_mode_action.setCheckable(True)
         self.dark_mode_action.toggled.connect(self.toggle_dark_mode)
@@ -184,56 +741,79 @@ class ImageBrowser(QMainWindow):
         self.model_dropdown = QComboBox()
         self.model_dropdown.addItem("VIT-GPT2")
         self.model_dropdown.addItem("BLIP")
+        self.model_dropdown.addItem(captioning.MODEL_SEPARATOR.join(self.models.names()))
+        self.model_dropdown.setItemData(2, "Caption with every model in one pass and combine the captions "
+                                           "(see Settings > Captioning)", Qt.ToolTipRole)
         self.generate_captions_button.clicked.connect(self.generate_captions)
         settings_action = QAction("Settings", self)
         settings_action.triggered.connect(self.show_settings_dialog)
         self.settings_dialog = SettingsDialog()
         self.settings_dialog.load_from_json("settings.json")
-        self.load_last_directory()
+        self.apply_model_settings()
 
-        
         if self.settings_dialog.dark_mode_on_launch:
             self.toggle_dark_mode(True)
 
-        if self.settings_dialog.remember_last_directory:
-            self.load_last_directory()
+        # Once: each call starts the directory's scan over.
+        self.load_last_directory()
 
         self.file_menu.addAction(settings_action)
+        QTimer.singleShot(0, self.offer_to_resume_caption_job)
     def show_status_message(self, message, duration=750):
         self.status_label.setText(message)
         self.status_label.setStyleSheet("color: #4a9a7d")
         self.status_label.show()
-        QTimer.singleShot(duration, self.status_label.hide)
+        if duration:
+            QTimer.singleShot(duration, self.status_label.hide)
 
 
     def predict_step(self, image_paths):
         selected_model = self.model_dropdown.currentText()
+        captions = {model_name: captioning.predict_step(self.models, model_name, image_paths, self.gen_kwargs)
+                    for model_name in captioning.split_models(selected_model)}
+        return [captioning.merge_captions({model_name: model_captions[index]
+                                           for model_name, model_captions in captions.items()},
+                                          self.settings_dialog.merge_captions)
+                for index in range(len(image_paths))]
+
+    def apply_model_settings(self):
+        for model_name, precision in self.settings_dialog.precision.items():
+            if model_name in self.models and precision in captioning.PRECISIONS:
+                self.models.set_precision(model_name, precision)
+        for model_name, runtime in self.settings_dialog.runtime.items():
+            if model_name in self.models and runtime in captioning.RUNTIMES:
+                self.models.set_runtime(model_name, runtime)
+        self.models.server_address = captioning.server_address() if self.settings_dialog.use_caption_server else None
+        self.gen_kwargs = {"max_length": self.settings_dialog.max_length, "num_beams": self.settings_dialog.num_beams}
+
+    def load_model_then(self, model_name, callback):
+        if all(self.models.is_loaded(name) for name in captioning.split_models(model_name)):
+            callback()
+            return
+
+        worker = ModelLoadWorker(self.models, model_name)
+        worker.signals.progress.connect(lambda message: self.show_status_message(message, duration=None))
+        worker.signals.loaded.connect(lambda: self.model_loaded(model_name, callback))
+        worker.signals.error.connect(self.model_load_failed)
+        self.thread_pool.start(worker)
+
+    def model_loaded(self, model_name, callback):
+        report = "\n".join(self.models.timing_report(name) for name in captioning.split_models(model_name))
+        self.show_status_message(report, duration=3000)
+        callback()
 
-        captions = []
-        for image_path in image_paths:
-            if selected_model == "VIT-GPT2":
-                image = feature_extractor(Image.open(image_path).convert("RGB").resize((384, 384)), return_tensors="pt").to(device)
-                with torch.no_grad():
-                    output = model.generate(pixel_values=image["pixel_values"], **self.gen_kwargs)
-                caption = tokenizer.batch_decode(output, skip_special_tokens=True)[0]
-            elif selected_model == "BLIP":
-                raw_image = Image.open(image_path).convert('RGB')
-                inputs = blip_processor(raw_image, return_tensors="pt")
-                out = blip_model.generate(**inputs)
-                caption = blip_processor.decode(out[0], skip_special_tokens=True)
-
-            captions.append(caption)
-
-        return captions
-
-    def load_text(self):
-        self.text_filename = os.path.splitext(self.images[self.current_image])[0] + ".txt"
-
-        if os.path.exists(self.text_filename):
-            with open(self.text_filename, "r", encoding="utf-8") as file:
-                self.textbox.setPlainText(file.read())
+    def model_load_failed(self, message):
+        self.status_label.hide()
+        QMessageBox.critical(self, "Error", f"Could not load the captioning model: {message}")
+
+    def load_text(self, caption=None):
+        """Show the caption of the current image; `caption` is a prefetched one from load_preview()."""
+        self.text_image = self.images[self.current_image]
+        if (caption is not None and self.caption_store.kind == "txt"
+                and caption[0] == text_file_signature(self.text_image)):
+            self.textbox.setPlainText(caption[1])
         else:
-            self.textbox.setPlainText("")
+            self.textbox.setPlainText(self.caption_store.load(self.text_image))
 
     def show_thumbnails(self):
         self.clear_layout(self.layout)
@@ -252,21 +832,37 @@ class ImageBrowser(QMainWindow):
         model_layout.addWidget(self.model_dropdown)
         button_layout.addLayout(model_layout)
 
-        self.layout.addLayout(button_layout)
+        search_layout = QHBoxLayout()
+        search_layout.addWidget(self.search_box)
+        search_layout.addWidget(self.search_label)
+        button_layout.addLayout(search_layout)
 
-        for i in reversed(range(self.thumbnail_layout.count())):
-            self.thumbnail_layout.itemAt(i).widget().setParent(None)
+        self.layout.addLayout(button_layout)
 
-        for index, image_path in enumerate(self.images):
-            thumbnail_pixmap = QPixmap(image_path).scaled(150, 150, Qt.KeepAspectRatio, Qt.FastTransformation)
+        self.apply_caption_filter()
 
-            thumbnail_label = QLabel()
-            thumbnail_label.setPixmap(thumbnail_pixmap)
-            thumbnail_label.setFixedSize(150, 150)
-            thumbnail_label.mousePressEvent = lambda event, idx=index: self.show_image(idx)
-            self.thumbnail_layout.addWidget(thumbnail_label, index // 4, index % 4)
+        self.layout.addWidget(self.thumbnail_view)
+        if self.current_image is not None and self.current_image < len(self.images):
+            row = self.thumbnail_model.rows.get(self.images[self.current_image])
+            if row is not None:
+                self.thumbnail_view.scrollTo(self.thumbnail_model.index(row))
+
+    def apply_caption_filter(self):
+        """Show only the thumbnails whose caption contains the search text."""
+        query = self.search_box.text()
+        images = self.images
+        if query.strip():
+            matches = self.caption_index.search(query)
+            images = [image_path for image_path in self.images if image_path in matches]
+            self.search_label.setText(f"{len(images)}/{len(self.images)} images, "
+                                      f"{sum(matches.values())} matches")
+        else:
+            self.search_label.setText("")
+        if self.thumbnail_model.images != images:
+            self.thumbnail_model.set_images(images)
 
-        self.layout.addWidget(self.thumbnail_scroll_area)
+    def thumbnail_clicked(self, index):
+        self.show_image(self.images.index(self.thumbnail_model.images[index.row()]))
 
     def create_captioning_settings_tab(self):
         captioning_settings_tab = QWidget()
@@ -284,22 +880,18 @@ class ImageBrowser(QMainWindow):
         return captioning_settings_tab
 
     def show_image(self, index):
+        previous_image = self.current_image
         self.current_image = index
         image_path = self.images[self.current_image]
 
-        
-        pixmap = QPixmap(image_path)
-        image_qimage = pixmap.toImage()
+        preview = self.preview_cache.get(image_path)
+        if preview is None:
+            preview = load_preview(image_path, self.caption_store)
+            if not preview[0].isNull():
+                self.preview_cache.put(image_path, preview, preview[0].sizeInBytes())
+        image, caption = preview
 
-        
-        max_size = QSize(400, 400)
-        scaled_size = image_qimage.size().scaled(max_size, Qt.KeepAspectRatio)
-
-        
-        image_qimage_scaled = image_qimage.scaled(scaled_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        image_qpixmap = QPixmap.fromImage(image_qimage_scaled)
-
-        self.image_label.setPixmap(image_qpixmap)
+        self.image_label.setPixmap(QPixmap.fromImage(image))
 
         self.clear_layout(self.layout)
         self.layout.addWidget(self.scroll_area)
@@ -325,8 +917,19 @@ class ImageBrowser(QMainWindow):
 
         self.layout.addLayout(control_layout)
 
-        self.load_text()
+        self.load_text(caption)
         self.image_label.setStyleSheet("border: none;")
+        self.prefetch_previews(index, -1 if previous_image is not None and index < previous_image else 1)
+
+    def prefetch_previews(self, index, direction):
+        """Load the next PREFETCH_AHEAD images in `direction` (and PREFETCH_BEHIND the other way) in the background."""
+        self.preview_loader.clear_pending()
+        # Requested least important first: the newest request runs first.
+        wanted = ([index - direction * step for step in range(PREFETCH_BEHIND, 0, -1)]
+                  + [index + direction * step for step in range(PREFETCH_AHEAD, 0, -1)])
+        for neighbour in wanted:
+            if 0 <= neighbour < len(self.images):
+                self.preview_loader.request(self.images[neighbour], self.caption_store)
 
 
     def focusInEvent(self, event):
@@ -377,31 +980,195 @@ class ImageBrowser(QMainWindow):
 
         crop_resize_dialog = CropResizeDialog(self.images,
                                               self.preselected_width,
-                                              self.preselected_height, self)
+                                              self.preselected_height, self,
+                                              self.settings_dialog.crop_output_format,
+                                              self.settings_dialog.crop_quality)
         cropped_successfully = crop_resize_dialog.exec_()
+        self.settings_dialog.crop_output_format = crop_resize_dialog.output_format_dropdown.currentText()
+        self.settings_dialog.crop_quality = crop_resize_dialog.quality_input.value()
+        self.settings_dialog.save_to_json("settings.json")
         if cropped_successfully:
-            
-            self.load_images()
+            for result in crop_resize_dialog.crop_results:
+                if result.output_path is not None and result.output_path != result.image_path:
+                    self.caption_store.rename(result.image_path, result.output_path)
+            # The rescan finds the rewritten images and refreshes just their thumbnails.
+            self.load_images([result.output_path or result.image_path for result in crop_resize_dialog.crop_results])
+
+    def load_images(self, changed_images=()):
+        recursive = self.settings_dialog.include_subfolders
+        if (self.scan_worker is None and self.directory_watcher.directory == self.directory
+                and self.directory_watcher.recursive == recursive):
+            # Already open: only pick up what changed on disk since.
+            self.directory_watcher.rescan(images=changed_images)
+            self.show_thumbnails()
+            return
+        self.directory_watcher.stop()
+        if self.scan_worker is not None:
+            self.scan_worker.cancelled = True
+        elif self.scan_cache is not None:
+            self.scan_cache.save()
+        self.scan_cache = image_directory.ScanCache.load(self.directory)
+        self.preview_cache.clear()
+        self.images = []
+        self.current_image = None
+        self.caption_store = self.caption_store_for(self.directory)
+        self.thumbnail_model.set_images([])
+
+        # The grid fills in chunk by chunk while the scan goes on.
+        worker = ScanWorker(image_directory.DirectoryScan(self.directory, recursive, self.scan_cache))
+        worker.signals.found.connect(lambda image_paths: self.images_found(worker, image_paths))
+        worker.signals.finished.connect(lambda: self.scan_finished(worker))
+        worker.signals.error.connect(lambda message: self.scan_failed(worker, message))
+        self.scan_worker = worker
+        self.scan_thread_pool.start(worker)
+        self.show_thumbnails()
 
-    def load_images(self):
-        self.images = []  
-        for file in os.listdir(self.directory):
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                image_path = os.path.join(self.directory, file)
-                self.images.append(image_path)
-                
+    def images_found(self, worker, image_paths):
+        if worker is not self.scan_worker:
+            return
+        self.images.extend(image_paths)
+        self.create_caption_files(image_paths)
+        if not self.search_box.text().strip():
+            self.thumbnail_model.insert_images(image_paths)
+        self.search_label.setText(f"Scanning... {len(self.images)} images")
+
+    def scan_finished(self, worker):
+        if worker is not self.scan_worker:
+            return
+        self.scan_worker = None
+        scan = worker.scan
+        self.directory_watcher.watch(self.directory, scan.recursive, self.scan_cache, scan)
+        self.open_caption_store()
+        self.apply_caption_filter()
+        if scan.recursive:
+            self.show_status_message(f"Found {len(self.images)} images in {len(scan.folders)} folders.",
+                                     duration=3000)
+
+    def scan_failed(self, worker, message):
+        if worker is not self.scan_worker:
+            return
+        self.scan_worker = None
+        self.search_label.setText("")
+        QMessageBox.critical(self, "Error", f"Could not read {self.directory}: {message}")
+
+    def wait_for_scan(self):
+        """Block until the directory scan started by load_images() has delivered every image."""
+        while self.scan_worker is not None:
+            QApplication.processEvents()
+            self.scan_thread_pool.waitForDone(10)
+
+    def create_caption_files(self, image_paths):
+        if self.caption_store.kind == "txt":
+            for image_path in image_paths:
                 txt_path = os.path.splitext(image_path)[0] + ".txt"
                 if not os.path.exists(txt_path):
                     with open(txt_path, "w") as txt_file:
                         txt_file.write("")
 
-        
-        self.show_thumbnails()
+    def images_changed(self, added, removed, modified):
+        """Apply images added, removed or modified on disk to the list, the grid and the caches."""
+        current = None
+        if self.current_image is not None and self.current_image < len(self.images):
+            current = self.images[self.current_image]
+        if removed:
+            gone = set(removed)
+            self.images = [image_path for image_path in self.images if image_path not in gone]
+            for image_path in removed:
+                self.thumbnail_cache.invalidate(image_path)
+                self.preview_cache.invalidate(image_path)
+                self.caption_index.discard(image_path)
+        if added:
+            if len(added) > 1000:
+                self.images = sorted(self.images + added, key=image_directory.natural_key)
+            else:
+                for image_path in added:
+                    bisect.insort(self.images, image_path, key=image_directory.natural_key)
+            self.create_caption_files(added)
+            for image_path in added:
+                self.caption_index.update(image_path, self.caption_store.load(image_path))
+        for image_path in modified:
+            self.thumbnail_cache.invalidate(image_path)
+            self.preview_cache.invalidate(image_path)
+            self.thumbnail_model.refresh_image(image_path)
+
+        if self.search_box.text().strip():
+            self.apply_caption_filter()
+        else:
+            self.thumbnail_model.remove_images(removed)
+            self.thumbnail_model.insert_images(added)
+
+        if current is not None:
+            if current in self.images:
+                self.current_image = self.images.index(current)
+            else:
+                self.current_image = None
+                if self.scroll_area.isVisible():
+                    self.show_thumbnails()
+
+    def caption_store_for(self, directory, kind=None):
+        """The caption store of `directory` (for the current storage setting by default), opened once and kept."""
+        key = (directory, kind or self.settings_dialog.caption_store)
+        if key not in self.caption_stores:
+            self.caption_stores[key] = open_caption_store(*key)
+        return self.caption_stores[key]
+
+    def open_caption_store(self):
+        self.caption_store = self.caption_store_for(self.directory)
+        if self.caption_store.created:
+            # First time this directory uses the store: bring in its existing .txt captions.
+            self.caption_store.created = False
+            imported = self.caption_store.import_text_files(self.images)
+            if imported:
+                self.show_status_message(f"Imported {imported} captions into {self.caption_store.path}.",
+                                         duration=3000)
+        if self.caption_index.store is not self.caption_store:
+            self.caption_index.save()
+            self.caption_index = CaptionIndex.load(self.caption_store)
+        self.caption_index.refresh(self.images)
+        self.close_unused_caption_stores()
+
+    def close_unused_caption_stores(self):
+        """
+        Close the stores of directories the user has moved away from (unless a
+        captioning job still writes to them), so a SQLite store doesn't leave
+        its -wal/-shm files sitting in those dataset folders.
+        """
+        in_use = [self.caption_store]
+        if self.caption_job is not None:
+            in_use.append(self.caption_store_for(self.caption_job.directory))
+        unused = [key for key, caption_store in self.caption_stores.items()
+                  if not any(caption_store is used for used in in_use)]
+        if not unused:
+            return
+        # Prefetches still running may be reading from one of them.
+        self.preview_loader.clear_pending()
+        self.preview_loader.thread_pool.waitForDone()
+        for key in unused:
+            self.caption_stores.pop(key).close()
+
+    def import_text_captions(self):
+        if self.caption_store.kind == "txt":
+            QMessageBox.information(self, "Info", "Captions are already stored as .txt files. "
+                                                  "Choose another Caption Storage in Settings first.")
+            return
+        imported = self.caption_store.import_text_files(self.images)
+        self.caption_index.refresh(self.images)
+        if self.current_image is not None and self.current_image < len(self.images):
+            self.load_text()
+        QMessageBox.information(self, "Info", f"Imported {imported} captions from .txt files.")
+
+    def export_text_captions(self):
+        if self.caption_store.kind == "txt":
+            QMessageBox.information(self, "Info", "Captions are already stored as .txt files.")
+            return
+        exported = self.caption_store.export_text_files(self.images)
+        QMessageBox.information(self, "Info", f"Exported {exported} captions to .txt files.")
 
     def save_text(self):
-        if self.text_filename:
-            with open(self.text_filename, "w", encoding="utf-8") as file:
-                file.write(self.textbox.toPlainText())
+        if self.text_image:
+            text = self.textbox.toPlainText()
+            self.caption_store.save(self.text_image, text)
+            self.caption_index.update(self.text_image, text)
             
             self.show_status_message("Text saved successfully.")
         else:
@@ -435,70 +1202,301 @@ class ImageBrowser(QMainWindow):
         suffix, ok2 = QInputDialog.getText(self, "Suffix", "Enter the suffix:")
 
         if ok1 and ok2:
-            for root, _, files in os.walk(self.directory):
-                for file in files:
-                    if file.lower().endswith('.txt'):
-                        old_path = os.path.join(root, file)
-                        with open(old_path, "r", encoding="utf-8") as f:
-                            lines = [prefix + line.strip() + suffix for line in f]
-                        with open(old_path, "r", encoding="utf-8") as f:
-                            f.write("\n".join(lines))
+            transforms = []
+            if prefix:
+                transforms.append(caption_transforms.Prefix(prefix))
+            if suffix:
+                transforms.append(caption_transforms.Suffix(suffix))
+            if transforms:
+                self.run_bulk_edit(transforms)
 
     def find_replace_all(self):
         find_text, ok1 = QInputDialog.getText(self, "Find", "Enter the text to find:")
         replace_text, ok2 = QInputDialog.getText(self, "Replace", "Enter the text to replace with:")
 
-        if ok1 and ok2:
-            for root, _, files in os.walk(self.directory):
-                for file in files:
-                    if file.lower().endswith('.txt'):
-                        old_path = os.path.join(root, file)
-                        with open(old_path, "r", encoding="utf-8") as f:
-                            content = f.read()
-                        content = content.replace(find_text, replace_text)
-                        with open(old_path, "r", encoding="utf-8") as f:
-                            f.write(content)
+        if ok1 and ok2 and find_text:
+            self.run_bulk_edit([caption_transforms.Replace(find_text, replace_text)])
+
+    def bulk_edit_captions(self):
+        if not self.images:
+            QMessageBox.critical(self, "Error", "No images found in the directory.")
+            return
+        dialog = BulkEditDialog(bool(self.search_box.text().strip()), self)
+        if dialog.exec_() == QDialog.Accepted and dialog.transforms:
+            image_paths = self.thumbnail_model.images if dialog.only_shown else self.images
+            self.run_bulk_edit(dialog.transforms, list(image_paths))
+
+    def run_bulk_edit(self, transforms, image_paths=None):
+        """
+        Work out which captions `transforms` would change (from the caption
+        index, without touching the files), show the changes and apply them
+        if confirmed.
+        """
+        image_paths = self.images if image_paths is None else image_paths
+        self.caption_index.refresh(self.images)
+        changes = caption_transforms.plan(transforms, self.caption_store, image_paths, self.caption_index.texts)
+        description = caption_transforms.describe(transforms)
+        if not changes:
+            QMessageBox.information(self, "Info", f"No captions would change ({description}).")
+            return
+        if not self.confirm_bulk_edit(description, changes, len(image_paths)):
+            return
+        caption_transforms.apply(changes, self.caption_store, description)
+        self.captions_edited({image_path: new for image_path, _, new in changes})
+        self.show_status_message(f"Changed {len(changes)} captions. File > Undo Last Bulk Edit reverts it.",
+                                 duration=3000)
+
+    def confirm_bulk_edit(self, description, changes, total):
+        box = QMessageBox(QMessageBox.Question, "Bulk Edit",
+                          f"{description[0].upper()}{description[1:]}.\n\n"
+                          f"This changes {len(changes)} of {total} captions. Apply it?",
+                          QMessageBox.Yes | QMessageBox.No, self)
+        box.setDetailedText(caption_transforms.diff(changes))
+        return box.exec_() == QMessageBox.Yes
+
+    def undo_bulk_edit(self):
+        journal_path = caption_transforms.latest_journal()
+        if journal_path is None:
+            QMessageBox.information(self, "Info", "There is no bulk edit to undo.")
+            return
+        header, entries = caption_transforms.read_journal(journal_path)
+        answer = QMessageBox.question(self, "Undo Bulk Edit",
+                                      f"Undo \"{header['description']}\" ({len(entries)} captions, {header['time']})?")
+        if answer != QMessageBox.Yes:
+            return
+        caption_store = self.caption_store_for(header["directory"], header["store"])
+        restored, conflicts = caption_transforms.undo(caption_store, journal_path)
+        if caption_store is self.caption_store:
+            self.captions_edited(restored)
+        message = f"Restored {len(restored)} captions."
+        if conflicts:
+            message += f"\n{len(conflicts)} captions were edited again since and were left as they are."
+        QMessageBox.information(self, "Info", message)
+
+    def captions_edited(self, captions):
+        """Bring the index, the grid filter and the open caption up to date after a bulk change."""
+        for image_path, caption in captions.items():
+            self.caption_index.update(image_path, caption)
+        self.caption_index.save()
+        if self.text_image in captions:
+            self.load_text()
+        self.apply_caption_filter()
 
     def generate_captions(self):
         if not self.images:
             QMessageBox.critical(self, "Error", "No images found in the directory.")
             return
+        if self.caption_job is not None:
+            QMessageBox.critical(self, "Error", "Captions are already being generated.")
+            return
         selected_model = self.model_dropdown.currentText()
-        print(f"Generating captions using the {selected_model} model.")
-
-        
-        worker = CaptionWorker(self.images, selected_model, self.predict_step)
+        job = CaptionJob.create(self.directory, selected_model, dict(self.gen_kwargs), self.images,
+                                self.settings_dialog.keep_existing_captions)
+        self.start_caption_job(job)
+
+    def start_caption_job(self, job):
+        self.caption_job = job
+        self.caption_failures = {}
+        print(f"Generating captions using the {job.model_name} model.")
+
+        self.caption_trace = None
+        if self.settings_dialog.write_timing_trace:
+            self.caption_trace = captioning.StageTrace(captioning.CAPTION_TRACE_FILE,
+                                                       captioning.CAPTION_TIMELINE_FILE)
+        feature_cache = None
+        if self.settings_dialog.cache_encoder_features:
+            if self.feature_cache is None:
+                self.feature_cache = FeatureCache()
+            feature_cache = self.feature_cache
+        self.caption_pipeline = captioning.create_pipeline(self.models, job.model_name, job.gen_kwargs,
+                                                           self.settings_dialog.batch_size,
+                                                           self.settings_dialog.worker_processes,
+                                                           trace=self.caption_trace, feature_cache=feature_cache)
+        worker = CaptionWorker(job.remaining(), job.model_name, self.caption_pipeline, self.caption_cache,
+                               job.keep_existing, self.caption_store_for(job.directory),
+                               self.settings_dialog.merge_captions)
         worker.signals.progress.connect(self.update_progress)
+        worker.signals.status.connect(lambda message: self.show_status_message(message, duration=None))
         worker.signals.caption_generated.connect(self.save_caption)
+        worker.signals.caption_failed.connect(self.caption_failed)
+        worker.signals.caption_kept.connect(self.caption_kept)
+        worker.signals.summary.connect(self.set_caption_summary)
+        worker.signals.error.connect(self.caption_job_failed)
         worker.signals.done.connect(self.captions_generated)
 
         self.thread_pool.start(worker)
 
+    def offer_to_resume_caption_job(self):
+        if self.caption_job is not None:
+            return
+        job = CaptionJob.load()
+        if job is None:
+            return
+        answer = QMessageBox.question(
+            self, "Resume Captioning",
+            f"Captioning of {job.directory} with {job.model_name} was interrupted after "
+            f"{job.completed_count()}/{job.total()} images.\nResume it now?")
+        if answer == QMessageBox.Yes:
+            self.resume_caption_job(job=job)
+        else:
+            job.close()
+
+    def resume_caption_job(self, checked=False, job=None):
+        if self.caption_job is not None:
+            QMessageBox.critical(self, "Error", "Captions are already being generated.")
+            return
+        job = job or CaptionJob.load()
+        if job is None:
+            QMessageBox.information(self, "Info", "There is no unfinished captioning job.")
+            return
+        if job.directory != self.directory and os.path.isdir(job.directory):
+            self.directory = job.directory
+            self.load_images()
+        self.start_caption_job(job)
+
+    def set_caption_summary(self, summary):
+        self.caption_summary = summary
+
+    def close_caption_trace(self):
+        """Close the run's timing trace; returns a line saying where it was written, for the end-of-run message."""
+        if self.caption_trace is None:
+            return ""
+        self.caption_trace.close()
+        message = f"\n\nTiming trace written to {self.caption_trace.path}" + (
+            f" and {self.caption_trace.timeline_path}" if self.caption_trace.timeline_path else "") + "."
+        self.caption_trace = None
+        return message
+
+    def caption_failed(self, image_path, message):
+        if self.caption_job is not None:
+            self.caption_job.mark_failed(image_path)
+            self.caption_failures[image_path] = message
+
+    def caption_kept(self, image_path):
+        # Already captioned and kept: done as far as the job (and a resume) is concerned.
+        if self.caption_job is not None:
+            self.caption_job.mark_done(image_path)
+
+    def caption_job_failed(self, message):
+        # Keep the journal so the job can be resumed.
+        self.caption_job.close()
+        self.caption_job = None
+        trace_message = self.close_caption_trace()
+        self.status_label.hide()
+        QMessageBox.critical(self, "Error", f"Captioning stopped: {message}\n"
+                                            f"Use File > Resume Captioning Job to continue." + trace_message)
+
+    def changeEvent(self, event):
+        # Images edited in place by another program don't change their folder,
+        # so the watcher can't see them; when the user comes back, re-stat the
+        # ones on screen (the open image and the thumbnails in memory).
+        if (event.type() == QEvent.ActivationChange and self.isActiveWindow()
+                and self.directory_watcher.directory is not None):
+            shown = list(self.thumbnail_model.pixmaps)
+            if self.current_image is not None and self.current_image < len(self.images):
+                shown.append(self.images[self.current_image])
+            self.directory_watcher.rescan(images=shown)
+        super().changeEvent(event)
+
+    def closeEvent(self, event):
+        if self.caption_job is not None:
+            self.caption_job.close()
+        self.directory_watcher.stop()
+        if self.scan_worker is not None:
+            self.scan_worker.cancelled = True
+            self.scan_thread_pool.waitForDone()
+        elif self.scan_cache is not None:
+            self.scan_cache.save()
+        self.caption_index.save()
+        for caption_store in self.caption_stores.values():
+            caption_store.close()
+        self.caption_stores.clear()
+        super().closeEvent(event)
+
 
     def update_progress(self, progress):
-        print(f"Progress: {progress}/{len(self.images)}")
+        if self.caption_job is not None:
+            done = self.caption_job.completed_count() + self.caption_job.failed_count()
+            total = self.caption_job.total()
+        else:
+            done, total = progress, len(self.images)
+        message = f"Captioning: {done}/{total}"
+        stats = self.caption_pipeline.stats if self.caption_pipeline is not None else None
+        rate = stats.rate() if stats is not None else None
+        if rate:
+            message += f", {rate:.1f} images/s, {captioning.format_duration((total - done) / rate)} left"
+            busiest = stats.busiest()
+            if busiest:
+                message += f" (mostly {busiest})"
+        self.show_status_message(message, duration=None)
 
     def save_caption(self, image_path, caption):
-        txt_path = os.path.splitext(image_path)[0] + ".txt"
-        with open(txt_path, "w") as txt_file:
-            txt_file.write(caption)
+        start = time.perf_counter()
+        if self.caption_job is not None:
+            caption_store = self.caption_store_for(self.caption_job.directory)
+            self.directory_watcher.expect_writes(caption_store.directory if caption_store.kind == "sqlite"
+                                                 else os.path.dirname(image_path))
+            caption_store.save(image_path, caption)
+            if caption_store is self.caption_index.store:
+                self.caption_index.update(image_path, caption)
+            self.caption_job.mark_done(image_path)
+            self.caption_pipeline.stats.add("write", time.perf_counter() - start, 1, start)
 
     def generate_caption_for_current_image(self):
         if self.current_image is not None and self.current_image < len(self.images):
             image_path = self.images[self.current_image]
 
             
-            worker = SingleCaptionWorker(image_path, self.predict_step)
+            worker = SingleCaptionWorker(image_path, self.predict_step, self.caption_store)
+            worker.signals.caption_generated.connect(self.caption_index.update)
             worker.signals.done.connect(self.single_caption_generated)
 
             
-            self.thread_pool.start(worker)
+            selected_model = self.model_dropdown.currentText()
+            self.load_model_then(selected_model, lambda: self.thread_pool.start(worker))
         else:
             QMessageBox.critical(self, "Error", "No image currently loaded.")
 
     def captions_generated(self):
-        selected_model = self.model_dropdown.currentText()
-        QMessageBox.information(self, "Info", f"Captions generated and saved successfully.")
+        selected_model = self.caption_job.model_name
+        failed_images = self.caption_job.failed_images()
+        self.caption_job.finish()
+        self.caption_job = None
+        trace_message = self.close_caption_trace()
+        self.caption_index.save()
+        summary = self.caption_summary
+        self.status_label.hide()
+        if summary["computed"]:
+            self.last_caption_report = "\n".join(
+                [f"Batch size: {self.caption_pipeline.batch_size}"]
+                + [self.models.timing_report(model_name) for model_name in captioning.split_models(selected_model)
+                   if self.models.is_loaded(model_name)]
+                + [self.caption_pipeline.stats.report()])
+        message = (f"Captions generated and saved successfully.\n"
+                   f"{summary['computed']} computed, {summary['cached']} from cache, "
+                   f"{summary['kept']} existing captions kept.")
+        if failed_images:
+            # Includes images skipped before the job was interrupted and resumed.
+            lines = [f"{os.path.basename(image_path)}: {self.caption_failures.get(image_path, 'unreadable')}"
+                     for image_path in failed_images[:MAX_LISTED_FAILURES]]
+            if len(failed_images) > MAX_LISTED_FAILURES:
+                lines.append(f"... and {len(failed_images) - MAX_LISTED_FAILURES} more")
+            message += f"\n\n{len(failed_images)} images couldn't be read and were skipped:\n" + "\n".join(lines)
+        message += trace_message
+        if failed_images:
+            QMessageBox.warning(self, "Warning", message)
+        else:
+            QMessageBox.information(self, "Info", message)
+    def show_performance_statistics(self):
+        sections = [self.thumbnail_cache.stats_report(), self.preview_cache.stats_report()]
+        if self.feature_cache is not None:
+            sections.append(self.feature_cache.stats_report())
+        sections += [self.models.timing_report(model_name) for model_name in self.models.names()
+                     if self.models.is_loaded(model_name)]
+        if self.last_caption_report:
+            sections.append("Last caption run:\n" + self.last_caption_report)
+        QMessageBox.information(self, "Performance Statistics", "\n\n".join(sections))
+
     def single_caption_generated(self):
         QMessageBox.information(self, "Info", "Caption generated and saved for the current image.")
         self.load_text()
@@ -604,47 +1602,263 @@ class ImageBrowser(QMainWindow):
                 """)
 class WorkerSignals(QObject):
     progress = pyqtSignal(int)
+    status = pyqtSignal(str)
     caption_generated = pyqtSignal(str, str)
+    caption_failed = pyqtSignal(str, str)
+    caption_kept = pyqtSignal(str)
+    summary = pyqtSignal(dict)
+    error = pyqtSignal(str)
     done = pyqtSignal()
 
 
+class ModelLoadSignals(QObject):
+    progress = pyqtSignal(str)
+    loaded = pyqtSignal()
+    error = pyqtSignal(str)
+
+
+class ModelLoadWorker(QRunnable):
+    def __init__(self, models, model_name):
+        super(ModelLoadWorker, self).__init__()
+        self.models = models
+        self.model_name = model_name
+        self.signals = ModelLoadSignals()
+
+    def run(self):
+        try:
+            for model_name in captioning.split_models(self.model_name):
+                self.models.get(model_name, progress=self.signals.progress.emit)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+            return
+        self.signals.loaded.emit()
+
+
 class CaptionWorker(QRunnable):
-    def __init__(self, images, selected_model, predict_step):
+    def __init__(self, images, selected_model, pipeline, caption_cache=None, keep_existing=False,
+                 caption_store=None, merge="lines"):
         super(CaptionWorker, self).__init__()
         self.images = images
         self.selected_model = selected_model
-        self.predict_step = predict_step
+        self.pipeline = pipeline
+        self.caption_cache = caption_cache
+        self.keep_existing = keep_existing
+        self.caption_store = caption_store or TextFileStore()
+        self.merge = merge
         self.signals = WorkerSignals()
 
     def run(self):
-        for index, image_path in enumerate(self.images):
-            caption = self.predict_step([image_path])[0]
-            self.signals.caption_generated.emit(image_path, caption)
-            self.signals.progress.emit(index + 1)
+        try:
+            self.caption_images()
+        except Exception as e:
+            self.signals.error.emit(str(e))
+
+    def caption_images(self):
+        summary = {"computed": 0, "cached": 0, "kept": 0, "failed": 0}
+        # Captions are cached per model, so a multi-model run reuses (and fills) the single-model entries.
+        model_names = captioning.split_models(self.selected_model)
+        stats = self.pipeline.stats
+        completed = 0
+        to_compute = []
+        cache_keys = {}
+        for image_path in self.images:
+            if self.keep_existing and self.caption_store.has_caption(image_path):
+                summary["kept"] += 1
+                self.signals.caption_kept.emit(image_path)
+            else:
+                captions = {}
+                if self.caption_cache is not None:
+                    start = time.perf_counter()
+                    for model_name in model_names:
+                        key = self.caption_cache.key(image_path, model_name, self.pipeline.gen_kwargs,
+                                                     self.pipeline.models.precision[model_name],
+                                                     self.pipeline.models.effective_runtime(model_name))
+                        cache_keys[image_path, model_name] = key
+                        caption = self.caption_cache.get(key)
+                        if caption is not None:
+                            captions[model_name] = caption
+                    stats.add("cache lookup", time.perf_counter() - start, 1, start)
+                if len(captions) < len(model_names):
+                    to_compute.append(image_path)
+                    continue
+                summary["cached"] += 1
+                self.signals.caption_generated.emit(image_path, captioning.merge_captions(captions, self.merge))
+            completed += 1
+            self.signals.progress.emit(completed)
+
+        if to_compute:
+            for batch, captions in self.pipeline.run(to_compute, progress=self.signals.status.emit):
+                if len(model_names) == 1:
+                    captions = {model_names[0]: captions}
+                for index, image_path in enumerate(batch):
+                    image_captions = {model_name: captions[model_name][index] for model_name in model_names}
+                    completed += 1
+                    if None in image_captions.values():
+                        summary["failed"] += 1
+                        self.signals.caption_failed.emit(image_path, self.pipeline.errors.get(image_path, ""))
+                        self.signals.progress.emit(completed)
+                        continue
+                    summary["computed"] += 1
+                    if self.caption_cache is not None:
+                        for model_name, caption in image_captions.items():
+                            self.caption_cache.put(cache_keys[image_path, model_name], caption)
+                    self.signals.caption_generated.emit(image_path,
+                                                        captioning.merge_captions(image_captions, self.merge))
+                    self.signals.progress.emit(completed)
+                if self.caption_cache is not None:
+                    self.caption_cache.flush()
+        if self.caption_cache is not None:
+            self.caption_cache.flush()
+        self.signals.summary.emit(summary)
         self.signals.done.emit()
 
 class SingleCaptionWorker(QRunnable):
-    def __init__(self, image_path, predict_step):
+    def __init__(self, image_path, predict_step, caption_store=None):
         super(SingleCaptionWorker, self).__init__()
         self.image_path = image_path
         self.predict_step = predict_step
+        self.caption_store = caption_store or TextFileStore()
         self.signals = WorkerSignals()
 
     def run(self):
         caption = self.predict_step([self.image_path])[0]
-        txt_path = os.path.splitext(self.image_path)[0] + ".txt"
-        with open(txt_path, "w") as txt_file:
-            txt_file.write(caption)
+        self.caption_store.save(self.image_path, caption)
+        self.signals.caption_generated.emit(self.image_path, caption)
         self.signals.done.emit()
 
 
+class BulkEditDialog(QDialog):
+    """Build a chain of caption transforms; the browser previews and applies it."""
+
+    def __init__(self, filtered=False, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Bulk Edit Captions")
+        self.transforms = []
+        self.only_shown = False
+
+        self.operation_dropdown = QComboBox()
+        self.operation_dropdown.addItems(caption_transforms.TRANSFORMS)
+        self.operation_dropdown.currentTextChanged.connect(self.operation_changed)
+        self.text_input = QLineEdit()
+        self.text_input.setPlaceholderText("Text")
+        self.replacement_input = QLineEdit()
+        self.replacement_input.setPlaceholderText("Replace with")
+        add_button = QPushButton("Add Step")
+        add_button.clicked.connect(self.add_step)
+        remove_button = QPushButton("Remove Last Step")
+        remove_button.clicked.connect(self.remove_step)
+        self.steps_view = QTextEdit()
+        self.steps_view.setReadOnly(True)
+        self.only_shown_checkbox = QCheckBox("Only the images shown in the grid (current search)")
+        self.only_shown_checkbox.setChecked(filtered)
+        self.only_shown_checkbox.setEnabled(filtered)
+
+        preview_button = QPushButton("Preview && Apply...")
+        preview_button.setObjectName("saveButton")
+        preview_button.clicked.connect(self.finish)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+
+        step_layout = QHBoxLayout()
+        step_layout.addWidget(self.operation_dropdown)
+        step_layout.addWidget(self.text_input)
+        step_layout.addWidget(self.replacement_input)
+        step_layout.addWidget(add_button)
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(preview_button)
+        button_layout.addWidget(cancel_button)
+
+        layout = QVBoxLayout(self)
+        layout.addLayout(step_layout)
+        layout.addWidget(self.steps_view)
+        layout.addWidget(remove_button)
+        layout.addWidget(self.only_shown_checkbox)
+        layout.addLayout(button_layout)
+        self.operation_changed(self.operation_dropdown.currentText())
+
+    def operation_changed(self, operation):
+        self.replacement_input.setVisible(operation in ("Replace", "Regex Replace"))
+
+    def add_step(self):
+        text = self.text_input.text()
+        if not text:
+            return False
+        try:
+            transform = caption_transforms.make_transform(self.operation_dropdown.currentText(), text,
+                                                          self.replacement_input.text())
+        except re.error as e:
+            QMessageBox.critical(self, "Error", f"Invalid regular expression: {e}")
+            return False
+        self.transforms.append(transform)
+        self.text_input.clear()
+        self.replacement_input.clear()
+        self.show_steps()
+        return True
+
+    def remove_step(self):
+        if self.transforms:
+            self.transforms.pop()
+            self.show_steps()
+
+    def show_steps(self):
+        self.steps_view.setPlainText("\n".join(f"{number}. {transform}"
+                                              for number, transform in enumerate(self.transforms, 1)))
+
+    def finish(self):
+        # A step typed but not added yet is what the user means to run.
+        if self.text_input.text() and not self.add_step():
+            return
+        self.only_shown = self.only_shown_checkbox.isChecked()
+        self.accept()
+
+
+class CropSignals(QObject):
+    cropped = pyqtSignal(int, int)
+    finished = pyqtSignal()
+    error = pyqtSignal(str)
+
+
+class CropWorker(QRunnable):
+    """Runs image_crops.crop_images() off the GUI thread; `results` holds a CropResult per image done."""
+
+    def __init__(self, jobs, size, output_format, quality):
+        super(CropWorker, self).__init__()
+        self.jobs = jobs
+        self.size = size
+        self.output_format = output_format
+        self.quality = quality
+        self.cancelled = False
+        self.results = []
+        self.signals = CropSignals()
+
+    def run(self):
+        try:
+            for result in image_crops.crop_images(self.jobs, self.size, self.output_format, self.quality,
+                                                  cancelled=lambda: self.cancelled):
+                self.results.append(result)
+                self.signals.cropped.emit(len(self.results), len(self.jobs))
+        except Exception as e:
+            self.signals.error.emit(str(e))
+            return
+        self.signals.finished.emit()
+
+
 class CropResizeDialog(QDialog):
-    def __init__(self, images, preselected_width=100, preselected_height=100, parent=None):
+    CELL_SIZE = 200
+    CELL_SPACING = 10
+    COLUMNS = 4
+
+    def __init__(self, images, preselected_width=100, preselected_height=100, parent=None,
+                 output_format="Keep", quality=image_crops.DEFAULT_QUALITY):
         super().__init__(parent)
         self.setWindowTitle("Crop & Resize Images")
         self.images = images
         self.preselected_width = preselected_width
         self.preselected_height = preselected_height
+        self.output_format = output_format
+        self.quality = quality
+        self.crop_worker = None
+        self.crop_results = []
         self.layout = QVBoxLayout(self)
         self.init_ui()
 
@@ -663,22 +1877,31 @@ class CropResizeDialog(QDialog):
         self.width_input.valueChanged.connect(self._updateAspectRatio)
         self.height_input.valueChanged.connect(self._updateAspectRatio)
 
+        self.output_format_dropdown = QComboBox()
+        self.output_format_dropdown.addItems(image_crops.OUTPUT_FORMATS)
+        self.output_format_dropdown.setCurrentText(self.output_format)
+        self.quality_input = QSpinBox()
+        self.quality_input.setRange(1, 100)
+        self.quality_input.setValue(self.quality)
+        self.quality_input.setToolTip("JPEG quality")
+
         input_layout = QHBoxLayout()
         input_layout.addWidget(self.width_label)
         input_layout.addWidget(self.width_input)
         input_layout.addWidget(self.height_label)
         input_layout.addWidget(self.height_input)
-
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-
-        self.preview_container = QWidget()
-        self.preview_layout = QGridLayout(self.preview_container)
-        self.preview_container.setLayout(self.preview_layout)  # Set the layout for the preview_container widget
-        self.preview_layout.setHorizontalSpacing(10)
-        self.preview_layout.setVerticalSpacing(10)
-
-        self.scroll_area.setWidget(self.preview_container)
+        input_layout.addWidget(QLabel("Format:"))
+        input_layout.addWidget(self.output_format_dropdown)
+        input_layout.addWidget(QLabel("Quality:"))
+        input_layout.addWidget(self.quality_input)
+
+        self.preview_view = QGraphicsView()
+        self.preview_view.setRenderHint(QPainter.Antialiasing)
+        self.preview_view.setRenderHint(QPainter.SmoothPixmapTransform)
+        self.preview_view.setRenderHint(QPainter.TextAntialiasing)
+        self.preview_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.preview_view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        self.preview_view.setAlignment(Qt.AlignLeft | Qt.AlignTop)
 
         self.save_button = QPushButton("Save")
         self.save_button.setObjectName("saveButton")
@@ -686,12 +1909,16 @@ class CropResizeDialog(QDialog):
         self.save_button.clicked.connect(self.crop_and_resize_and_close)
         self.cancel_button.clicked.connect(self.reject)
 
+        self.progress_bar = QProgressBar()
+        self.progress_bar.hide()
+
         button_layout = QHBoxLayout()
         button_layout.addWidget(self.save_button)
         button_layout.addWidget(self.cancel_button)
 
         self.layout.addLayout(input_layout)
-        self.layout.addWidget(self.scroll_area)
+        self.layout.addWidget(self.preview_view)
+        self.layout.addWidget(self.progress_bar)
         self.layout.addLayout(button_layout)
 
         self.load_images()
@@ -699,104 +1926,184 @@ class CropResizeDialog(QDialog):
         self.adjustSize()
 
     def load_images(self):
-        self.scenes = []
-        self.selection_boxes = []
-        row, col = 0, 0
-
-        max_width, max_height = 200, 200
-
-        for image_path in self.images:
-            
-            scene = QGraphicsScene()
-            self.scenes.append(scene)
-
-            pixmap = QPixmap(image_path)
-            pixmap_item = QGraphicsPixmapItem(pixmap)
-            scene.addItem(pixmap_item)
-
-            
-            scene.setSceneRect(pixmap_item.boundingRect())
-
-            
-            selection_box = DraggableRectItem(0, 0,
-                                              pixmap.size().width(),
-                                              pixmap.size().height())
-            selection_box.setFlag(QGraphicsItem.ItemIsSelectable, True)
-            selection_box.setFlag(QGraphicsItem.ItemIsMovable, True)
-            self.selection_boxes.append(selection_box)
-
-            scene.addItem(selection_box)
-
-            
-            selection_box.set_aspect_ratio(
-                    self.preselected_width / float(self.preselected_height))
-
-            
-            graphics_view = QGraphicsView()
-            graphics_view.setRenderHint(QPainter.Antialiasing)
-            graphics_view.setRenderHint(QPainter.SmoothPixmapTransform)
-            graphics_view.setRenderHint(QPainter.TextAntialiasing)
-            graphics_view.setViewportUpdateMode(QGraphicsView.FullViewportUpdate)
-            graphics_view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-            graphics_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-            graphics_view.setScene(scene)
-
-            
-            original_size = pixmap.size()
-            scaled_size = original_size.scaled(max_width, max_height, Qt.KeepAspectRatio)
-            scale_factor = scaled_size.width() / original_size.width()
-            graphics_view.setFixedSize(scaled_size)
+        """
+        Lay out the previews in a grid on one scene, shown by one view.  A
+        preview is only built once it first scrolls into view: its group is
+        in the image's full resolution coordinates (read from the file
+        header) and scaled down to its cell, so the selection box is in
+        image pixels too; the picture behind it is a downscaled proxy,
+        scaled up to cover the image.  Proxies are only decoded for the
+        previews on screen, kept in memory only (cropping rewrites the
+        images anyway), and only the most recently shown are kept.
+        """
+        self.scene = QGraphicsScene(self)
+        self.selection_boxes = {}
+        self.pixmap_items = {}
+        self.proxies = OrderedDict()
+        pitch = self.CELL_SIZE + self.CELL_SPACING
+        rows = (len(self.images) + self.COLUMNS - 1) // self.COLUMNS
+        self.scene.setSceneRect(QRectF(0, 0, self.COLUMNS * pitch - self.CELL_SPACING,
+                                       max(1, rows * pitch - self.CELL_SPACING)))
+        self.preview_view.setScene(self.scene)
+        frame = 2 * self.preview_view.frameWidth()
+        self.preview_view.setMinimumWidth(int(self.scene.width()) + frame
+                                          + self.preview_view.verticalScrollBar().sizeHint().width())
+        self.preview_view.setMinimumHeight(min(rows, 2) * pitch + frame)
+
+        self.proxy_loader = ThumbnailLoader(None, self, CROP_PROXY_SIZE)
+        self.proxy_loader.loaded.connect(self.proxy_loaded)
+        self.preview_view.verticalScrollBar().valueChanged.connect(self.request_visible_proxies)
+
+    def create_preview(self, index):
+        image_path = self.images[index]
+        original_size = QImageReader(image_path).size()
+        if not original_size.isValid():
+            original_size = QSize(self.CELL_SIZE, self.CELL_SIZE)
+        width, height = original_size.width(), original_size.height()
+
+        # The group's rect is the image; it clips the selection box's outline to it.
+        group = QGraphicsRectItem(0, 0, width, height)
+        group.setPen(QPen(Qt.NoPen))
+        group.setFlag(QGraphicsItem.ItemClipsChildrenToShape, True)
+        scaled_size = original_size.scaled(self.CELL_SIZE, self.CELL_SIZE, Qt.KeepAspectRatio)
+        group.setScale(scaled_size.width() / width)
+        pitch = self.CELL_SIZE + self.CELL_SPACING
+        group.setPos((index % self.COLUMNS) * pitch + (self.CELL_SIZE - scaled_size.width()) / 2,
+                     (index // self.COLUMNS) * pitch + (self.CELL_SIZE - scaled_size.height()) / 2)
+        self.scene.addItem(group)
+
+        pixmap_item = QGraphicsPixmapItem(group)
+        pixmap_item.setTransformationMode(Qt.SmoothTransformation)
+        self.pixmap_items[image_path] = pixmap_item
+
+        selection_box = DraggableRectItem(0, 0, width, height)
+        selection_box.setParentItem(group)
+        selection_box.set_aspect_ratio(self.width_input.value() / float(self.height_input.value()))
+        self.selection_boxes[image_path] = selection_box
 
-            
-            graphics_view.scale(scale_factor, scale_factor)
+    def showEvent(self, event):
+        super().showEvent(event)
+        QTimer.singleShot(0, self.request_visible_proxies)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.request_visible_proxies()
+
+    def visible_images(self):
+        """Indexes of the images whose cells are at least partly in view."""
+        visible = self.preview_view.mapToScene(self.preview_view.viewport().rect()).boundingRect()
+        pitch = self.CELL_SIZE + self.CELL_SPACING
+        first = max(0, int(visible.top() // pitch) * self.COLUMNS)
+        last = min(len(self.images), (int(visible.bottom() // pitch) + 1) * self.COLUMNS)
+        return range(first, last)
+
+    def request_visible_proxies(self):
+        self.proxy_loader.clear_pending()
+        for index in self.visible_images():
+            image_path = self.images[index]
+            if image_path not in self.selection_boxes:
+                self.create_preview(index)
+            if image_path in self.proxies:
+                self.proxies.move_to_end(image_path)
+            else:
+                self.proxy_loader.request(image_path)
 
-            
-            self.preview_layout.addWidget(graphics_view, row, col)
-            col += 1
-            if col % 4 == 0:
-                row += 1
-                col = 0
+    def proxy_loaded(self, image_path, image):
+        pixmap_item = self.pixmap_items.get(image_path)
+        if pixmap_item is None or image.isNull():
+            return
+        pixmap_item.setPixmap(QPixmap.fromImage(image))
+        pixmap_item.setScale(pixmap_item.parentItem().rect().width() / image.width())
+        self.proxies[image_path] = True
+        self.proxies.move_to_end(image_path)
+        while len(self.proxies) > CROP_PROXIES_IN_MEMORY:
+            evicted, _ = self.proxies.popitem(last=False)
+            self.pixmap_items[evicted].setPixmap(QPixmap())
 
     def _updateAspectRatio(self, value):
         """
         Loop over the selection boxes and update their aspect ratios.
         """
         aspect_ratio = self.width_input.value() / float(self.height_input.value())
-        for selection_box in self.selection_boxes:
+        for selection_box in self.selection_boxes.values():
             selection_box.set_aspect_ratio(aspect_ratio)
 
+    def crop_jobs(self):
+        """
+        (image_path, (x, y, width, height)) of every selection box; None for
+        images never scrolled into view, which get the default box.
+        """
+        jobs = []
+        for image_path in self.images:
+            selection_box = self.selection_boxes.get(image_path)
+            if selection_box is None:
+                jobs.append((image_path, None))
+                continue
+            position = selection_box.pos()
+            rect = selection_box.rect()
+            jobs.append((image_path, (position.x(), position.y(), rect.width(), rect.height())))
+        return jobs
+
+    def create_crop_worker(self):
+        return CropWorker(self.crop_jobs(), (self.width_input.value(), self.height_input.value()),
+                          self.output_format_dropdown.currentText(), self.quality_input.value())
+
     def crop_and_resize_and_close(self):
-        self.crop_and_resize_images()
-        self.accept()
+        """Crop on a worker thread with a progress bar; Cancel stops after the images already started."""
+        self.crop_worker = self.create_crop_worker()
+        self.crop_worker.signals.cropped.connect(self.image_cropped)
+        self.crop_worker.signals.finished.connect(self.cropping_finished)
+        self.crop_worker.signals.error.connect(self.cropping_failed)
+        for widget in (self.save_button, self.width_input, self.height_input,
+                       self.output_format_dropdown, self.quality_input, self.preview_view):
+            widget.setEnabled(False)
+        self.progress_bar.setRange(0, len(self.images))
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        QThreadPool.globalInstance().start(self.crop_worker)
 
     def crop_and_resize_images(self):
-        try:
-            self.cropped_images = [self._process_image(image_path,
-                                                       self.selection_boxes[i],
-                                                       self.width_input.value(),
-                                                       self.height_input.value())
-                                    for i, image_path in enumerate(self.images)]
-        except Exception as e:
-            print(f"Error processing images: {e}")
-
-    def _process_image(self, image_path, selection_box, output_width, output_height):
-        with Image.open(image_path) as image:
-            
-            crop_x = selection_box.pos().x()
-            crop_y = selection_box.pos().y()
-            crop_width = selection_box.rect().width()
-            crop_height = selection_box.rect().height()
-
-            
-            crop_box = (crop_x, crop_y, crop_x + crop_width, crop_y + crop_height)
-            cropped_image = image.crop(crop_box)
-
-            
-            resized_image = cropped_image.resize((output_width, output_height),
-                                                 Image.ANTIALIAS)
+        """Crop and resize every image in this thread and return the CropResults."""
+        worker = self.create_crop_worker()
+        worker.run()
+        self.crop_results = worker.results
+        return self.crop_results
+
+    def image_cropped(self, done, total):
+        self.progress_bar.setValue(done)
+        self.progress_bar.setFormat(f"Cropping: {done}/{total}")
+
+    def reject(self):
+        if self.crop_worker is None:
+            super().reject()
+            return
+        self.crop_worker.cancelled = True
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.setText("Cancelling...")
+
+    def cropping_finished(self):
+        self.crop_results = self.crop_worker.results
+        failed = [result for result in self.crop_results if result.error is not None]
+        if failed:
+            details = "\n".join(f"{os.path.basename(result.image_path)}: {result.error}" for result in failed[:20])
+            if len(failed) > 20:
+                details += f"\n... and {len(failed) - 20} more"
+            QMessageBox.warning(self, "Warning", f"{len(failed)} of {len(self.crop_results)} images "
+                                                 f"could not be cropped:\n{details}")
+        if self.crop_worker.cancelled:
+            QMessageBox.information(self, "Info", f"Stopped after {len(self.crop_results)} of "
+                                                  f"{len(self.images)} images.")
+        self.crop_worker = None
+        if len(failed) < len(self.crop_results):
+            self.accept()
+        else:
+            self.reject()
 
-            
-            resized_image.save(image_path, image.format)
+    def cropping_failed(self, message):
+        self.crop_results = self.crop_worker.results
+        self.crop_worker = None
+        QMessageBox.critical(self, "Error", f"Cropping stopped: {message}")
+        self.accept()
 
 
 class DraggableRectItem(QGraphicsRectItem):
@@ -867,11 +2174,16 @@ class DraggableRectItem(QGraphicsRectItem):
     def _getSafePosition(self, position):
         """
         Given a position for the draggable rectangle, return a position that
-        is within the bounds of the scene the rectangle exists within.
+        is within the bounds of its parent item (or its scene if it has none).
         """
         new_position = position
         box_rect = self.rect()
-        scene_rect = self.scene().sceneRect()
+        if self.parentItem() is not None:
+            scene_rect = self.parentItem().boundingRect()
+        elif self.scene() is not None:
+            scene_rect = self.scene().sceneRect()
+        else:
+            return new_position
 
         
         if position.x() < 0:
@@ -900,6 +2212,7 @@ class SettingsDialog(QDialog):
 
 
         self.tab_widget.addTab(self.create_general_settings_tab(), "General")
+        self.tab_widget.addTab(self.create_captioning_settings_tab(), "Captioning")
 
 
         save_button = QPushButton("Save")
@@ -926,22 +2239,82 @@ class SettingsDialog(QDialog):
             self.dark_mode_on_launch = settings.get("dark_mode_on_launch", False)
             self.default_directory = settings.get("default_directory", "")
             self.remember_last_directory = settings.get("remember_last_directory", False)
+            self.batch_size = settings.get("batch_size", 0)
+            self.keep_existing_captions = settings.get("keep_existing_captions", False)
+            self.worker_processes = settings.get("worker_processes", 0)
+            self.write_timing_trace = settings.get("write_timing_trace", False)
+            self.include_subfolders = settings.get("include_subfolders", False)
+            self.use_caption_server = settings.get("use_caption_server", False)
+            self.max_length = settings.get("max_length", 16)
+            self.num_beams = settings.get("num_beams", 4)
+            self.cache_encoder_features = settings.get("cache_encoder_features", False)
+            self.merge_captions = settings.get("merge_captions", "lines")
+            self.crop_output_format = settings.get("crop_output_format", "Keep")
+            self.crop_quality = settings.get("crop_quality", image_crops.DEFAULT_QUALITY)
+            self.caption_store = settings.get("caption_store", "txt")
+            self.precision = settings.get("precision", {})
+            self.runtime = settings.get("runtime", {})
         except FileNotFoundError:
 
             self.dark_mode_on_launch = False
             self.default_directory = ""
             self.remember_last_directory = False
+            self.batch_size = 0
+            self.keep_existing_captions = False
+            self.worker_processes = 0
+            self.write_timing_trace = False
+            self.include_subfolders = False
+            self.use_caption_server = False
+            self.max_length = 16
+            self.num_beams = 4
+            self.cache_encoder_features = False
+            self.merge_captions = "lines"
+            self.crop_output_format = "Keep"
+            self.crop_quality = image_crops.DEFAULT_QUALITY
+            self.caption_store = "txt"
+            self.precision = {}
+            self.runtime = {}
     def save_to_json(self, filename):
         settings = {
             "dark_mode_on_launch": self.dark_mode_on_launch,
             "default_directory": self.default_directory,
-            "remember_last_directory": self.remember_last_directory
+            "remember_last_directory": self.remember_last_directory,
+            "batch_size": self.batch_size,
+            "keep_existing_captions": self.keep_existing_captions,
+            "worker_processes": self.worker_processes,
+            "write_timing_trace": self.write_timing_trace,
+            "include_subfolders": self.include_subfolders,
+            "use_caption_server": self.use_caption_server,
+            "max_length": self.max_length,
+            "num_beams": self.num_beams,
+            "cache_encoder_features": self.cache_encoder_features,
+            "merge_captions": self.merge_captions,
+            "crop_output_format": self.crop_output_format,
+            "crop_quality": self.crop_quality,
+            "caption_store": self.caption_store,
+            "precision": self.precision,
+            "runtime": self.runtime
         }
-        with open(filename, "r", encoding="utf-8") as file:
+        with open(filename, "w", encoding="utf-8") as file:
             json.dump(settings, file, indent=2)
     def save_settings(self):
         self.dark_mode_on_launch = self.dark_mode_checkbox.isChecked()
         self.remember_last_directory = self.remember_last_directory_checkbox.isChecked()
+        self.include_subfolders = self.include_subfolders_checkbox.isChecked()
+        self.batch_size = self.batch_size_input.value()
+        self.keep_existing_captions = self.keep_existing_checkbox.isChecked()
+        self.worker_processes = self.worker_processes_input.value()
+        self.write_timing_trace = self.write_timing_trace_checkbox.isChecked()
+        self.use_caption_server = self.use_caption_server_checkbox.isChecked()
+        self.max_length = self.max_length_input.value()
+        self.num_beams = self.num_beams_input.value()
+        self.cache_encoder_features = self.cache_encoder_features_checkbox.isChecked()
+        self.merge_captions = self.merge_captions_dropdown.currentText()
+        self.caption_store = self.caption_store_dropdown.currentText()
+        self.precision = {model_name: dropdown.currentText()
+                          for model_name, dropdown in self.precision_dropdowns.items()}
+        self.runtime = {model_name: dropdown.currentText()
+                        for model_name, dropdown in self.runtime_dropdowns.items()}
 
 
         self.save_to_json("settings.json")
@@ -966,14 +2339,130 @@ class SettingsDialog(QDialog):
         self.remember_last_directory_checkbox.setChecked(self.remember_last_directory)
         self.remember_last_directory_checkbox.toggled.connect(self.default_directory_button.setDisabled)
 
+        self.include_subfolders_checkbox = QCheckBox("Include Images In Subfolders")
+        self.include_subfolders_checkbox.setChecked(self.include_subfolders)
+
         layout = QVBoxLayout()
         layout.addWidget(self.dark_mode_checkbox)
         layout.addWidget(self.default_directory_button)
         layout.addWidget(self.remember_last_directory_checkbox)
+        layout.addWidget(self.include_subfolders_checkbox)
         general_settings_tab.setLayout(layout)
 
         return general_settings_tab
 
+    def create_captioning_settings_tab(self):
+        captioning_settings_tab = QWidget()
+
+        batch_size_label = QLabel("Batch Size (0 = auto):")
+        self.batch_size_input = QSpinBox()
+        self.batch_size_input.setRange(0, 256)
+        self.batch_size_input.setValue(self.batch_size)
+
+        worker_processes_label = QLabel("CPU Worker Processes (0 = in-process):")
+        self.worker_processes_input = QSpinBox()
+        self.worker_processes_input.setRange(0, os.cpu_count() or 1)
+        self.worker_processes_input.setValue(self.worker_processes)
+
+        self.keep_existing_checkbox = QCheckBox("Keep Existing Captions When Generating For All")
+        self.keep_existing_checkbox.setChecked(self.keep_existing_captions)
+
+        self.write_timing_trace_checkbox = QCheckBox(
+            f"Write Timing Trace ({captioning.CAPTION_TRACE_FILE}, {captioning.CAPTION_TIMELINE_FILE})")
+        self.write_timing_trace_checkbox.setChecked(self.write_timing_trace)
+
+        self.use_caption_server_checkbox = QCheckBox("Use Caption Server If Running (caption_server.py)")
+        self.use_caption_server_checkbox.setChecked(self.use_caption_server)
+        self.use_caption_server_checkbox.setToolTip(f"Caption with the models kept loaded by caption_server.py at "
+                                                    f"{captioning.server_address()}, instead of loading them here.")
+
+        self.max_length_input = QSpinBox()
+        self.max_length_input.setRange(2, 128)
+        self.max_length_input.setValue(self.max_length)
+        self.num_beams_input = QSpinBox()
+        self.num_beams_input.setRange(1, 16)
+        self.num_beams_input.setValue(self.num_beams)
+
+        generation_layout = QHBoxLayout()
+        generation_layout.addWidget(QLabel("VIT-GPT2 Max Caption Length (tokens):"))
+        generation_layout.addWidget(self.max_length_input)
+        generation_layout.addWidget(QLabel("Beams:"))
+        generation_layout.addWidget(self.num_beams_input)
+
+        self.cache_encoder_features_checkbox = QCheckBox(f"Cache Encoder Features ({FEATURE_CACHE_DIR})")
+        self.cache_encoder_features_checkbox.setChecked(self.cache_encoder_features)
+        self.cache_encoder_features_checkbox.setToolTip(
+            "Keep each image's encoder output on disk, so captioning the same images again with other\n"
+            "generation settings only runs the text decoder.  Takes about 0.6 MB per image for VIT-GPT2\n"
+            "and 2.4 MB for BLIP.  Not used with worker processes or the caption server.")
+
+        batch_size_layout = QHBoxLayout()
+        batch_size_layout.addWidget(batch_size_label)
+        batch_size_layout.addWidget(self.batch_size_input)
+
+        worker_processes_layout = QHBoxLayout()
+        worker_processes_layout.addWidget(worker_processes_label)
+        worker_processes_layout.addWidget(self.worker_processes_input)
+
+        self.caption_store_dropdown = QComboBox()
+        self.caption_store_dropdown.addItems(CAPTION_STORES)
+        self.caption_store_dropdown.setCurrentText(self.caption_store)
+        self.caption_store_dropdown.setToolTip("txt: one .txt file next to each image.\n"
+                                               "sqlite: one indexed database file per directory; "
+                                               "use File > Export Captions for training tools.")
+
+        caption_store_layout = QHBoxLayout()
+        caption_store_layout.addWidget(QLabel("Caption Storage:"))
+        caption_store_layout.addWidget(self.caption_store_dropdown)
+
+        self.merge_captions_dropdown = QComboBox()
+        self.merge_captions_dropdown.addItems(captioning.MERGE_STRATEGIES)
+        self.merge_captions_dropdown.setCurrentText(self.merge_captions)
+        self.merge_captions_dropdown.setToolTip("How the captions of every model are combined when captioning "
+                                                "with several models in one pass:\n"
+                                                "lines: one caption per line, in model order.\n"
+                                                "labelled: the same, each line starting with the model's name.\n"
+                                                "comma: joined with commas.\n"
+                                                "longest: only the longest caption.")
+
+        merge_captions_layout = QHBoxLayout()
+        merge_captions_layout.addWidget(QLabel("Combine Captions Of Several Models:"))
+        merge_captions_layout.addWidget(self.merge_captions_dropdown)
+
+        layout = QVBoxLayout()
+        layout.addLayout(batch_size_layout)
+        layout.addLayout(worker_processes_layout)
+        layout.addLayout(caption_store_layout)
+        layout.addLayout(generation_layout)
+        layout.addLayout(merge_captions_layout)
+
+        self.precision_dropdowns = {}
+        self.runtime_dropdowns = {}
+        for model_name in ("VIT-GPT2", "BLIP"):
+            precision_dropdown = QComboBox()
+            precision_dropdown.addItems(captioning.PRECISIONS)
+            precision_dropdown.setCurrentText(self.precision.get(model_name, "fp32"))
+            self.precision_dropdowns[model_name] = precision_dropdown
+
+            runtime_dropdown = QComboBox()
+            runtime_dropdown.addItems(captioning.RUNTIMES)
+            runtime_dropdown.setCurrentText(self.runtime.get(model_name, "eager"))
+            self.runtime_dropdowns[model_name] = runtime_dropdown
+
+            precision_layout = QHBoxLayout()
+            precision_layout.addWidget(QLabel(f"{model_name} Precision:"))
+            precision_layout.addWidget(precision_dropdown)
+            precision_layout.addWidget(QLabel("Runtime:"))
+            precision_layout.addWidget(runtime_dropdown)
+            layout.addLayout(precision_layout)
+        layout.addWidget(self.keep_existing_checkbox)
+        layout.addWidget(self.write_timing_trace_checkbox)
+        layout.addWidget(self.use_caption_server_checkbox)
+        layout.addWidget(self.cache_encoder_features_checkbox)
+        captioning_settings_tab.setLayout(layout)
+
+        return captioning_settings_tab
+
     def show_settings_dialog(self):
         settings_dialog_instance = SettingsDialog(self)
         settings_dialog_instance.exec_()
@@ -984,6 +2473,7 @@ class SettingsDialog(QDialog):
             self.default_directory = default_directory
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     image_browser = ImageBrowser()
     image_browser.setGeometry(100, 100, 800, 600)
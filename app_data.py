@@ -0,0 +1,29 @@
+"""Where J_Captioneer keeps its caches and working files.
+
+The caches and other files the app and its tools write for their own use
+live in one directory per user instead of the current directory:
+$J_CAPTIONEER_DATA if set, else %LOCALAPPDATA%\\J_Captioneer on Windows,
+~/Library/Application Support/J_Captioneer on macOS, and
+$XDG_DATA_HOME/j_captioneer (~/.local/share/j_captioneer) elsewhere.
+Settings stay next to the app.  Keep this module free of any PyQt5 imports.
+"""
+import os
+import sys
+
+APP_DATA_ENV = "J_CAPTIONEER_DATA"
+
+
+def app_data_dir():
+    directory = os.environ.get(APP_DATA_ENV)
+    if directory:
+        return directory
+    if sys.platform == "win32":
+        return os.path.join(os.environ.get("LOCALAPPDATA") or os.path.expanduser("~"), "J_Captioneer")
+    if sys.platform == "darwin":
+        return os.path.expanduser("~/Library/Application Support/J_Captioneer")
+    return os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "j_captioneer")
+
+
+def data_path(name):
+    """`name` in app_data_dir().  Whoever writes there creates the directory."""
+    return os.path.join(app_data_dir(), name)
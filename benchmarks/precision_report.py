@@ -0,0 +1,150 @@
+"""Compare captioning precisions and runtimes on a sample of images.
+
+    python benchmarks/precision_report.py DIRECTORY --model BLIP --limit 32
+    python benchmarks/precision_report.py DIRECTORY --precisions fp32 --runtimes eager,torch.export
+
+Each precision/runtime pair runs in a fresh process so peak memory is
+measured on its own.  Latency is per image after a warm-up batch.
+Agreement is measured against the first precision on the first runtime
+(fp32, eager by default): the share of identical captions and the mean word
+overlap (Jaccard) between them.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import captioning  # noqa: E402
+from image_directory import IMAGE_EXTENSIONS  # noqa: E402
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure(loader, model_name, precision, runtime, image_paths, gen_kwargs, batch_size, quantized_dir, export_dir,
+            results):
+    import torch
+
+    try:
+        models = captioning.ModelRegistry(torch.device("cpu"), quantized_dir, export_dir)
+        models.register(model_name, loader, precision, runtime)
+        start = time.perf_counter()
+        models.get(model_name)
+        load_seconds = time.perf_counter() - start
+
+        warm_up = image_paths[:batch_size]
+        captioning.predict_step(models, model_name, warm_up, gen_kwargs, batch_size)
+        start = time.perf_counter()
+        captions = captioning.predict_step(models, model_name, image_paths, gen_kwargs, batch_size)
+        seconds = time.perf_counter() - start
+        results.put({
+            "precision": precision,
+            "runtime": models.loaded[model_name]["runtime"],
+            "load_seconds": load_seconds,
+            "seconds_per_image": seconds / len(image_paths),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "captions": captions,
+        })
+    except Exception as e:
+        results.put({"precision": precision, "runtime": runtime, "error": f"{type(e).__name__}: {e}"})
+
+
+def run_in_process(loader, model_name, precision, runtime, image_paths, gen_kwargs, batch_size, quantized_dir,
+                   export_dir):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=measure, args=(loader, model_name, precision, runtime, image_paths, gen_kwargs,
+                                                    batch_size, quantized_dir, export_dir, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def word_overlap(first, second):
+    first, second = set(first.split()), set(second.split())
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+def export(loader, model_name, runtime, quantized_dir, export_dir):
+    """Export the graphs for `runtime` up front, so that isn't counted as loading or in peak memory."""
+    import torch
+
+    models = captioning.ModelRegistry(torch.device("cpu"), quantized_dir, export_dir)
+    models.register(model_name, loader, "fp32", runtime)
+    models.prepare(model_name)
+
+
+def compare(loader, model_name, image_paths, precisions, gen_kwargs, batch_size,
+            quantized_dir=captioning.QUANTIZED_MODEL_DIR, runtimes=("eager",), export_dir=captioning.EXPORT_DIR):
+    reports = []
+    for runtime in runtimes:
+        if runtime != "eager":
+            export(loader, model_name, runtime, quantized_dir, export_dir)
+        for precision in precisions:
+            reports.append(run_in_process(loader, model_name, precision, runtime, image_paths, gen_kwargs,
+                                          batch_size, quantized_dir, export_dir))
+    reference = reports[0] if "captions" in reports[0] else None
+    for report in reports:
+        if reference is None or "captions" not in report:
+            continue
+        pairs = list(zip(reference["captions"], report["captions"]))
+        report["exact_agreement"] = sum(first == second for first, second in pairs) / len(pairs)
+        report["word_overlap"] = sum(word_overlap(first, second) for first, second in pairs) / len(pairs)
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--model", default="VIT-GPT2", choices=["VIT-GPT2", "BLIP"])
+    parser.add_argument("--precisions", default="fp32,bf16,int8")
+    parser.add_argument("--runtimes", default="eager")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=32, help="number of sample images")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per run")
+    args = parser.parse_args(argv)
+
+    image_paths = sorted(os.path.join(args.directory, name) for name in os.listdir(args.directory)
+                         if name.lower().endswith(IMAGE_EXTENSIONS))[:args.limit]
+    loader = captioning.create_registry().loaders[args.model]
+    precisions = args.precisions.split(",")
+    runtimes = args.runtimes.split(",")
+    gen_kwargs = {"max_length": 16, "num_beams": 4}
+
+    for report in compare(loader, args.model, image_paths, precisions, gen_kwargs, args.batch_size,
+                          runtimes=runtimes):
+        name = f"{report['precision']:>5} {report['runtime']:<12}"
+        if args.json:
+            print(json.dumps({key: value for key, value in report.items() if key != "captions"}), flush=True)
+        elif "error" in report:
+            print(f"{name}: failed, {report['error']}")
+        else:
+            peak = report["peak_rss_bytes"]
+            peak = f"{peak / 2**20:7.0f} MB peak" if peak else "   ? MB peak"
+            agreement = ""
+            if "exact_agreement" in report:
+                agreement = (f", {report['exact_agreement']:.0%} identical to the first, "
+                             f"{report['word_overlap']:.0%} word overlap")
+            print(f"{name}: {report['seconds_per_image'] * 1000:7.1f} ms/image, {peak}, "
+                  f"loaded in {report['load_seconds']:.1f}s{agreement}")
+
+
+if __name__ == "__main__":
+    main()
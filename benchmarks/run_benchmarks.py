@@ -0,0 +1,327 @@
+"""Offline benchmark suite for J_Captioneer.
+
+    python benchmarks/run_benchmarks.py --images 64 --size 1920x1080 --output before.json
+    python benchmarks/run_benchmarks.py --images 64 --size 1920x1080 --compare before.json
+
+Generates a synthetic image directory and times the app's own code paths
+against it: predict_step with tiny random models (see synthetic.py),
+ImageBrowser.load_images, ImageBrowser.show_thumbnails in an offscreen Qt
+window (cold and warm thumbnail cache), opening CropResizeDialog and
+running crop_and_resize_images, and the bulk caption edits.  Nothing is
+downloaded and nothing outside a temporary directory is touched.
+
+Results are printed (or written to --output) as one JSON document, with
+the median of --repeat runs for each case.  --compare prints the change
+against an earlier results file to stderr.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from app_data import APP_DATA_ENV  # noqa: E402
+
+# The app's caches are located when its modules are imported, so point them
+# at the benchmark's temporary directory before anything else is imported.
+WORK_DIRECTORY = tempfile.mkdtemp(prefix="j_captioneer_benchmark_")
+os.environ[APP_DATA_ENV] = os.path.join(WORK_DIRECTORY, "app_data")
+
+import synthetic  # noqa: E402
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = ("predict_step", "load_images", "show_thumbnails", "crop_resize", "bulk_edits")
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPOSITORY,
+                                    capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    versions = {}
+    for module_name in ("torch", "transformers", "PIL", "PyQt5.QtCore"):
+        try:
+            module = __import__(module_name, fromlist=["_"])
+        except ImportError:
+            continue
+        versions[module_name] = getattr(module, "__version__", None) or getattr(module, "PYQT_VERSION_STR", None)
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+    }
+
+
+def run_case(name, function, repeats, items, setup=None, check=None, **params):
+    """
+    Time `function` `repeats` times (calling `setup` untimed before each run)
+    and describe the result.  `check`, if given, returns extra fields such as
+    how many outputs were correct.
+    """
+    result = {"name": name, "params": params, "items": items}
+    seconds = []
+    try:
+        for _ in range(repeats):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+            if check is not None:
+                result.update(check())
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = seconds
+    if seconds:
+        median = statistics.median(seconds)
+        result["median_seconds"] = median
+        result["items_per_second"] = items / median if median and items else None
+    print(f"{name}: " + (f"{result['median_seconds']:.4f}s" if seconds else "no timing")
+          + (f" ({result['error']})" if "error" in result else ""), file=sys.stderr, flush=True)
+    return result
+
+
+def bench_predict_step(image_paths, repeats, batch_size):
+    import torch
+    import captioning
+
+    results = []
+    models = synthetic.create_tiny_registry(torch.device("cpu"))
+    gen_kwargs = {"max_length": 16, "num_beams": 4}
+    for model_name in models.names():
+        start = time.perf_counter()
+        captioning.predict_step(models, model_name, image_paths[:batch_size], gen_kwargs, batch_size)
+        first_call = time.perf_counter() - start
+        result = run_case(f"predict_step[{model_name}]",
+                          lambda: captioning.predict_step(models, model_name, image_paths, gen_kwargs, batch_size),
+                          repeats, len(image_paths), batch_size=batch_size, **gen_kwargs)
+        result["first_call_seconds"] = first_call
+        results.append(result)
+    return results
+
+
+def wait_for_thumbnails(app, browser, timeout=300):
+    """Process events until every thumbnail the view asked for has been loaded and painted."""
+    loader = browser.thumbnail_loader
+    deadline = time.perf_counter() + timeout
+    idle_rounds = 0
+    while time.perf_counter() < deadline:
+        app.processEvents()
+        if loader.pending or loader.thread_pool.activeThreadCount():
+            idle_rounds = 0
+            time.sleep(0.001)
+            continue
+        idle_rounds += 1
+        if idle_rounds >= 3 and (browser.thumbnail_model.pixmaps or not browser.images):
+            return
+    raise TimeoutError("thumbnails didn't finish loading")
+
+
+def bench_gui(app, browser, directory, work_directory, repeats, width, height, cases):
+    import J_Captioneer_v2
+
+    results = []
+    browser.directory = directory
+
+    def load_images():
+        # Open the directory from scratch (the scan cache stays warm), not as a rescan.
+        browser.directory_watcher.stop()
+        browser.load_images()
+        browser.wait_for_scan()
+
+    if "load_images" in cases:
+        results.append(run_case("load_images", load_images, repeats, len(os.listdir(directory)) // 2))
+    else:
+        load_images()
+
+    def show_thumbnails():
+        browser.show_thumbnails()
+        wait_for_thumbnails(app, browser)
+
+    def forget_thumbnails():
+        browser.thumbnail_model.set_images([])
+
+    def forget_thumbnails_and_cache():
+        forget_thumbnails()
+        browser.thumbnail_cache.clear()
+
+    def shown_thumbnails():
+        return {"thumbnails_shown": len(browser.thumbnail_model.pixmaps)}
+
+    image_count = len(browser.images)
+    if "show_thumbnails" in cases:
+        results.append(run_case("show_thumbnails[cold]", show_thumbnails, repeats, image_count,
+                                setup=forget_thumbnails_and_cache, check=shown_thumbnails))
+        results.append(run_case("show_thumbnails[warm]", show_thumbnails, repeats, image_count,
+                                setup=forget_thumbnails, check=shown_thumbnails))
+
+    copy_directory = os.path.join(work_directory, "copy")
+
+    def copy_dataset():
+        shutil.rmtree(copy_directory, ignore_errors=True)
+        shutil.copytree(directory, copy_directory)
+        browser.directory = copy_directory
+        browser.load_images()
+        browser.wait_for_scan()
+
+    def copied_images():
+        return sorted(os.path.join(copy_directory, name) for name in os.listdir(copy_directory)
+                      if not name.endswith(".txt"))
+
+    dialogs = []
+    output_width, output_height = width // 2, height // 2
+
+    def open_crop_dialog():
+        dialogs[:] = [J_Captioneer_v2.CropResizeDialog(copied_images(), output_width, output_height)]
+
+    if "crop_resize" in cases:
+        results.append(run_case("crop_resize_dialog_open", open_crop_dialog, repeats, image_count,
+                                setup=copy_dataset))
+
+    def resized_images():
+        from PIL import Image
+
+        resized = 0
+        for image_path in copied_images():
+            with Image.open(image_path) as image:
+                resized += image.size == (output_width, output_height)
+        return {"resized": resized}
+
+    if "crop_resize" in cases:
+        results.append(run_case("crop_and_resize_images", lambda: dialogs[0].crop_and_resize_images(), repeats,
+                                image_count, setup=lambda: (copy_dataset(), open_crop_dialog()),
+                                check=resized_images, width=output_width, height=output_height))
+    if "bulk_edits" not in cases:
+        return results
+
+    answers = []
+    original_get_text = J_Captioneer_v2.QInputDialog.getText
+    J_Captioneer_v2.QInputDialog.getText = lambda *args, **kwargs: (answers.pop(0), True)
+    browser.confirm_bulk_edit = lambda *args: True
+
+    def edited_captions(expected):
+        def check():
+            edited = 0
+            for image_path in copied_images():
+                with open(os.path.splitext(image_path)[0] + ".txt", "r", encoding="utf-8") as file:
+                    edited += expected(file.read())
+            return {"edited": edited}
+        return check
+
+    try:
+        results.append(run_case("add_prefix_suffix", browser.add_prefix_suffix, repeats, image_count,
+                                setup=lambda: (copy_dataset(), answers.__setitem__(slice(None), ["pre, ", ", post"])),
+                                check=edited_captions(lambda text: text.startswith("pre, ") and
+                                                      text.endswith(", post"))))
+        results.append(run_case("find_replace_all", browser.find_replace_all, repeats, image_count,
+                                setup=lambda: (copy_dataset(), answers.__setitem__(slice(None), ["photo", "picture"])),
+                                check=edited_captions(lambda text: "picture" in text and "photo" not in text)))
+    finally:
+        J_Captioneer_v2.QInputDialog.getText = original_get_text
+        del browser.confirm_bulk_edit
+        browser.directory = directory
+        browser.load_images()
+        browser.wait_for_scan()
+    return results
+
+
+def compare(baseline, results):
+    """Print each case's median against the baseline's, slowest changes last."""
+    before = {result["name"]: result for result in baseline["results"]}
+    rows = []
+    for result in results["results"]:
+        old = before.get(result["name"], {}).get("median_seconds")
+        new = result.get("median_seconds")
+        ratio = new / old if old and new else None
+        rows.append((ratio if ratio is not None else float("inf"), result["name"], old, new, ratio))
+    print(f"{'case':<28}{'before':>12}{'after':>12}{'change':>10}", file=sys.stderr)
+    for _, name, old, new, ratio in sorted(rows):
+        old_text = f"{old:.4f}s" if old else "-"
+        new_text = f"{new:.4f}s" if new else "-"
+        change = f"{(ratio - 1) * 100:+.1f}%" if ratio is not None else "-"
+        print(f"{name:<28}{old_text:>12}{new_text:>12}{change:>10}", file=sys.stderr)
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=32, help="number of synthetic images")
+    parser.add_argument("--size", type=parse_size, default=(1024, 768), help="image size, WIDTHxHEIGHT")
+    parser.add_argument("--format", default="jpg", choices=["jpg", "png", "bmp"])
+    parser.add_argument("--caption-images", type=int, default=8, help="images per predict_step call")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated subset of " + ", ".join(CASES))
+    parser.add_argument("--output", help="write the results here instead of stdout")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+    cases = args.cases.split(",")
+    width, height = args.size
+
+    work_directory = WORK_DIRECTORY
+    working_directory = os.getcwd()
+    try:
+        # The app keeps its settings in the working directory.
+        os.chdir(work_directory)
+        dataset = os.path.join(work_directory, "dataset")
+        start = time.perf_counter()
+        image_paths = synthetic.make_image_directory(dataset, args.images, width, height, args.format)
+        print(f"generated {args.images} images in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        results = {
+            "environment": environment(),
+            "config": {"images": args.images, "width": width, "height": height, "format": args.format,
+                       "repeat": args.repeat},
+            "results": [],
+        }
+        if "predict_step" in cases:
+            results["results"] += bench_predict_step(image_paths[:args.caption_images], args.repeat,
+                                                     args.batch_size)
+        if set(cases) & {"load_images", "show_thumbnails", "crop_resize", "bulk_edits"}:
+            from PyQt5.QtWidgets import QApplication
+            import J_Captioneer_v2
+
+            app = QApplication.instance() or QApplication([sys.argv[0]])
+            browser = J_Captioneer_v2.ImageBrowser()
+            browser.resize(1280, 800)
+            browser.show()
+            app.processEvents()
+            results["results"] += bench_gui(app, browser, dataset, work_directory, args.repeat, width, height,
+                                            cases)
+            browser.close()
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            compare(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
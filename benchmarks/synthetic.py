@@ -0,0 +1,109 @@
+"""Synthetic datasets and tiny captioning models for the benchmarks.
+
+Nothing here downloads anything: images are generated from a seed and the
+models are randomly initialised VisionEncoderDecoder (ViT + GPT-2) and BLIP
+configs small enough to load in well under a second.  The models are
+registered under the real names ("VIT-GPT2", "BLIP") so they go through the
+same preprocessing and generation code as the real ones.  Their captions
+are nonsense, but deterministic.
+"""
+import os
+import random
+import sys
+import tempfile
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import captioning  # noqa: E402
+from caption_store import caption_path  # noqa: E402
+
+TINY_IMAGE_SIZE = 32
+TINY_VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + [f"word{index}" for index in range(95)]
+PAD_TOKEN_ID, START_TOKEN_ID, END_TOKEN_ID = 0, 2, 3
+
+
+def make_image(width, height, seed):
+    """A smooth random colour field, which compresses and decodes like a photo rather than like noise."""
+    generator = random.Random(seed)
+    small_size = (max(1, width // 32), max(1, height // 32))
+    small = Image.frombytes("RGB", small_size, generator.randbytes(small_size[0] * small_size[1] * 3))
+    return small.resize((width, height), Image.BILINEAR)
+
+
+def make_image_directory(directory, count, width=1024, height=768, image_format="jpg", captions=True, seed=0):
+    """
+    Fill `directory` with `count` generated images (and a caption .txt next
+    to each if `captions`) and return their paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    image_paths = []
+    for index in range(count):
+        image_path = os.path.join(directory, f"image_{index:06d}.{image_format}")
+        # quality only applies to JPEG; other formats ignore it.
+        make_image(width, height, seed + index).save(image_path, quality=90)
+        if captions:
+            with open(caption_path(image_path), "w", encoding="utf-8") as file:
+                file.write(f"a synthetic photo number {index}, with some colours")
+        image_paths.append(image_path)
+    return image_paths
+
+
+def tiny_tokenizer():
+    from transformers import BertTokenizer
+
+    with tempfile.TemporaryDirectory() as directory:
+        vocab_path = os.path.join(directory, "vocab.txt")
+        with open(vocab_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(TINY_VOCAB))
+        return BertTokenizer(vocab_path)
+
+
+def load_tiny_vit_gpt2(device, report):
+    import torch
+    from transformers import (GPT2Config, ViTConfig, ViTImageProcessor, VisionEncoderDecoderConfig,
+                              VisionEncoderDecoderModel)
+
+    report("building tiny VIT-GPT2")
+    torch.manual_seed(0)
+    encoder = ViTConfig(hidden_size=32, num_hidden_layers=1, num_attention_heads=2, intermediate_size=37,
+                        image_size=TINY_IMAGE_SIZE, patch_size=8)
+    decoder = GPT2Config(n_embd=32, n_layer=1, n_head=2, vocab_size=len(TINY_VOCAB),
+                         bos_token_id=START_TOKEN_ID, eos_token_id=END_TOKEN_ID)
+    model = VisionEncoderDecoderModel(VisionEncoderDecoderConfig.from_encoder_decoder_configs(encoder, decoder))
+    for config in (model.config, model.generation_config):
+        config.decoder_start_token_id = START_TOKEN_ID
+        config.pad_token_id = PAD_TOKEN_ID
+        config.eos_token_id = END_TOKEN_ID
+    model.to(device)
+    model.eval()
+    processor = ViTImageProcessor(size={"height": TINY_IMAGE_SIZE, "width": TINY_IMAGE_SIZE})
+    return {"model": model, "processor": processor, "tokenizer": tiny_tokenizer()}
+
+
+def load_tiny_blip(device, report):
+    import torch
+    from transformers import BlipConfig, BlipForConditionalGeneration, BlipImageProcessor, BlipProcessor
+
+    report("building tiny BLIP")
+    torch.manual_seed(0)
+    config = BlipConfig(
+        text_config=dict(hidden_size=32, num_hidden_layers=1, num_attention_heads=2, intermediate_size=37,
+                         vocab_size=len(TINY_VOCAB), encoder_hidden_size=32, bos_token_id=START_TOKEN_ID,
+                         sep_token_id=END_TOKEN_ID, eos_token_id=END_TOKEN_ID, pad_token_id=PAD_TOKEN_ID),
+        vision_config=dict(hidden_size=32, num_hidden_layers=1, num_attention_heads=2, intermediate_size=37,
+                           image_size=TINY_IMAGE_SIZE, patch_size=8))
+    model = BlipForConditionalGeneration(config)
+    model.to(device)
+    model.eval()
+    processor = BlipProcessor(BlipImageProcessor(size={"height": TINY_IMAGE_SIZE, "width": TINY_IMAGE_SIZE}),
+                              tiny_tokenizer())
+    return {"model": model, "processor": processor, "tokenizer": processor}
+
+
+def create_tiny_registry(device=None, quantized_dir=captioning.QUANTIZED_MODEL_DIR, export_dir=captioning.EXPORT_DIR):
+    registry = captioning.ModelRegistry(device, quantized_dir, export_dir)
+    registry.register("VIT-GPT2", load_tiny_vit_gpt2)
+    registry.register("BLIP", load_tiny_blip)
+    return registry
@@ -0,0 +1,101 @@
+"""Images/sec of CPU captioning against the number of worker processes.
+
+    python benchmarks/worker_scaling.py DIRECTORY --model BLIP --workers 0,1,2,4
+    python benchmarks/worker_scaling.py --tiny --limit 128
+
+0 workers is the in-process CaptionPipeline, for comparison.  "steady" is
+the throughput after every worker has loaded its model, which is what a
+long run converges to; "wall" includes model loading.  --tiny runs the tiny
+random models of synthetic.py instead of the real ones, so nothing is
+downloaded, and without a DIRECTORY --limit images of --size are generated
+into a temporary directory.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import captioning  # noqa: E402
+import synthetic  # noqa: E402
+from image_directory import IMAGE_EXTENSIONS  # noqa: E402
+
+
+def run_once(models, model_name, image_paths, gen_kwargs, batch_size, workers):
+    if workers:
+        pool = captioning.ProcessCaptionPool(models, model_name, gen_kwargs, batch_size, workers)
+    else:
+        pool = captioning.CaptionPipeline(models, model_name, gen_kwargs, batch_size)
+
+    start = time.perf_counter()
+    ready = start if workers else None
+    done = 0
+    for batch, _ in pool.run(image_paths):
+        if ready is None:
+            ready = time.perf_counter()
+        done += len(batch)
+    end = time.perf_counter()
+    if workers:
+        ready = pool.ready_at or start
+
+    return {
+        "workers": workers,
+        "threads_per_worker": pool.threads_per_worker if workers else None,
+        "batch_size": pool.batch_size,
+        "images": done,
+        "wall_seconds": end - start,
+        "wall_images_per_second": done / (end - start),
+        "steady_images_per_second": done / (end - ready) if end > ready else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", nargs="?", help="images to caption (default: generated ones)")
+    parser.add_argument("--model", default="VIT-GPT2")
+    parser.add_argument("--workers", default="0,1,2,4", help="comma separated worker counts")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=64, help="number of images to caption per run")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per run")
+    parser.add_argument("--tiny", action="store_true", help="use tiny random models instead of the real ones")
+    parser.add_argument("--size", default="1024x768", help="size of generated images, WIDTHxHEIGHT")
+    args = parser.parse_args(argv)
+
+    import torch
+
+    work_directory = tempfile.mkdtemp(prefix="j_captioneer_worker_scaling_")
+    try:
+        if args.directory:
+            image_paths = sorted(os.path.join(args.directory, name) for name in os.listdir(args.directory)
+                                 if name.lower().endswith(IMAGE_EXTENSIONS))[:args.limit]
+        else:
+            width, height = (int(side) for side in args.size.lower().split("x"))
+            image_paths = synthetic.make_image_directory(os.path.join(work_directory, "dataset"), args.limit,
+                                                         width, height, captions=False)
+        if args.tiny:
+            # Never mix the tiny models into the real models' quantized and exported copies.
+            models = synthetic.create_tiny_registry(torch.device("cpu"), os.path.join(work_directory, "quantized"),
+                                                    os.path.join(work_directory, "exported"))
+        else:
+            models = captioning.create_registry(torch.device("cpu"))
+        gen_kwargs = {"max_length": 16, "num_beams": 4}
+
+        for workers in [int(count) for count in args.workers.split(",")]:
+            result = run_once(models, args.model, image_paths, gen_kwargs, args.batch_size, workers)
+            if args.json:
+                print(json.dumps(result), flush=True)
+            else:
+                steady = result["steady_images_per_second"]
+                print(f"{workers:>3} workers: {result['wall_images_per_second']:6.2f} images/s wall, "
+                      f"{steady:6.2f} images/s steady ({result['images']} images, batch {result['batch_size']})",
+                      flush=True)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
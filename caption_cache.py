@@ -0,0 +1,98 @@
+"""Persistent cache of generated captions for J_Captioneer.
+
+Captions are keyed by the SHA-256 of the image file's content together with
+the model name, its precision and runtime and the generation settings, so
+re-running "Generate Captions For All" only computes images that are new or
+have changed.  Hashing a file is skipped while its path, mtime and size stay
+the same.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from app_data import data_path
+
+CAPTION_CACHE_FILE = data_path("caption_cache.db")
+
+
+def file_digest(path, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CaptionCache:
+    def __init__(self, path=CAPTION_CACHE_FILE):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "digest TEXT, model TEXT, params TEXT, caption TEXT, "
+            "PRIMARY KEY (digest, model, params))")
+        self.connection.commit()
+
+    def digest(self, image_path):
+        """Content hash of `image_path`, reusing the stored one if the file is unchanged."""
+        path = os.path.abspath(image_path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT mtime_ns, size, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[2]
+
+        digest = file_digest(path)
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (path, stat.st_mtime_ns, stat.st_size, digest))
+        return digest
+
+    def key(self, image_path, model_name, gen_kwargs, precision="fp32", runtime="eager"):
+        params = json.dumps(gen_kwargs, sort_keys=True)
+        # Exported graphs and other precisions can pick a different word now and then.
+        variant = [setting for setting in (precision, runtime) if setting not in ("fp32", "eager")]
+        if variant:
+            model_name = f"{model_name} ({', '.join(variant)})"
+        return self.digest(image_path), model_name, params
+
+    def get(self, key):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT caption FROM captions WHERE digest = ? AND model = ? AND params = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, caption):
+        """Store a caption.  Call flush() to make pending writes durable."""
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?)", key + (caption,))
+
+    def flush(self):
+        with self._lock:
+            self.connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM captions")
+            self.connection.commit()
+
+    def close(self):
+        with self._lock:
+            self.connection.commit()
+            self.connection.close()
@@ -0,0 +1,167 @@
+"""Inverted index of caption words for J_Captioneer.
+
+Maps every lower-cased word to the images whose caption contains it, so
+searching, filtering the thumbnail grid and finding the captions a bulk edit
+would touch never reads caption files.  The index keeps each caption's text
+(and, for .txt captions, the file's mtime and size) and is saved to
+CAPTION_INDEX_DIR between sessions; reopening a directory only re-reads the
+captions that changed since.  Callers keep it current with update() when
+they save a caption.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from app_data import data_path
+from caption_store import IO_WORKERS, caption_path
+
+CAPTION_INDEX_DIR = data_path("caption_index")
+INDEX_VERSION = 1
+WORD = re.compile(r"\w+")
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+def text_file_signature(image_path):
+    try:
+        stat = os.stat(caption_path(image_path))
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class CaptionIndex:
+    def __init__(self, store, directory=CAPTION_INDEX_DIR):
+        self.store = store
+        key = f"{store.kind}:{os.path.abspath(store.directory or '')}"
+        self.path = os.path.join(directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+        self.texts = {}
+        self.signatures = {}
+        self.postings = {}
+        self.dirty = False
+
+    @classmethod
+    def load(cls, store, directory=CAPTION_INDEX_DIR):
+        """The saved index for `store`, or an empty one.  Call refresh() before trusting it."""
+        index = cls(store, directory)
+        try:
+            with open(index.path, "r", encoding="utf-8") as file:
+                saved = json.load(file)
+            if saved.get("version") == INDEX_VERSION:
+                for image_path, (signature, text) in saved["documents"].items():
+                    index._add(image_path, text, signature)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return index
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        documents = {image_path: [self.signatures.get(image_path), text] for image_path, text in self.texts.items()}
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+            json.dump({"version": INDEX_VERSION, "documents": documents}, file)
+        os.replace(temporary_path, self.path)
+        self.dirty = False
+
+    def refresh(self, image_paths):
+        """
+        Bring the index in line with the store for exactly `image_paths` and
+        return how many captions had to be read.  .txt captions are only
+        re-read if their mtime or size changed; a SQLite store is read in one
+        query.
+        """
+        image_paths = list(image_paths)
+        wanted = set(image_paths)
+        for image_path in [image_path for image_path in self.texts if image_path not in wanted]:
+            self._remove(image_path)
+
+        if self.store.kind == "sqlite":
+            captions = self.store.captions()
+            changed = [image_path for image_path in image_paths
+                       if self.texts.get(image_path) != captions.get(image_path, "")]
+            for image_path in changed:
+                self.update(image_path, captions.get(image_path, ""))
+            return len(changed)
+
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            signatures = dict(zip(image_paths, executor.map(text_file_signature, image_paths)))
+            changed = [image_path for image_path in image_paths
+                       if image_path not in self.texts or self.signatures.get(image_path) != signatures[image_path]]
+            texts = executor.map(self.store.load, changed)
+            for image_path, text in zip(changed, texts):
+                self.update(image_path, text, signatures[image_path])
+        return len(changed)
+
+    def update(self, image_path, text, signature=None):
+        """Record that `image_path`'s caption is now `text`."""
+        if signature is None and self.store.kind == "txt":
+            signature = text_file_signature(image_path)
+        if self.texts.get(image_path) == text and self.signatures.get(image_path) == signature:
+            return
+        self._remove(image_path)
+        self._add(image_path, text, signature)
+        self.dirty = True
+
+    def discard(self, image_path):
+        """Forget an image that no longer exists."""
+        self._remove(image_path)
+
+    def _add(self, image_path, text, signature):
+        self.texts[image_path] = text
+        self.signatures[image_path] = signature
+        for word in set(words(text)):
+            self.postings.setdefault(word, set()).add(image_path)
+
+    def _remove(self, image_path):
+        text = self.texts.pop(image_path, None)
+        self.signatures.pop(image_path, None)
+        if text is None:
+            return
+        self.dirty = True
+        for word in set(words(text)):
+            paths = self.postings.get(word)
+            if paths is not None:
+                paths.discard(image_path)
+                if not paths:
+                    del self.postings[word]
+
+    def candidates(self, query):
+        """
+        Images whose caption might contain `query`: every word of the query
+        must be part of some word in the caption.  None means any caption
+        might (the query has no word characters).
+        """
+        candidates = None
+        for query_word in set(words(query)):
+            paths = self.postings.get(query_word, set()).copy()
+            for word, word_paths in self.postings.items():
+                if query_word in word and word != query_word:
+                    paths |= word_paths
+            candidates = paths if candidates is None else candidates & paths
+            if not candidates:
+                return set()
+        return candidates
+
+    def search(self, query, case_sensitive=False):
+        """{image_path: number of occurrences} for every caption containing `query` literally."""
+        if not query:
+            return {}
+        candidates = self.candidates(query)
+        if candidates is None:
+            candidates = self.texts
+        if not case_sensitive:
+            query = query.lower()
+        matches = {}
+        for image_path in candidates:
+            text = self.texts[image_path]
+            count = (text if case_sensitive else text.lower()).count(query)
+            if count:
+                matches[image_path] = count
+        return matches
@@ -0,0 +1,125 @@
+"""Resumable "Generate Captions For All" jobs for J_Captioneer.
+
+A job is an append-only journal: the first line describes the job (model,
+settings and the full image list) and every following line is the index of
+an image whose caption has been written, or "f" and the index of an image
+that couldn't be read and is skipped.  Lines are buffered and flushed in
+groups, so checkpointing costs a few bytes per image; after a crash at most
+the last unflushed group is captioned again.  The journal is deleted when
+the job finishes, so an existing journal always means unfinished work.
+"""
+import json
+import os
+import time
+
+from app_data import data_path
+
+JOB_JOURNAL_FILE = data_path("caption_job.jsonl")
+FLUSH_EVERY = 64
+FLUSH_INTERVAL = 1.0
+
+
+class CaptionJob:
+    def __init__(self, path, header, completed, failed, file):
+        self.path = path
+        self.directory = header["directory"]
+        self.model_name = header["model"]
+        self.gen_kwargs = header["gen_kwargs"]
+        self.keep_existing = header.get("keep_existing", False)
+        self.images = header["images"]
+        self.indexes = {image_path: index for index, image_path in enumerate(self.images)}
+        self.completed = completed
+        self.failed = failed
+        self.file = file
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    @classmethod
+    def create(cls, directory, model_name, gen_kwargs, images, keep_existing=False, path=JOB_JOURNAL_FILE):
+        header = {
+            "directory": directory,
+            "model": model_name,
+            "gen_kwargs": gen_kwargs,
+            "keep_existing": keep_existing,
+            "images": list(images),
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        file = open(path, "w", encoding="utf-8")
+        file.write(json.dumps(header) + "\n")
+        file.flush()
+        return cls(path, header, set(), set(), file)
+
+    @classmethod
+    def load(cls, path=JOB_JOURNAL_FILE):
+        """Reopen an unfinished job, or return None if there is none (or it is unreadable)."""
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                header = json.loads(file.readline())
+                completed = set()
+                failed = set()
+                for line in file:
+                    # The last line may be cut short by a crash.
+                    if not line.endswith("\n"):
+                        continue
+                    line = line.strip()
+                    if line.isdigit():
+                        completed.add(int(line))
+                    elif line.startswith("f") and line[1:].isdigit():
+                        failed.add(int(line[1:]))
+        except (OSError, ValueError, KeyError):
+            return None
+        if not isinstance(header, dict) or "images" not in header:
+            return None
+        return cls(path, header, completed, failed, open(path, "a", encoding="utf-8"))
+
+    def remaining(self):
+        return [image_path for index, image_path in enumerate(self.images)
+                if index not in self.completed and index not in self.failed]
+
+    def completed_count(self):
+        return len(self.completed)
+
+    def failed_count(self):
+        return len(self.failed)
+
+    def failed_images(self):
+        return [self.images[index] for index in sorted(self.failed)]
+
+    def total(self):
+        return len(self.images)
+
+    def mark_done(self, image_path):
+        index = self.indexes.get(image_path)
+        if index is None or index in self.completed:
+            return
+        self.completed.add(index)
+        self._write(f"{index}\n")
+
+    def mark_failed(self, image_path):
+        index = self.indexes.get(image_path)
+        if index is None or index in self.completed or index in self.failed:
+            return
+        self.failed.add(index)
+        self._write(f"f{index}\n")
+
+    def _write(self, line):
+        self.file.write(line)
+        self.unflushed += 1
+        if self.unflushed >= FLUSH_EVERY or time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def finish(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,274 @@
+"""Local caption server for J_Captioneer.
+
+Keeps the captioning models loaded in one long-running process so the app
+and the command line tool don't each load their own copy.  Clients
+(captioning.CaptionClient) connect over a Unix socket, or localhost TCP,
+and send image paths; requests from all clients for the same model and
+settings that arrive within a few milliseconds of each other are captioned
+in one batched generate() call.
+
+    python caption_server.py [--address PATH|HOST:PORT] [--preload BLIP]
+
+The app uses the server when "Use Caption Server" is on in its settings, and
+the command line tool when given --server.  Both fall back to loading the
+model themselves if no server is running.
+
+Clients name image files for the server to open, so anyone who can connect
+can make it read any image its user can.  The Unix socket is created
+readable and writable by its owner only; TCP is only served on a loopback
+address, where every local user can still connect, so prefer the socket
+where there is one.
+"""
+import argparse
+import ipaddress
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import captioning
+
+MAX_BATCH = 8
+BATCH_WAIT = 0.02
+
+
+class Request:
+    """One client request waiting for the batcher: decoded RGB images, to be captioned in order."""
+
+    def __init__(self, key, images):
+        self.key = key
+        self.images = images
+        self.captions = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Batcher:
+    """
+    Runs every generate() call on one thread.  Requests with the same key
+    (model, precision, runtime and generation settings) are merged into
+    batches of up to `max_batch` images, waiting at most `batch_wait`
+    seconds for more to arrive.  Each request's images are preprocessed on
+    their own before merging, so an image the processor rejects only fails
+    the request it came in.
+    """
+
+    def __init__(self, max_batch=MAX_BATCH, batch_wait=BATCH_WAIT):
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.requests = queue.Queue()
+        self.registries = {}
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def registry(self, precision, runtime):
+        """A ModelRegistry per (precision, runtime), so differently configured clients can share the server."""
+        key = (precision, runtime)
+        with self._lock:
+            if key not in self.registries:
+                registry = captioning.create_registry()
+                for name in registry.names():
+                    registry.set_precision(name, precision)
+                    registry.set_runtime(name, runtime)
+                self.registries[key] = registry
+            return self.registries[key]
+
+    def loaded(self):
+        with self._lock:
+            registries = list(self.registries.items())
+        return sorted(f"{name} ({precision}, {runtime})" for (precision, runtime), registry in registries
+                      for name in registry.names() if registry.is_loaded(name))
+
+    def submit(self, key, images):
+        request = Request(key, images)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.captions
+
+    def run(self):
+        while True:
+            first = self.requests.get()
+            batch = [first]
+            deferred = []
+            count = len(first.images)
+            deadline = time.monotonic() + self.batch_wait
+            while count < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request.key == first.key:
+                    batch.append(request)
+                    count += len(request.images)
+                else:
+                    deferred.append(request)
+            for request in deferred:
+                self.requests.put(request)
+            self.caption(batch)
+
+    def caption(self, batch):
+        import torch
+
+        model_name, precision, runtime, gen_kwargs = batch[0].key
+        try:
+            registry = self.registry(precision, runtime)
+            backend = registry.get(model_name)
+        except Exception as e:
+            self.fail(batch, e)
+            return
+        pixel_values = []
+        accepted = []
+        for request in batch:
+            try:
+                tensors = [captioning.preprocess(backend, model_name, image) for image in request.images]
+            except Exception as e:
+                self.fail([request], e)
+                continue
+            pixel_values.extend(tensors)
+            accepted.append(request)
+        if not accepted:
+            return
+        try:
+            captions = []
+            start = time.perf_counter()
+            for offset in range(0, len(pixel_values), self.max_batch):
+                output = captioning.generate_ids(backend, model_name,
+                                                 torch.cat(pixel_values[offset:offset + self.max_batch]),
+                                                 json.loads(gen_kwargs), registry.device)
+                captions.extend(captioning.decode_ids(backend, model_name, output))
+            registry.record_call(model_name, time.perf_counter() - start, len(pixel_values))
+            log(f"{len(pixel_values)} images from {len(accepted)} requests: {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            self.fail(accepted, e)
+            return
+        for request in accepted:
+            request.captions, captions = captions[:len(request.images)], captions[len(request.images):]
+            request.done.set()
+
+    def fail(self, requests, error):
+        for request in requests:
+            request.error = error
+            request.done.set()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.respond(json.loads(line))
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+    def respond(self, message):
+        batcher = self.server.batcher
+        if message.get("op") == "ping":
+            return {"pid": os.getpid(), "loaded": batcher.loaded()}
+        if message.get("op") != "caption":
+            raise ValueError(f"Unknown request: {message.get('op')}")
+        model_name = message["model"]
+        if model_name not in batcher.registry("fp32", "eager"):
+            raise KeyError(f"Unknown captioning model: {model_name}")
+        options = message.get("options", {})
+        key = (model_name, options.get("precision", "fp32"), options.get("runtime", "eager"),
+               json.dumps(message.get("gen_kwargs", {}), sort_keys=True))
+        # Decoded here, on the client's thread, so decoding overlaps generation.
+        # Images that can't be read get a None caption and an entry in "errors".
+        errors = {}
+        images = [captioning.try_load_image(image_path, errors) for image_path in message["images"]]
+        readable = [image for image in images if image is not None]
+        captions = iter(batcher.submit(key, readable) if readable else [])
+        return {"captions": [None if image is None else next(captions) for image in images], "errors": errors}
+
+
+def log(message):
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def create_server(address, batcher):
+    """
+    Listen at `address`: a Unix socket path, created with owner-only
+    permissions, or a (host, port) that must be a loopback address.
+    """
+    if isinstance(address, tuple):
+        if not is_loopback(address[0]):
+            raise ValueError(f"{address[0]} is not a loopback address; the caption server only serves this machine")
+        server = socketserver.ThreadingTCPServer(address, RequestHandler, bind_and_activate=False)
+        server.allow_reuse_address = True
+    else:
+        if os.path.exists(address):
+            try:
+                with captioning.CaptionClient(address):
+                    raise RuntimeError(f"A caption server is already running at {address}")
+            except captioning.CaptionServerUnavailable:
+                os.remove(address)  # left behind by a server that didn't shut down cleanly
+        server = socketserver.ThreadingUnixStreamServer(address, RequestHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.batcher = batcher
+    # Unix sockets get their permissions from the umask when bound.
+    umask = os.umask(0o177) if not isinstance(address, tuple) else None
+    try:
+        server.server_bind()
+        server.server_activate()
+    except OSError:
+        server.server_close()
+        raise
+    finally:
+        if umask is not None:
+            os.umask(umask)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep J_Captioneer's captioning models loaded for all clients.")
+    parser.add_argument("--address", default=None,
+                        help=f"Unix socket path or HOST:PORT, HOST being a loopback address (default: "
+                             f"${captioning.CAPTION_SERVER_ENV} or {captioning.default_server_address()})")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="images per generate() call")
+    parser.add_argument("--batch-wait-ms", type=float, default=BATCH_WAIT * 1000,
+                        help="how long to wait for other clients' requests to batch with")
+    parser.add_argument("--preload", nargs="*", default=[], choices=["VIT-GPT2", "BLIP"],
+                        help="load these models (fp32, eager) before accepting requests")
+    args = parser.parse_args(argv)
+
+    address = captioning.server_address(args.address)
+    batcher = Batcher(args.max_batch, args.batch_wait_ms / 1000)
+    for model_name in args.preload:
+        batcher.registry("fp32", "eager").get(model_name, progress=log)
+    try:
+        server = create_server(address, batcher)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"Could not start the caption server: {e}", file=sys.stderr)
+        return 1
+    batcher.thread.start()
+    log(f"Caption server listening at {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple):
+            try:
+                os.remove(address)
+            except OSError:
+                pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
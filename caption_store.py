@@ -0,0 +1,183 @@
+"""Where J_Captioneer keeps the captions of a dataset.
+
+TextFileStore is the classic layout: one `<image name>.txt` next to each
+image, which is what training tools read.  SQLiteCaptionStore keeps all of
+a directory's captions in a single indexed SQLite file inside it instead,
+so loading, saving and bulk edits don't open one small file per image
+(which dominates on network shares and large datasets).  Captions move
+between the two with import_text_files() and export_text_files().
+
+Both stores have the same load/save API and are safe to use from several
+threads.
+"""
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+CAPTION_STORES = ("txt", "sqlite")
+CAPTION_STORE_FILE = "j_captioneer_captions.db"
+IO_WORKERS = 8
+
+
+def caption_path(image_path):
+    return os.path.splitext(image_path)[0] + ".txt"
+
+
+def read_text_file(path):
+    """Content of a caption .txt, or None if it doesn't exist."""
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_text_file(path, text):
+    """Replace `path` atomically: write a temporary file next to it and rename it over."""
+    temporary_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+
+
+class TextFileStore:
+    kind = "txt"
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.created = False
+
+    def load(self, image_path):
+        return read_text_file(caption_path(image_path)) or ""
+
+    def save(self, image_path, caption):
+        write_text_file(caption_path(image_path), caption)
+
+    def save_many(self, captions):
+        """Save {image_path: caption} in one go."""
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            list(executor.map(lambda item: self.save(*item), captions.items()))
+
+    def has_caption(self, image_path):
+        return bool(self.load(image_path).strip())
+
+    def rename(self, image_path, new_image_path):
+        """Move the caption of an image that was renamed (e.g. converted to another format)."""
+        old_path, new_path = caption_path(image_path), caption_path(new_image_path)
+        if old_path != new_path and os.path.exists(old_path):
+            os.replace(old_path, new_path)
+
+    def close(self):
+        pass
+
+
+class SQLiteCaptionStore:
+    """
+    All captions of `directory` in `directory`/CAPTION_STORE_FILE, keyed by
+    the image's path relative to the directory so the dataset can be moved.
+    Scanning the directory doesn't create anything; an image without a row
+    simply has no caption yet.
+    """
+
+    kind = "sqlite"
+
+    def __init__(self, directory, filename=CAPTION_STORE_FILE):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        self.created = not os.path.exists(self.path)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS captions (name TEXT PRIMARY KEY, caption TEXT)")
+        self.connection.commit()
+
+    def name(self, image_path):
+        return os.path.relpath(image_path, self.directory).replace(os.sep, "/")
+
+    def load(self, image_path):
+        with self._lock:
+            row = self.connection.execute("SELECT caption FROM captions WHERE name = ?",
+                                          (self.name(image_path),)).fetchone()
+        return row[0] if row is not None else ""
+
+    def save(self, image_path, caption):
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO captions VALUES (?, ?)", (self.name(image_path), caption))
+            self.connection.commit()
+
+    def save_many(self, captions):
+        """Save {image_path: caption} in a single transaction."""
+        rows = [(self.name(image_path), caption) for image_path, caption in captions.items()]
+        with self._lock:
+            self.connection.executemany("INSERT OR REPLACE INTO captions VALUES (?, ?)", rows)
+            self.connection.commit()
+
+    def has_caption(self, image_path):
+        return bool(self.load(image_path).strip())
+
+    def rename(self, image_path, new_image_path):
+        """Move the caption of an image that was renamed (e.g. converted to another format)."""
+        with self._lock:
+            self.connection.execute("UPDATE OR REPLACE captions SET name = ? WHERE name = ?",
+                                    (self.name(new_image_path), self.name(image_path)))
+            self.connection.commit()
+
+    def captions(self):
+        """{image_path: caption} for every stored caption."""
+        with self._lock:
+            rows = self.connection.execute("SELECT name, caption FROM captions").fetchall()
+        return {os.path.join(self.directory, *name.split("/")): caption for name, caption in rows}
+
+    def import_text_files(self, image_paths, overwrite=True):
+        """
+        Copy the .txt captions of `image_paths` into the store, reading them
+        in parallel and inserting them in one transaction.  Returns how many
+        were imported.  With overwrite=False, captions already stored win.
+        """
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            texts = executor.map(lambda image_path: read_text_file(caption_path(image_path)), image_paths)
+            captions = {image_path: text for image_path, text in zip(image_paths, texts) if text is not None}
+        if not overwrite:
+            stored = self.captions()
+            captions = {image_path: text for image_path, text in captions.items() if image_path not in stored}
+        self.save_many(captions)
+        return len(captions)
+
+    def export_text_files(self, image_paths=None):
+        """
+        Write stored captions out as .txt files next to their images (only
+        for `image_paths` if given, and only images that still exist).
+        Returns how many were written.
+        """
+        captions = self.captions()
+        if image_paths is not None:
+            captions = {image_path: captions.get(image_path, "") for image_path in image_paths}
+        items = [(image_path, caption) for image_path, caption in captions.items() if os.path.exists(image_path)]
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            list(executor.map(lambda item: write_text_file(caption_path(item[0]), item[1]), items))
+        return len(items)
+
+    def close(self):
+        with self._lock:
+            self.connection.commit()
+            # Fold the write-ahead log back into the database, so nothing but
+            # CAPTION_STORE_FILE stays behind in the dataset folder.
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.connection.close()
+
+
+def open_caption_store(directory, kind="txt"):
+    if kind == "sqlite":
+        return SQLiteCaptionStore(directory)
+    if kind != "txt":
+        raise ValueError(f"Unknown caption store: {kind}")
+    return TextFileStore(directory)
@@ -0,0 +1,196 @@
+"""Bulk caption edits for J_Captioneer.
+
+A bulk edit is a chain of transforms (prefix, suffix, literal or regex
+replace) run over many captions.  plan() works out which captions the chain
+would change without writing anything, and diff() renders that dry run.
+apply() first writes an undo journal holding the old text of every changed
+caption, then saves only those captions through the caption store (.txt
+captions are replaced atomically).  undo() restores the newest journal,
+leaving alone any caption that was edited again since.
+"""
+import difflib
+import gzip
+import json
+import os
+import re
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from app_data import data_path
+from caption_store import IO_WORKERS
+
+UNDO_DIR = data_path("caption_undo")
+JOURNAL_SUFFIX = ".jsonl.gz"
+TRANSFORMS = ("Prefix", "Suffix", "Replace", "Regex Replace")
+
+
+class Prefix:
+    """Add `text` to the start of every line (original leading whitespace is dropped)."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def __call__(self, caption):
+        return "\n".join(self.text + line.lstrip() for line in caption.splitlines())
+
+    def __str__(self):
+        return f"prefix \"{self.text}\""
+
+
+class Suffix:
+    """Add `text` to the end of every line (original trailing whitespace is dropped)."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def __call__(self, caption):
+        return "\n".join(line.rstrip() + self.text for line in caption.splitlines())
+
+    def __str__(self):
+        return f"suffix \"{self.text}\""
+
+
+class Replace:
+    def __init__(self, find, replacement):
+        self.find = find
+        self.replacement = replacement
+
+    def __call__(self, caption):
+        return caption.replace(self.find, self.replacement)
+
+    def __str__(self):
+        return f"replace \"{self.find}\" with \"{self.replacement}\""
+
+
+class RegexReplace:
+    """re.sub(); `replacement` may use \\1 or \\g<name>.  Raises re.error for an invalid pattern."""
+
+    def __init__(self, pattern, replacement):
+        self.pattern = re.compile(pattern)
+        self.replacement = replacement
+
+    def __call__(self, caption):
+        return self.pattern.sub(self.replacement, caption)
+
+    def __str__(self):
+        return f"regex replace /{self.pattern.pattern}/ with \"{self.replacement}\""
+
+
+def make_transform(name, text, replacement=""):
+    """Build one of TRANSFORMS by name."""
+    if name == "Prefix":
+        return Prefix(text)
+    if name == "Suffix":
+        return Suffix(text)
+    if name == "Replace":
+        return Replace(text, replacement)
+    if name == "Regex Replace":
+        return RegexReplace(text, replacement)
+    raise ValueError(f"Unknown transform: {name}")
+
+
+def describe(transforms):
+    return ", then ".join(str(transform) for transform in transforms)
+
+
+def plan(transforms, store, image_paths, texts=None):
+    """
+    [(image_path, old caption, new caption)] for every caption in
+    `image_paths` that the chain changes.  Current captions come from
+    `texts` ({image_path: caption}, e.g. a CaptionIndex's) where present
+    and are otherwise read from `store` on a thread pool.
+    """
+    def change(image_path, old):
+        new = old
+        for transform in transforms:
+            new = transform(new)
+        return (image_path, old, new) if new != old else None
+
+    texts = texts or {}
+    missing = [image_path for image_path in image_paths if image_path not in texts]
+    if missing:
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            texts = {**texts, **dict(zip(missing, executor.map(store.load, missing)))}
+    return [result for result in (change(image_path, texts[image_path]) for image_path in image_paths) if result]
+
+
+def diff(changes, limit=200):
+    """Unified diff of planned changes, for the first `limit` captions."""
+    lines = []
+    for image_path, old, new in changes[:limit]:
+        name = os.path.basename(image_path)
+        lines.extend(difflib.unified_diff(old.splitlines(), new.splitlines(), name, name, lineterm=""))
+    if len(changes) > limit:
+        lines.append(f"... and {len(changes) - limit} more captions")
+    return "\n".join(lines)
+
+
+def checksum(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def apply(changes, store, description="", directory=UNDO_DIR):
+    """
+    Save the planned `changes` and return the path of their undo journal.
+    The journal (a gzipped JSON-lines file: a header, then the path, old
+    text and a checksum of the new text per caption) is on disk before the
+    first caption is written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    journal_path = os.path.join(directory, f"{time.time_ns()}{JOURNAL_SUFFIX}")
+    header = {"store": store.kind, "directory": store.directory, "description": description,
+              "count": len(changes), "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+    with open(journal_path, "xb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as journal:
+        journal.write((json.dumps(header) + "\n").encode("utf-8"))
+        for image_path, old, new in changes:
+            journal.write((json.dumps([image_path, old, checksum(new)]) + "\n").encode("utf-8"))
+        journal.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    store.save_many({image_path: new for image_path, _, new in changes})
+    return journal_path
+
+
+def latest_journal(directory=UNDO_DIR):
+    try:
+        journals = sorted(name for name in os.listdir(directory) if name.endswith(JOURNAL_SUFFIX))
+    except OSError:
+        return None
+    return os.path.join(directory, journals[-1]) if journals else None
+
+
+def read_journal(journal_path):
+    """(header, [(image_path, old caption, checksum of the new caption)])."""
+    with gzip.open(journal_path, "rt", encoding="utf-8") as journal:
+        header = json.loads(journal.readline())
+        entries = [tuple(json.loads(line)) for line in journal if line.strip()]
+    return header, entries
+
+
+def undo(store, journal_path):
+    """
+    Put back the old captions recorded in `journal_path` and delete it.
+    Returns ({image_path: restored caption}, [image paths skipped because
+    they changed after the edit]).
+    """
+    _, entries = read_journal(journal_path)
+    image_paths = [entry[0] for entry in entries]
+    if store.kind == "sqlite":
+        captions = store.captions()
+        current = [captions.get(image_path, "") for image_path in image_paths]
+    else:
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            current = list(executor.map(store.load, image_paths))
+    restored = {}
+    conflicts = []
+    for (image_path, old, new_checksum), text in zip(entries, current):
+        if text == old:
+            continue
+        if checksum(text) != new_checksum:
+            conflicts.append(image_path)
+            continue
+        restored[image_path] = old
+    store.save_many(restored)
+    os.remove(journal_path)
+    return restored, conflicts
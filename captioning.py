@@ -0,0 +1,1248 @@
+"""Captioning models used by J_Captioneer.
+
+torch and transformers are heavy to import and the models take seconds (and
+gigabytes) to load, so nothing is imported or loaded here until a caption is
+actually requested.  Keep this module free of any PyQt5 imports.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from app_data import data_path
+
+VIT_GPT2_SOURCE = "nlpconnect/vit-gpt2-image-captioning"
+BLIP_SOURCE = "Salesforce/blip-image-captioning-large"
+
+# Rough peak memory one image adds to a generate() call with 4 beams.
+MEMORY_PER_IMAGE = {"VIT-GPT2": 96 * 2**20, "BLIP": 320 * 2**20}
+MAX_BATCH_SIZE = {"cpu": 8, "cuda": 32}
+
+# fp32: full precision.  bf16: generate() under bfloat16 autocast.
+# int8: linear layers dynamically quantized to int8 (CPU only).
+PRECISIONS = ("fp32", "bf16", "int8")
+QUANTIZED_MODEL_DIR = data_path("quantized_models")
+
+# eager: the transformers model itself.  torch.export / onnxruntime: the
+# generation loop runs against graphs exported once (see exported_models).
+RUNTIMES = ("eager", "torch.export", "onnxruntime")
+EXPORT_DIR = data_path("exported_models")
+
+# Several models captioning in one pass are named like "VIT-GPT2 + BLIP", and
+# their captions combined into one with one of MERGE_STRATEGIES:
+# lines: one caption per line, in model order.  labelled: the same, each line
+# starting with the model's name.  comma: joined with ", ".  longest: only
+# the longest caption.
+MODEL_SEPARATOR = " + "
+MERGE_STRATEGIES = ("lines", "labelled", "comma", "longest")
+
+# What load_image() raises for a file that can't be captioned.
+IMAGE_ERRORS = (OSError, ValueError, SyntaxError, Image.DecompressionBombError)
+
+CAPTION_TRACE_FILE = "caption_trace.jsonl"
+CAPTION_TIMELINE_FILE = "caption_timeline.json"
+
+# Where caption_server.py listens unless J_CAPTIONEER_SERVER says otherwise:
+# a per-user Unix socket, or a localhost port where Unix sockets don't exist.
+CAPTION_SERVER_ENV = "J_CAPTIONEER_SERVER"
+CAPTION_SERVER_PORT = 47620
+CAPTION_SERVER_CONNECT_TIMEOUT = 1.0
+
+
+def split_models(model_name):
+    """The model names in `model_name`, which names one model or several joined by MODEL_SEPARATOR."""
+    return model_name.split(MODEL_SEPARATOR)
+
+
+def merge_captions(captions, strategy="lines"):
+    """Combine {model name: caption} (in model order) into one caption."""
+    if len(captions) == 1:
+        return next(iter(captions.values()))
+    if strategy == "lines":
+        return "\n".join(captions.values())
+    if strategy == "labelled":
+        return "\n".join(f"{model_name}: {caption}" for model_name, caption in captions.items())
+    if strategy == "comma":
+        return ", ".join(caption for caption in captions.values() if caption)
+    if strategy == "longest":
+        return max(captions.values(), key=len)
+    raise ValueError(f"Unknown merge strategy: {strategy}")
+
+
+def get_device():
+    import torch
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def load_vit_gpt2(device, report):
+    report("importing transformers")
+    from transformers import VisionEncoderDecoderModel, ViTImageProcessor, AutoTokenizer
+
+    report("loading model weights")
+    model = VisionEncoderDecoderModel.from_pretrained(VIT_GPT2_SOURCE)
+    report("loading feature extractor and tokenizer")
+    feature_extractor = ViTImageProcessor.from_pretrained(VIT_GPT2_SOURCE)
+    tokenizer = AutoTokenizer.from_pretrained(VIT_GPT2_SOURCE)
+    report(f"moving model to {device}")
+    model.to(device)
+    model.eval()
+    return {"model": model, "processor": feature_extractor, "tokenizer": tokenizer}
+
+
+def load_blip(device, report):
+    report("importing transformers")
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+
+    report("loading processor")
+    blip_processor = BlipProcessor.from_pretrained(BLIP_SOURCE)
+    report("loading model weights")
+    blip_model = BlipForConditionalGeneration.from_pretrained(BLIP_SOURCE)
+    report(f"moving model to {device}")
+    blip_model.to(device)
+    blip_model.eval()
+    return {"model": blip_model, "processor": blip_processor, "tokenizer": blip_processor}
+
+
+def quantized_model_path(directory, name, loader):
+    import torch
+    import transformers
+
+    identity = f"{loader.__module__}.{loader.__qualname__}|{torch.__version__}|{transformers.__version__}"
+    safe_name = "".join(character if character.isalnum() else "_" for character in name)
+    return os.path.join(directory, f"{safe_name}-int8-{hashlib.sha1(identity.encode()).hexdigest()[:12]}.pt")
+
+
+def int8_linear_state(model):
+    """
+    The int8 weights of every dynamically quantized linear layer in `model`,
+    as plain tensors.  Quantized tensors themselves don't pickle reliably.
+    """
+    import torch
+
+    state = {}
+    for name, module in model.named_modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight = module.weight()
+            entry = {"int8": weight.int_repr(), "bias": module.bias()}
+            if weight.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+                entry["scales"] = weight.q_per_channel_scales()
+                entry["zero_points"] = weight.q_per_channel_zero_points()
+                entry["axis"] = weight.q_per_channel_axis()
+            else:
+                entry["scale"] = weight.q_scale()
+                entry["zero_point"] = weight.q_zero_point()
+            state[name] = entry
+    return state
+
+
+def load_int8_linear_state(model, state):
+    """Swap the linear layers named in `state` for int8 ones holding the stored weights."""
+    import torch
+
+    for name, entry in state.items():
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        linear = getattr(parent, child_name)
+        if "scales" in entry:
+            weight = torch._make_per_channel_quantized_tensor(entry["int8"], entry["scales"], entry["zero_points"],
+                                                              entry["axis"])
+        else:
+            weight = torch._make_per_tensor_quantized_tensor(entry["int8"], entry["scale"], entry["zero_point"])
+        quantized = torch.ao.nn.quantized.dynamic.Linear(linear.in_features, linear.out_features,
+                                                         bias_=entry["bias"] is not None, dtype=torch.qint8)
+        quantized.set_weight_bias(weight, entry["bias"])
+        setattr(parent, child_name, quantized)
+
+
+def load_quantized(name, loader, report, directory=QUANTIZED_MODEL_DIR):
+    """
+    Load `name` on the CPU with its linear layers dynamically quantized to
+    int8.  The quantized weights are cached in `directory`, so later loads
+    only swap them in instead of quantizing again.
+    """
+    import torch
+
+    backend = loader(torch.device("cpu"), report)
+    model = backend["model"]
+    path = quantized_model_path(directory, name, loader)
+    if os.path.exists(path):
+        report("loading cached int8 weights")
+        try:
+            load_int8_linear_state(model, torch.load(path, weights_only=True))
+            return backend
+        except Exception as e:
+            report(f"cached int8 weights unusable ({e}), quantizing again")
+
+    report("quantizing linear layers to int8")
+    torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(int8_linear_state(model), temp_path)
+    os.replace(temp_path, path)
+    return backend
+
+
+class ModelRegistry:
+    """
+    Lazily loaded captioning backends, keyed by the name shown in the model
+    dropdown.  A backend is imported and loaded the first time it is asked
+    for and then kept for the rest of the session, at the precision and on
+    the runtime set for it with set_precision() and set_runtime().
+    """
+
+    def __init__(self, device=None, quantized_dir=QUANTIZED_MODEL_DIR, export_dir=EXPORT_DIR):
+        self.device = device
+        self.quantized_dir = quantized_dir
+        self.export_dir = export_dir
+        # Address of a caption server to try before loading models here; None = never.
+        self.server_address = None
+        self.loaders = {}
+        self.loaded = {}
+        self.precision = {}
+        self.runtime = {}
+        self.timings = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader, precision="fp32", runtime="eager"):
+        self.loaders[name] = loader
+        self.precision[name] = precision
+        self.runtime[name] = runtime
+        self._locks[name] = threading.Lock()
+        self._reset_timings(name)
+
+    def _reset_timings(self, name):
+        self.timings[name] = {"load_seconds": None, "cold_seconds": None,
+                              "warm_seconds": 0.0, "warm_images": 0}
+
+    def set_precision(self, name, precision):
+        """Switch `name` to another precision; it is reloaded the next time it is needed."""
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}")
+        if self.precision[name] != precision:
+            self.precision[name] = precision
+            self.unload(name)
+
+    def set_runtime(self, name, runtime):
+        """
+        Run `name` eagerly or from exported graphs (see exported_models); it
+        is reloaded the next time it is needed.
+        """
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown runtime: {runtime}")
+        if self.runtime[name] != runtime:
+            self.runtime[name] = runtime
+            self.unload(name)
+
+    def options(self, name):
+        """Everything another process needs to load `name` the same way."""
+        return {"precision": self.precision[name], "runtime": self.runtime[name],
+                "quantized_dir": self.quantized_dir, "export_dir": self.export_dir}
+
+    def effective_runtime(self, name):
+        """The runtime `name` actually generates with: int8 always runs eagerly."""
+        return "eager" if self.precision[name] == "int8" else self.runtime[name]
+
+    def prepare(self, name, progress=None):
+        """
+        Export `name` now if its runtime needs graphs that don't exist yet, so
+        worker processes don't each export it.  Falls back to the eager
+        runtime if the export fails.
+        """
+        if self.effective_runtime(name) == "eager":
+            return
+        import exported_models
+
+        try:
+            exported_models.ensure_exported(name, self.loaders[name], self.runtime[name],
+                                            self._reporter(name, progress), self.export_dir)
+        except Exception as e:
+            self._reporter(name, progress)(f"{self.runtime[name]} unavailable ({e}), running eagerly")
+            self.runtime[name] = "eager"
+
+    def _reporter(self, name, progress):
+        def report(message):
+            if progress is not None:
+                progress(f"Loading {name}: {message}...")
+        return report
+
+    def unload(self, name):
+        with self._locks[name]:
+            self.loaded.pop(name, None)
+            self._reset_timings(name)
+
+    def names(self):
+        return list(self.loaders)
+
+    def is_loaded(self, name):
+        return name in self.loaded
+
+    def get(self, name, progress=None):
+        """
+        Return the loaded backend for `name`, loading it first if needed.
+        `progress` is called with short status strings while loading.  Safe to
+        call from several threads; only one of them will do the loading.
+        """
+        if name in self.loaded:
+            return self.loaded[name]
+        if name not in self.loaders:
+            raise KeyError(f"Unknown captioning model: {name}")
+
+        with self._locks[name]:
+            if name in self.loaded:
+                return self.loaded[name]
+
+            report = self._reporter(name, progress)
+            start = time.perf_counter()
+            with self._lock:
+                if self.device is None:
+                    report("importing torch")
+                    self.device = get_device()
+            precision = self.precision[name]
+            runtime = self.runtime[name]
+            backend = None
+            if precision == "int8":
+                # int8 is already the CPU-optimized eager path; exported graphs are fp32/bf16 only.
+                runtime = "eager"
+                backend = load_quantized(name, self.loaders[name], report, self.quantized_dir)
+            elif runtime != "eager":
+                import exported_models
+
+                try:
+                    backend = exported_models.load_exported(name, self.loaders[name], runtime, report,
+                                                            self.export_dir)
+                except Exception as e:
+                    report(f"{runtime} unavailable ({e}), running eagerly")
+                    runtime = "eager"
+            if backend is None:
+                backend = self.loaders[name](self.device, report)
+            backend["device"] = getattr(backend["model"], "device", self.device)
+            backend["name"] = name
+            backend["precision"] = precision
+            backend["runtime"] = runtime
+            self.timings[name]["load_seconds"] = time.perf_counter() - start
+            self.loaded[name] = backend
+            return backend
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return name in self.loaders
+
+    def record_call(self, name, seconds, image_count):
+        """
+        Record how long a predict call took.  The first call after a load is
+        kept as the cold-start figure, later ones are averaged as warm calls.
+        """
+        timings = self.timings[name]
+        if timings["cold_seconds"] is None:
+            timings["cold_seconds"] = seconds
+        else:
+            timings["warm_seconds"] += seconds
+            timings["warm_images"] += image_count
+
+    def timing_report(self, name):
+        timings = self.timings[name]
+        if timings["load_seconds"] is None:
+            return f"{name}: not loaded"
+        backend = self.loaded.get(name, {})
+        parts = [f"{name} ({self.precision[name]}, {backend.get('runtime', self.runtime[name])}): loaded in {timings['load_seconds']:.1f}s"]
+        if timings["cold_seconds"] is not None:
+            parts.append(f"first call {timings['cold_seconds']:.2f}s")
+        if timings["warm_images"]:
+            per_image = timings["warm_seconds"] / timings["warm_images"]
+            parts.append(f"warm {per_image:.2f}s/image")
+        return ", ".join(parts)
+
+
+def create_registry(device=None):
+    registry = ModelRegistry(device)
+    registry.register("VIT-GPT2", load_vit_gpt2)
+    registry.register("BLIP", load_blip)
+    return registry
+
+
+def available_memory(device):
+    """Free memory in bytes on `device`, or None if it can't be determined."""
+    if device.type == "cuda":
+        import torch
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    if sys.platform == "win32":
+        import ctypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def auto_batch_size(device, model_name, gen_kwargs):
+    """
+    Pick a batch size that fits in half of the currently free memory on
+    `device`, capped so CPU runs don't trade latency for nothing.
+    """
+    limit = MAX_BATCH_SIZE.get(device.type, MAX_BATCH_SIZE["cpu"])
+    memory = available_memory(device)
+    if memory is None:
+        return 4
+    beams = max(1, gen_kwargs.get("num_beams", 1))
+    per_image = MEMORY_PER_IMAGE.get(model_name, MEMORY_PER_IMAGE["BLIP"]) * beams / 4
+    return max(1, min(limit, int(memory / 2 / per_image)))
+
+
+def load_image(image_path):
+    return Image.open(image_path).convert("RGB")
+
+
+def try_load_image(image_path, errors):
+    """
+    load_image(), but an image that can't be read (missing, truncated, not
+    an image) is recorded in `errors` as {image_path: message} and None
+    returned, so one bad file doesn't stop a whole captioning run.
+    """
+    try:
+        return load_image(image_path)
+    except IMAGE_ERRORS as e:
+        errors[image_path] = f"{type(e).__name__}: {e}"
+        return None
+
+
+def preprocess(backend, model_name, image):
+    """Turn one RGB PIL image into a (1, 3, H, W) pixel_values tensor."""
+    if model_name == "VIT-GPT2":
+        image = image.resize((384, 384))
+    elif model_name != "BLIP":
+        raise KeyError(f"Unknown captioning model: {model_name}")
+    return backend["processor"](images=image, return_tensors="pt")["pixel_values"]
+
+
+def generate_ids(backend, model_name, pixel_values, gen_kwargs, device):
+    """Run one generate() call over a stacked batch of pixel_values."""
+    import torch
+
+    device = backend.get("device", device)
+    autocast = torch.autocast(device.type, dtype=torch.bfloat16, enabled=backend.get("precision") == "bf16")
+    with torch.no_grad(), autocast:
+        if model_name == "VIT-GPT2":
+            return backend["model"].generate(pixel_values=pixel_values.to(device), **gen_kwargs)
+        return backend["model"].generate(pixel_values=pixel_values.to(device))
+
+
+def encode_pixels(backend, model_name, pixel_values, device):
+    """
+    Run only the image encoder over a stacked batch of pixel_values and
+    return its output as a float32 CPU tensor, one row per image, for
+    generate_from_features().
+    """
+    import torch
+
+    device = backend.get("device", device)
+    model = backend["model"]
+    autocast = torch.autocast(device.type, dtype=torch.bfloat16, enabled=backend.get("precision") == "bf16")
+    with torch.no_grad(), autocast:
+        if backend.get("runtime", "eager") != "eager":
+            features = model.encode(pixel_values)
+        elif model_name == "VIT-GPT2":
+            features = model.encoder(pixel_values=pixel_values.to(device)).last_hidden_state
+        else:
+            features = model.vision_model(pixel_values=pixel_values.to(device))[0]
+    return features.float().cpu()
+
+
+def generate_from_features(backend, model_name, features, gen_kwargs, device):
+    """generate_ids() for images whose encoder output (from encode_pixels()) is already known."""
+    import torch
+
+    device = backend.get("device", device)
+    model = backend["model"]
+    autocast = torch.autocast(device.type, dtype=torch.bfloat16, enabled=backend.get("precision") == "bf16")
+    with torch.no_grad(), autocast:
+        features = features.to(device)
+        if backend.get("runtime", "eager") != "eager":
+            return model.generate(encoder_hidden_states=features,
+                                  **(gen_kwargs if model_name == "VIT-GPT2" else {}))
+        if model_name == "VIT-GPT2":
+            from transformers.modeling_outputs import BaseModelOutput
+
+            return model.generate(encoder_outputs=BaseModelOutput(last_hidden_state=features), **gen_kwargs)
+        # What BlipForConditionalGeneration.generate() does after running its vision model.
+        text_config = model.config.text_config
+        input_ids = torch.full((features.shape[0], 1), text_config.bos_token_id, dtype=torch.long, device=device)
+        attention_mask = torch.ones(features.shape[:-1], dtype=torch.long, device=device)
+        return model.text_decoder.generate(input_ids=input_ids, eos_token_id=text_config.sep_token_id,
+                                           pad_token_id=text_config.pad_token_id, attention_mask=None,
+                                           encoder_hidden_states=features, encoder_attention_mask=attention_mask)
+
+
+def feature_variant(backend, loader):
+    """Name under which FeatureCache keeps the encoder output of `backend`."""
+    import torch
+    import transformers
+
+    return (f"{backend['name']}|{backend['precision']}|{backend['runtime']}|{loader.__module__}.{loader.__qualname__}|"
+            f"{torch.__version__}|{transformers.__version__}")
+
+
+def decode_ids(backend, model_name, output):
+    captions = backend["tokenizer"].batch_decode(output, skip_special_tokens=True)
+    return [caption.strip() for caption in captions]
+
+
+def generate_batch(backend, model_name, images, gen_kwargs, device):
+    """Caption a list of RGB PIL images with a single generate() call."""
+    import torch
+
+    pixel_values = torch.cat([preprocess(backend, model_name, image) for image in images])
+    output = generate_ids(backend, model_name, pixel_values, gen_kwargs, device)
+    return decode_ids(backend, model_name, output)
+
+
+def predict_step(models, model_name, image_paths, gen_kwargs, batch_size=None):
+    """
+    Caption `image_paths`, running one batched generate() call per
+    `batch_size` images (all of them at once if no batch size is given).
+    If `models.server_address` is set and a caption server is listening
+    there, the server captions them instead; otherwise the model is loaded
+    and run in this process.
+    """
+    start = time.perf_counter()
+    if models.server_address is not None:
+        try:
+            with CaptionClient(models.server_address) as client:
+                return client.caption(model_name, image_paths, gen_kwargs, models.options(model_name))
+        except CaptionServerUnavailable:
+            pass
+    backend = models.get(model_name)
+    batch_size = batch_size or len(image_paths)
+
+    captions = []
+    for offset in range(0, len(image_paths), batch_size):
+        images = [load_image(image_path) for image_path in image_paths[offset:offset + batch_size]]
+        captions.extend(generate_batch(backend, model_name, images, gen_kwargs, models.device))
+
+    models.record_call(model_name, time.perf_counter() - start, len(image_paths))
+    return captions
+
+
+def default_server_address():
+    if hasattr(socket, "AF_UNIX"):
+        user = os.getuid() if hasattr(os, "getuid") else os.getlogin()
+        return os.path.join(tempfile.gettempdir(), f"j_captioneer-{user}.sock")
+    return ("127.0.0.1", CAPTION_SERVER_PORT)
+
+
+def server_address(text=None):
+    """
+    Parse a caption server address: "host:port" for TCP, anything else is a
+    Unix socket path.  Defaults to $J_CAPTIONEER_SERVER, then
+    default_server_address().
+    """
+    text = text or os.environ.get(CAPTION_SERVER_ENV)
+    if not text:
+        return default_server_address()
+    host, _, port = text.rpartition(":")
+    if host and port.isdigit() and os.sep not in text:
+        return (host, int(port))
+    return text
+
+
+class CaptionServerUnavailable(Exception):
+    """No caption server is listening at the address."""
+
+
+class CaptionClient:
+    """
+    One connection to caption_server.py.  Requests and responses are single
+    JSON lines.  Connecting raises CaptionServerUnavailable if no server is
+    running; errors the server reports are raised as RuntimeError.
+    """
+
+    def __init__(self, address=None):
+        self.address = address or server_address()
+        family = socket.AF_INET if isinstance(self.address, tuple) else socket.AF_UNIX
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(CAPTION_SERVER_CONNECT_TIMEOUT)
+        try:
+            self.socket.connect(self.address)
+        except OSError as e:
+            self.socket.close()
+            raise CaptionServerUnavailable(f"No caption server at {self.address}: {e}") from e
+        self.socket.settimeout(None)
+        self.file = self.socket.makefile("rwb")
+
+    def request(self, **message):
+        try:
+            self.file.write((json.dumps(message) + "\n").encode("utf-8"))
+            self.file.flush()
+            line = self.file.readline()
+        except OSError as e:
+            raise RuntimeError(f"Lost the connection to the caption server: {e}") from e
+        if not line:
+            raise RuntimeError("The caption server closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Caption server: {response['error']}")
+        return response
+
+    def ping(self):
+        """{"pid": ..., "loaded": [model names]} of the server."""
+        return self.request(op="ping")
+
+    def caption(self, model_name, image_paths, gen_kwargs, options=None, errors=None):
+        """
+        Captions of `image_paths`.  Images the server can't read get a None
+        caption and their error added to `errors`; without an `errors` dict
+        they raise RuntimeError instead.
+        """
+        options = {key: value for key, value in (options or {}).items() if key in ("precision", "runtime")}
+        paths = [os.path.abspath(image_path) for image_path in image_paths]
+        response = self.request(op="caption", model=model_name, gen_kwargs=gen_kwargs, options=options, images=paths)
+        failed = {image_path: response.get("errors", {})[path] for image_path, path in zip(image_paths, paths)
+                  if path in response.get("errors", {})}
+        if failed and errors is None:
+            image_path, message = next(iter(failed.items()))
+            raise RuntimeError(f"Caption server: {image_path}: {message}")
+        if errors is not None:
+            errors.update(failed)
+        return response["captions"]
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class StageTrace:
+    """
+    Timeline of one caption run: a JSON line per timed span with its stage,
+    start and duration (seconds since the trace was opened), item count and
+    the thread or process that did the work.  If `timeline_path` is given,
+    close() also writes the spans in the Chrome trace event format, which
+    chrome://tracing and https://ui.perfetto.dev open as a timeline.
+
+    Spans from worker processes use their own time.perf_counter(), which is
+    the same system-wide monotonic clock as this process's.
+    """
+
+    def __init__(self, path=CAPTION_TRACE_FILE, timeline_path=None):
+        self.path = path
+        self.timeline_path = timeline_path
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self.file = open(path, "w", encoding="utf-8")
+
+    def add(self, stage, start, seconds, items=1, worker=None):
+        event = {"stage": stage, "start": round(start - self.origin, 6), "seconds": round(seconds, 6),
+                 "items": items, "worker": worker or threading.current_thread().name}
+        with self._lock:
+            if not self.file.closed:
+                self.file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        with self._lock:
+            if self.file.closed:
+                return
+            self.file.close()
+        if self.timeline_path:
+            write_timeline(self.path, self.timeline_path)
+
+
+def write_timeline(trace_path, timeline_path):
+    """Convert a StageTrace file to Chrome trace event JSON, one timeline row per worker."""
+    workers = {}
+    events = []
+    with open(trace_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                span = json.loads(line)
+            except ValueError:
+                continue
+            row = workers.setdefault(span["worker"], len(workers) + 1)
+            events.append({"name": span["stage"], "ph": "X", "pid": 1, "tid": row,
+                           "ts": span["start"] * 1e6, "dur": span["seconds"] * 1e6,
+                           "args": {"items": span["items"]}})
+    for worker, row in workers.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": row, "args": {"name": worker}})
+    with open(timeline_path, "w", encoding="utf-8") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+class StageStats:
+    """
+    Busy time and item counts for each stage of a caption run, and the
+    recent completion rate for throughput and ETA.  Spans are also written
+    to `trace` (a StageTrace) if one is given.
+    """
+
+    RATE_WINDOW = 30.0
+    IDLE_STAGES = ("waiting for input", "load")
+
+    def __init__(self, stages, trace=None):
+        self.stages = list(stages)
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+        self.items = dict.fromkeys(self.stages, 0)
+        self.completed = 0
+        self.started = time.perf_counter()
+        self.finished = None
+        self.trace = trace
+        self.recent = deque()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, items=1, start=None, worker=None):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.items[stage] += items
+        if self.trace is not None:
+            if start is None:
+                start = time.perf_counter() - seconds
+            self.trace.add(stage, start, seconds, items, worker)
+
+    def begin(self):
+        """Mark where captioning proper starts (after loading); rate() counts from here."""
+        with self._lock:
+            self.recent.clear()
+            self.recent.append((time.perf_counter(), self.completed))
+
+    def complete(self, items):
+        now = time.perf_counter()
+        with self._lock:
+            self.completed += items
+            self.recent.append((now, self.completed))
+            while len(self.recent) > 2 and now - self.recent[1][0] > self.RATE_WINDOW:
+                self.recent.popleft()
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def throughput(self, stage):
+        """Items per second of busy time spent in `stage`."""
+        if not self.seconds[stage]:
+            return None
+        return self.items[stage] / self.seconds[stage]
+
+    def rate(self):
+        """Images completed per second over roughly the last RATE_WINDOW seconds, or None if unknown yet."""
+        with self._lock:
+            if len(self.recent) < 2:
+                return None
+            (first_time, first_count), (last_time, last_count) = self.recent[0], self.recent[-1]
+        if last_time <= first_time or last_count == first_count:
+            return None
+        return (last_count - first_count) / (last_time - first_time)
+
+    def eta(self, remaining):
+        """Seconds until `remaining` more images are done at the current rate, or None."""
+        rate = self.rate()
+        if rate is None:
+            return None
+        return remaining / rate
+
+    def busiest(self):
+        """The working stage that has taken the most time so far."""
+        stages = [stage for stage in self.stages if stage not in self.IDLE_STAGES and self.seconds[stage]]
+        return max(stages, key=self.seconds.get, default=None)
+
+    def report(self):
+        lines = []
+        for stage in self.stages:
+            if not self.seconds[stage] and not self.items[stage]:
+                continue
+            rate = self.throughput(stage)
+            if self.items[stage] and rate is not None:
+                lines.append(f"{stage}: {self.items[stage]} in {self.seconds[stage]:.2f}s ({rate:.1f}/s)")
+            else:
+                lines.append(f"{stage}: {self.seconds[stage]:.2f}s")
+        elapsed = self.elapsed()
+        if self.completed and elapsed:
+            lines.append(f"total: {self.completed} in {elapsed:.2f}s ({self.completed / elapsed:.1f}/s)")
+        return "\n".join(lines)
+
+
+class CaptionPipeline:
+    """
+    Caption a list of images while the next batches are decoded and
+    preprocessed ahead of the model.
+
+    A producer thread hands single images to a pool of decode workers (PIL
+    releases the GIL while decoding), stacks their pixel_values into batches
+    and puts them on a bounded queue.  run() takes batches off the queue and
+    calls generate(), so decoding overlaps generation and at most
+    `prefetch_batches` batches are held in memory.  "waiting for input" in
+    the stats is time the model spent starved.
+
+    With a `feature_cache` (a FeatureCache), images whose encoder output is
+    cached aren't decoded at all; the encoder only runs for the others, and
+    "generate" is the text decoder alone.
+
+    Images that can't be read get a None caption, and the reason in
+    `errors` as {image_path: message}; the others are captioned as usual.
+    """
+
+    STAGES = ("cache lookup", "feature lookup", "decode", "preprocess", "waiting for input", "encode", "generate",
+              "token decode", "write")
+
+    def __init__(self, models, model_name, gen_kwargs, batch_size=0, decode_workers=None, prefetch_batches=2,
+                 trace=None, feature_cache=None):
+        self.models = models
+        self.model_name = model_name
+        self.gen_kwargs = gen_kwargs
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers or max(1, min(4, (os.cpu_count() or 2) // 2))
+        self.prefetch_batches = prefetch_batches
+        self.feature_cache = feature_cache
+        self.errors = {}
+        self.stats = StageStats(self.STAGES, trace)
+
+    def _prepare(self, backend, image_path):
+        start = time.perf_counter()
+        image = try_load_image(image_path, self.errors)
+        if image is None:
+            return None
+        decoded = time.perf_counter()
+        pixel_values = preprocess(backend, self.model_name, image)
+        self.stats.add("decode", decoded - start, 1, start)
+        self.stats.add("preprocess", time.perf_counter() - decoded, 1, decoded)
+        return pixel_values
+
+    def _stack(self, tensors):
+        import torch
+
+        return torch.cat(tensors)
+
+    def _produce(self, backend, image_paths, batches, stop, variant=None):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.decode_workers) as executor:
+                for offset in range(0, len(image_paths), self.batch_size):
+                    batch = image_paths[offset:offset + self.batch_size]
+                    features = [None] * len(batch)
+                    if variant is not None:
+                        start = time.perf_counter()
+                        features = [self.feature_cache.get(variant, path) for path in batch]
+                        self.stats.add("feature lookup", time.perf_counter() - start, len(batch), start)
+                    missing = [path for path, feature in zip(batch, features) if feature is None]
+                    tensors = list(executor.map(lambda path: self._prepare(backend, path), missing))
+                    failed = {path for path, tensor in zip(missing, tensors) if tensor is None}
+                    tensors = [tensor for tensor in tensors if tensor is not None]
+                    if not put((batch, failed, self._stack(tensors) if tensors else None, features, None)):
+                        return
+        except Exception as e:
+            put((None, None, None, None, e))
+            return
+        put(None)
+
+    def run(self, image_paths, progress=None):
+        """
+        Yield (image_paths, captions) for each batch, in input order.  The
+        model is loaded first if needed, reporting through `progress`, and a
+        batch size of 0 is replaced by auto_batch_size() once it is loaded.
+        """
+        backend = self.models.get(self.model_name, progress=progress)
+        device = backend["device"]
+        if not self.batch_size:
+            self.batch_size = auto_batch_size(device, self.model_name, self.gen_kwargs)
+        variant = None
+        if self.feature_cache is not None:
+            variant = feature_variant(backend, self.models.loaders[self.model_name])
+        batches = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(backend, image_paths, batches, stop, variant),
+                                    daemon=True)
+        self.stats.begin()
+        producer.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.stats.add("waiting for input", time.perf_counter() - start, 0, start)
+                if item is None:
+                    break
+                batch, failed, pixel_values, features, error = item
+                if error is not None:
+                    raise error
+
+                readable = [index for index, path in enumerate(batch) if path not in failed]
+                captions = [None] * len(batch)
+                if readable:
+                    start = time.perf_counter()
+                    if variant is None:
+                        output = generate_ids(backend, self.model_name, pixel_values, self.gen_kwargs, device)
+                        generated = time.perf_counter()
+                        self.stats.add("generate", generated - start, len(readable), start)
+                    else:
+                        output = self._generate_from_cache(backend, device, variant,
+                                                           [batch[index] for index in readable], pixel_values,
+                                                           [features[index] for index in readable])
+                        generated = time.perf_counter()
+                    for index, caption in zip(readable, decode_ids(backend, self.model_name, output)):
+                        captions[index] = caption
+                    self.stats.add("token decode", time.perf_counter() - generated, len(readable), generated)
+                    self.models.record_call(self.model_name, time.perf_counter() - start, len(readable))
+                self.stats.complete(len(batch))
+                yield batch, captions
+        finally:
+            stop.set()
+            producer.join()
+            self.stats.finish()
+
+    def _generate_from_cache(self, backend, device, variant, batch, pixel_values, features):
+        """Encode the images missing from the feature cache, store them, then decode the whole batch."""
+        import torch
+
+        if pixel_values is not None:
+            start = time.perf_counter()
+            encoded = encode_pixels(backend, self.model_name, pixel_values, device)
+            self.stats.add("encode", time.perf_counter() - start, len(encoded), start)
+            missing = [index for index, feature in enumerate(features) if feature is None]
+            for index, feature in zip(missing, encoded):
+                self.feature_cache.put(variant, batch[index], feature)
+                features[index] = feature
+            self.feature_cache.flush()
+        start = time.perf_counter()
+        output = generate_from_features(backend, self.model_name, torch.stack(features), self.gen_kwargs, device)
+        self.stats.add("generate", time.perf_counter() - start, len(batch), start)
+        return output
+
+
+class MultiModelPipeline(CaptionPipeline):
+    """
+    Caption images with several models in one pass.  Each image is decoded
+    once and preprocessed for every model, ahead of the models as in
+    CaptionPipeline.  On a GPU the models generate concurrently; on the CPU
+    one after the other, since each generate() call already uses every core.
+    run() yields (image_paths, {model name: captions}) for each batch, with
+    None captions for images that can't be read.
+    """
+
+    STAGES = ("cache lookup", "decode", "preprocess", "waiting for input", "generate", "token decode", "write")
+
+    def __init__(self, models, model_names, gen_kwargs, batch_size=0, decode_workers=None, prefetch_batches=2,
+                 trace=None):
+        super().__init__(models, MODEL_SEPARATOR.join(model_names), gen_kwargs, batch_size, decode_workers,
+                         prefetch_batches, trace)
+        self.model_names = list(model_names)
+
+    def _prepare(self, backends, image_path):
+        start = time.perf_counter()
+        image = try_load_image(image_path, self.errors)
+        if image is None:
+            return None
+        decoded = time.perf_counter()
+        pixel_values = {model_name: preprocess(backend, model_name, image) for model_name, backend in backends.items()}
+        self.stats.add("decode", decoded - start, 1, start)
+        self.stats.add("preprocess", time.perf_counter() - decoded, 1, decoded)
+        return pixel_values
+
+    def _stack(self, tensors):
+        import torch
+
+        return {model_name: torch.cat([pixel_values[model_name] for pixel_values in tensors])
+                for model_name in self.model_names}
+
+    def _generate(self, backend, model_name, pixel_values):
+        start = time.perf_counter()
+        output = generate_ids(backend, model_name, pixel_values, self.gen_kwargs, backend["device"])
+        generated = time.perf_counter()
+        captions = decode_ids(backend, model_name, output)
+        self.stats.add("generate", generated - start, len(pixel_values), start)
+        self.stats.add("token decode", time.perf_counter() - generated, len(pixel_values), generated)
+        self.models.record_call(model_name, time.perf_counter() - start, len(pixel_values))
+        return captions
+
+    def run(self, image_paths, progress=None):
+        backends = {model_name: self.models.get(model_name, progress=progress) for model_name in self.model_names}
+        if not self.batch_size:
+            self.batch_size = min(auto_batch_size(backend["device"], model_name, self.gen_kwargs)
+                                  for model_name, backend in backends.items())
+        concurrent = any(backend["device"].type == "cuda" for backend in backends.values())
+        executor = ThreadPoolExecutor(max_workers=len(backends)) if concurrent else None
+        batches = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(backends, image_paths, batches, stop), daemon=True)
+        self.stats.begin()
+        producer.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.stats.add("waiting for input", time.perf_counter() - start, 0, start)
+                if item is None:
+                    break
+                batch, failed, pixel_values, _, error = item
+                if error is not None:
+                    raise error
+
+                readable = [index for index, path in enumerate(batch) if path not in failed]
+                generated = {}
+                if readable and executor is not None:
+                    futures = {model_name: executor.submit(self._generate, backend, model_name,
+                                                           pixel_values[model_name])
+                               for model_name, backend in backends.items()}
+                    generated = {model_name: future.result() for model_name, future in futures.items()}
+                elif readable:
+                    generated = {model_name: self._generate(backend, model_name, pixel_values[model_name])
+                                 for model_name, backend in backends.items()}
+                captions = {model_name: [None] * len(batch) for model_name in self.model_names}
+                for model_name, model_captions in generated.items():
+                    for index, caption in zip(readable, model_captions):
+                        captions[model_name][index] = caption
+                self.stats.complete(len(batch))
+                yield batch, captions
+        finally:
+            stop.set()
+            producer.join()
+            if executor is not None:
+                executor.shutdown()
+            self.stats.finish()
+
+
+class RemoteCaptionPipeline:
+    """
+    Same interface as CaptionPipeline, but every batch is captioned by a
+    running caption server, which keeps the models loaded between sessions
+    and batches requests from all its clients together.  Raises
+    CaptionServerUnavailable from the constructor if there is none.
+    """
+
+    STAGES = ("cache lookup", "server", "write")
+
+    def __init__(self, models, model_name, gen_kwargs, batch_size=0, address=None, trace=None):
+        self.models = models
+        self.model_name = model_name
+        self.gen_kwargs = gen_kwargs
+        self.batch_size = batch_size or MAX_BATCH_SIZE["cpu"]
+        self.client = CaptionClient(address or models.server_address)
+        self.errors = {}
+        self.stats = StageStats(self.STAGES, trace)
+
+    def run(self, image_paths, progress=None):
+        if progress is not None:
+            progress(f"Captioning with {self.model_name} on the caption server at {self.client.address}...")
+        self.stats.begin()
+        try:
+            for offset in range(0, len(image_paths), self.batch_size):
+                batch = image_paths[offset:offset + self.batch_size]
+                start = time.perf_counter()
+                captions = self.client.caption(self.model_name, batch, self.gen_kwargs,
+                                               self.models.options(self.model_name), self.errors)
+                self.stats.add("server", time.perf_counter() - start, len(batch), start)
+                self.stats.complete(len(batch))
+                yield batch, captions
+        finally:
+            self.client.close()
+            self.stats.finish()
+
+
+def create_pipeline(models, model_name, gen_kwargs, batch_size=0, workers=0, threads_per_worker=None, trace=None,
+                    feature_cache=None):
+    """
+    The pipeline to caption with: the caption server if `models.server_address`
+    is set and one is running there, else worker processes if `workers`,
+    else CaptionPipeline in this process.  Only CaptionPipeline uses the
+    `feature_cache`.  Several models (see split_models()) are always run
+    in this process by a MultiModelPipeline.
+    """
+    model_names = split_models(model_name)
+    if len(model_names) > 1:
+        return MultiModelPipeline(models, model_names, gen_kwargs, batch_size, trace=trace)
+    if models.server_address is not None:
+        try:
+            return RemoteCaptionPipeline(models, model_name, gen_kwargs, batch_size, trace=trace)
+        except CaptionServerUnavailable:
+            pass
+    if workers:
+        return ProcessCaptionPool(models, model_name, gen_kwargs, batch_size, workers, threads_per_worker,
+                                  trace=trace)
+    return CaptionPipeline(models, model_name, gen_kwargs, batch_size, trace=trace, feature_cache=feature_cache)
+
+
+def caption_process(loader, model_name, options, gen_kwargs, threads, tasks, results):
+    """Entry point of a ProcessCaptionPool worker process."""
+    import torch
+
+    try:
+        torch.set_num_threads(threads)
+        models = ModelRegistry(torch.device("cpu"), options["quantized_dir"], options["export_dir"])
+        models.register(model_name, loader, options["precision"], options["runtime"])
+        start = time.perf_counter()
+        backend = models.get(model_name)
+        results.put(("loaded", os.getpid(), start, time.perf_counter() - start))
+
+        while True:
+            batch = tasks.get()
+            if batch is None:
+                break
+            # (stage, start, seconds, items) for the parent's StageStats.
+            spans = []
+            tensors = []
+            errors = {}
+            readable = []
+            for index, image_path in enumerate(batch):
+                start = time.perf_counter()
+                image = try_load_image(image_path, errors)
+                if image is None:
+                    continue
+                decoded = time.perf_counter()
+                tensors.append(preprocess(backend, model_name, image))
+                readable.append(index)
+                spans.append(("decode", start, decoded - start, 1))
+                spans.append(("preprocess", decoded, time.perf_counter() - decoded, 1))
+
+            captions = [None] * len(batch)
+            if readable:
+                start = time.perf_counter()
+                output = generate_ids(backend, model_name, torch.cat(tensors), gen_kwargs, models.device)
+                generated = time.perf_counter()
+                for index, caption in zip(readable, decode_ids(backend, model_name, output)):
+                    captions[index] = caption
+                spans.append(("generate", start, generated - start, len(readable)))
+                spans.append(("token decode", generated, time.perf_counter() - generated, len(readable)))
+            results.put(("captions", os.getpid(), batch, captions, spans, errors))
+    except Exception as e:
+        results.put(("error", f"{type(e).__name__}: {e}"))
+
+
+class ProcessCaptionPool:
+    """
+    Caption images with several CPU worker processes, each holding its own
+    copy of the model and a share of the CPU threads.  This scales past the
+    point where torch's intra-op threading and the GIL stop helping a single
+    model.
+
+    Same interface as CaptionPipeline: run() yields (image_paths, captions)
+    per batch, in completion order rather than input order, with a None
+    caption for each image in `errors`.
+    """
+
+    STAGES = ("cache lookup", "load", "decode", "preprocess", "generate", "token decode", "write")
+
+    def __init__(self, models, model_name, gen_kwargs, batch_size=0, workers=2, threads_per_worker=None,
+                 trace=None):
+        self.models = models
+        self.model_name = model_name
+        self.gen_kwargs = gen_kwargs
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers)
+        self.errors = {}
+        self.stats = StageStats(self.STAGES, trace)
+        self.ready_at = None
+
+    def run(self, image_paths, progress=None):
+        import torch
+
+        if not image_paths:
+            return
+        if not self.batch_size:
+            self.batch_size = max(1, auto_batch_size(torch.device("cpu"), self.model_name, self.gen_kwargs) // self.workers)
+
+        context = multiprocessing.get_context("spawn")
+        tasks = context.Queue()
+        results = context.Queue()
+        for offset in range(0, len(image_paths), self.batch_size):
+            tasks.put(image_paths[offset:offset + self.batch_size])
+        for _ in range(self.workers):
+            tasks.put(None)
+
+        self.models.prepare(self.model_name, progress)
+        loader = self.models.loaders[self.model_name]
+        processes = [context.Process(target=caption_process, daemon=True,
+                                     args=(loader, self.model_name, self.models.options(self.model_name),
+                                           self.gen_kwargs, self.threads_per_worker, tasks, results))
+                     for _ in range(self.workers)]
+        for process in processes:
+            process.start()
+        if progress is not None:
+            progress(f"Loading {self.model_name}: starting {self.workers} worker processes...")
+
+        remaining = len(image_paths)
+        loaded = 0
+        try:
+            while remaining:
+                try:
+                    message = results.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(process.is_alive() for process in processes):
+                        raise RuntimeError("Caption worker processes exited unexpectedly")
+                    continue
+
+                if message[0] == "error":
+                    raise RuntimeError(message[1])
+                if message[0] == "loaded":
+                    _, pid, start, seconds = message
+                    loaded += 1
+                    self.stats.add("load", seconds, 1, start, f"process {pid}")
+                    if loaded == self.workers:
+                        self.ready_at = time.perf_counter()
+                        self.stats.begin()
+                    if progress is not None:
+                        progress(f"Loading {self.model_name}: {loaded}/{self.workers} worker processes ready...")
+                    continue
+
+                _, pid, batch, captions, spans, errors = message
+                self.errors.update(errors)
+                for stage, start, seconds, items in spans:
+                    self.stats.add(stage, seconds, items, start, f"process {pid}")
+                self.stats.complete(len(batch))
+                remaining -= len(batch)
+                yield batch, captions
+        finally:
+            for process in processes:
+                if remaining:
+                    process.terminate()
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.kill()
+            tasks.cancel_join_thread()
+            self.stats.finish()
@@ -0,0 +1,499 @@
+"""Exported captioning backends for J_Captioneer.
+
+A model is exported once into three graphs, the way optimum lays out
+encoder-decoder models: the image encoder, the first decoder step and the
+decoder step that continues from the cached attention keys and values.  The
+generation loop (greedy or beam search, matching transformers' generate())
+then runs against those graphs, so later sessions never build the eager
+transformers model at all.
+
+Two graph formats are supported: torch.export programs (.pt2), which only
+need torch, and ONNX files run by onnxruntime, which has to be installed
+separately.  Keep this module free of any PyQt5 imports.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+from PIL import Image
+
+import captioning
+from captioning import EXPORT_DIR
+
+GRAPH_EXTENSIONS = {"torch.export": ".pt2", "onnxruntime": ".onnx"}
+# Longest caption, in tokens, the exported decoder accepts.
+MAX_DECODER_POSITIONS = 256
+# generate() options the exported loop doesn't implement, with the value that makes them a no-op.
+UNSUPPORTED_GENERATION_OPTIONS = {
+    "do_sample": False, "min_length": 0, "min_new_tokens": None, "no_repeat_ngram_size": 0,
+    "repetition_penalty": 1.0, "bad_words_ids": None, "forced_bos_token_id": None,
+    "forced_eos_token_id": None, "suppress_tokens": None, "begin_suppress_tokens": None,
+    "num_return_sequences": 1, "diversity_penalty": 0.0, "num_beam_groups": 1,
+}
+
+
+def export_path(directory, name, loader, runtime):
+    import torch
+    import transformers
+
+    identity = (f"{loader.__module__}.{loader.__qualname__}|{runtime}|"
+                f"{torch.__version__}|{transformers.__version__}")
+    safe_name = "".join(character if character.isalnum() else "_" for character in name)
+    return os.path.join(directory, f"{safe_name}-{runtime.replace('.', '_')}-"
+                                   f"{hashlib.sha1(identity.encode()).hexdigest()[:12]}")
+
+
+def flatten_cache(cache):
+    """Self-attention keys and values of every layer, then the cross-attention ones."""
+    tensors = []
+    for layers in (cache.self_attention_cache.layers, cache.cross_attention_cache.layers):
+        for layer in layers:
+            tensors += [layer.keys, layer.values]
+    return tuple(tensors)
+
+
+def cache_from_tensors(tensors):
+    """
+    A DynamicCache holding `tensors` (keys, values, keys, values, ...) as they
+    are.  Passing them to DynamicCache() would copy every one of them.
+    """
+    from transformers.cache_utils import DynamicCache
+
+    cache = DynamicCache(ddp_cache_data=[(None, None)] * (len(tensors) // 2))
+    for layer, keys, values in zip(cache.layers, tensors[0::2], tensors[1::2]):
+        layer.lazy_initialization(keys, values)
+        layer.keys, layer.values = keys, values
+    return cache
+
+
+def decoding_parts(model):
+    """
+    The encoder, decoder and generation settings of a transformers captioning
+    model, covering VisionEncoderDecoderModel (VIT-GPT2) and
+    BlipForConditionalGeneration (BLIP).
+    """
+    if hasattr(model, "text_decoder"):
+        text_config = model.config.text_config
+        generation_config = model.text_decoder.generation_config
+        encoder, decoder = model.vision_model, model.text_decoder
+        tokens = {"start_token_id": text_config.bos_token_id, "eos_token_id": text_config.sep_token_id,
+                  "pad_token_id": text_config.pad_token_id}
+        projection = None
+    elif hasattr(model, "encoder") and hasattr(model, "decoder"):
+        generation_config = model.generation_config
+        encoder, decoder = model.encoder, model.decoder
+        tokens = {"start_token_id": generation_config.decoder_start_token_id or model.config.decoder_start_token_id,
+                  "eos_token_id": generation_config.eos_token_id, "pad_token_id": generation_config.pad_token_id}
+        projection = None
+        if (encoder.config.hidden_size != decoder.config.hidden_size
+                and decoder.config.cross_attention_hidden_size is None):
+            projection = model.enc_to_dec_proj
+    else:
+        raise ValueError(f"Can't export {type(model).__name__}: not an image captioning model")
+
+    if isinstance(tokens["eos_token_id"], (list, tuple)):
+        tokens["eos_token_id"] = tokens["eos_token_id"][0]
+    for option, default in UNSUPPORTED_GENERATION_OPTIONS.items():
+        value = getattr(generation_config, option, default)
+        if value not in (default, None):
+            raise ValueError(f"Can't export: generate() option {option}={value!r} isn't supported")
+
+    # Like generate(): without a configured length, 20 tokens after the start token.
+    if generation_config.max_new_tokens is not None:
+        max_length = generation_config.max_new_tokens + 1
+    else:
+        max_length = generation_config.max_length or 21
+    settings = dict(tokens)
+    settings.update(max_length=max_length, num_beams=generation_config.num_beams or 1,
+                    length_penalty=1.0 if generation_config.length_penalty is None
+                    else generation_config.length_penalty,
+                    early_stopping=generation_config.early_stopping or False)
+    return encoder, projection, decoder, settings
+
+
+def graph_modules(model):
+    """torch modules for the three exported graphs."""
+    import torch
+
+    encoder, projection, decoder, settings = decoding_parts(model)
+
+    class Encoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.encoder = encoder
+            self.projection = projection
+
+        def forward(self, pixel_values):
+            hidden_states = self.encoder(pixel_values=pixel_values).last_hidden_state
+            if self.projection is not None:
+                hidden_states = self.projection(hidden_states)
+            return hidden_states
+
+    class DecoderInit(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.decoder = decoder
+
+        def forward(self, input_ids, encoder_hidden_states):
+            output = self.decoder(input_ids=input_ids, encoder_hidden_states=encoder_hidden_states,
+                                  use_cache=True, return_dict=True)
+            return (output.logits[:, -1, :],) + flatten_cache(output.past_key_values)
+
+    class DecoderStep(torch.nn.Module):
+        def __init__(self, layers):
+            super().__init__()
+            self.decoder = decoder
+            self.layers = layers
+
+        def forward(self, input_ids, encoder_hidden_states, past):
+            from transformers.cache_utils import EncoderDecoderCache
+
+            layers = self.layers
+            cache = EncoderDecoderCache(cache_from_tensors(past[:2 * layers]), cache_from_tensors(past[2 * layers:]))
+            for layer in range(layers):
+                cache.is_updated[layer] = True
+            output = self.decoder(input_ids=input_ids, encoder_hidden_states=encoder_hidden_states,
+                                  past_key_values=cache, use_cache=True, return_dict=True)
+            return (output.logits[:, -1, :],) + flatten_cache(output.past_key_values)[:2 * layers]
+
+    return Encoder().eval(), DecoderInit().eval(), DecoderStep, settings
+
+
+def sample_pixel_values(backend, model_name):
+    """Two synthetic images run through the model's own preprocessing."""
+    import torch
+
+    gradient = Image.linear_gradient("L").resize((384, 384)).convert("RGB")
+    noise = Image.effect_noise((384, 384), 64).convert("RGB")
+    return torch.cat([captioning.preprocess(backend, model_name, image) for image in (gradient, noise)])
+
+
+def graph_input_names(graph_name, layers):
+    if graph_name == "encoder":
+        return ["pixel_values"]
+    names = ["input_ids", "encoder_hidden_states"]
+    if graph_name == "decoder_step":
+        names += [f"past_{index}" for index in range(4 * layers)]
+    return names
+
+
+def export_graphs(model, pixel_values, runtime, directory, report):
+    """Write the encoder and decoder graphs of `model` to `directory` and return the generation settings."""
+    import torch
+    import torch.fx.experimental._config as fx_config
+
+    encoder, decoder_init, decoder_step_class, settings = graph_modules(model)
+    extension = GRAPH_EXTENSIONS[runtime]
+    batch = torch.export.Dim("batch", min=1, max=1024)
+    positions = getattr(model.config, "text_config", None) or model.config.decoder
+    positions = getattr(positions, "n_positions", None) or getattr(positions, "max_position_embeddings", 512)
+    past_length = torch.export.Dim("past", min=1, max=min(MAX_DECODER_POSITIONS, positions) - 1)
+
+    with torch.no_grad():
+        hidden_states = encoder(pixel_values)
+        input_ids = torch.full((pixel_values.shape[0], 1), settings["start_token_id"], dtype=torch.long)
+        first = decoder_init(input_ids, hidden_states)
+        layers = (len(first) - 1) // 4
+        decoder_step = decoder_step_class(layers).eval()
+        # Sizes of 0 and 1 get specialized by export, so trace the step with two cached positions.
+        second = decoder_step(input_ids, hidden_states, first[1:])
+        past = second[1:] + first[1 + 2 * layers:]
+    past_shapes = tuple([{0: batch, 2: past_length}] * (2 * layers) + [{0: batch}] * (2 * layers))
+    graphs = [
+        ("encoder", encoder, (pixel_values,), ({0: batch},)),
+        ("decoder_init", decoder_init, (input_ids, hidden_states), ({0: batch}, {0: batch})),
+        ("decoder_step", decoder_step, (input_ids, hidden_states, past), ({0: batch}, {0: batch}, past_shapes)),
+    ]
+    for graph_name, module, args, dynamic_shapes in graphs:
+        report(f"exporting {graph_name.replace('_', ' ')}")
+        path = os.path.join(directory, graph_name + extension)
+        with torch.no_grad(), fx_config.patch(backed_size_oblivious=True):
+            if runtime == "onnxruntime":
+                torch.onnx.export(module, args, path, dynamo=True, dynamic_shapes=dynamic_shapes,
+                                  input_names=graph_input_names(graph_name, layers), external_data=True)
+            else:
+                torch.export.save(torch.export.export(module, args, dynamic_shapes=dynamic_shapes), path)
+    settings["layers"] = layers
+    settings["max_positions"] = past_length.max + 1
+    return settings
+
+
+class OnnxGraph:
+    """An onnxruntime session called like the torch.export graph it replaces."""
+
+    def __init__(self, path, input_names):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = input_names
+        # The exporter drops inputs the graph doesn't use.
+        self.used_names = {graph_input.name for graph_input in self.session.get_inputs()}
+
+    def __call__(self, *inputs):
+        import torch
+
+        arrays = []
+        for value in inputs:
+            arrays.extend(value if isinstance(value, (tuple, list)) else [value])
+        feed = {name: array.numpy() for name, array in zip(self.input_names, arrays) if name in self.used_names}
+        outputs = tuple(torch.from_numpy(output) for output in self.session.run(None, feed))
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+class ExportedCaptioner:
+    """
+    Stand-in for a transformers captioning model that only offers generate(),
+    running greedy or beam search over the exported graphs.
+    """
+
+    def __init__(self, encoder, decoder_init, decoder_step, settings):
+        import torch
+
+        self.encoder = encoder
+        self.decoder_init = decoder_init
+        self.decoder_step = decoder_step
+        self.settings = settings
+        self.layers = settings["layers"]
+        self.device = torch.device("cpu")
+
+    def encode(self, pixel_values):
+        import torch
+
+        with torch.no_grad():
+            return self.encoder(pixel_values.cpu())
+
+    def generate(self, pixel_values=None, max_length=None, num_beams=None, length_penalty=None, early_stopping=None,
+                 encoder_hidden_states=None):
+        """Caption `pixel_values`, or images whose encode() output is `encoder_hidden_states`."""
+        import torch
+
+        settings = self.settings
+        max_length = max_length or settings["max_length"]
+        num_beams = num_beams or settings["num_beams"]
+        length_penalty = settings["length_penalty"] if length_penalty is None else length_penalty
+        early_stopping = settings["early_stopping"] if early_stopping is None else early_stopping
+        if max_length > settings["max_positions"]:
+            raise ValueError(f"max_length {max_length} is longer than the exported decoder allows "
+                             f"({settings['max_positions']})")
+
+        with torch.no_grad():
+            if encoder_hidden_states is None:
+                hidden_states = self.encoder(pixel_values.cpu())
+            else:
+                hidden_states = encoder_hidden_states.cpu()
+            if num_beams == 1:
+                return self._greedy(hidden_states, max_length)
+            return self._beam_search(hidden_states, max_length, num_beams, length_penalty, early_stopping)
+
+    def _step(self, input_ids, hidden_states, self_attention, cross_attention):
+        output = self.decoder_step(input_ids, hidden_states, tuple(self_attention) + tuple(cross_attention))
+        return output[0], output[1:]
+
+    def _greedy(self, hidden_states, max_length):
+        import torch
+
+        settings = self.settings
+        eos, pad = settings["eos_token_id"], settings["pad_token_id"]
+        pad = eos if pad is None else pad
+        input_ids = torch.full((hidden_states.shape[0], 1), settings["start_token_id"], dtype=torch.long)
+        output = self.decoder_init(input_ids, hidden_states)
+        logits, self_attention = output[0], output[1:1 + 2 * self.layers]
+        cross_attention = output[1 + 2 * self.layers:]
+        unfinished = torch.ones(input_ids.shape[0], dtype=torch.bool)
+        while True:
+            tokens = torch.where(unfinished, logits.float().argmax(dim=-1), pad)
+            input_ids = torch.cat([input_ids, tokens[:, None]], dim=-1)
+            unfinished &= ~((tokens == eos) | (input_ids.shape[1] >= max_length))
+            if not unfinished.any():
+                return input_ids
+            logits, self_attention = self._step(tokens[:, None], hidden_states, self_attention, cross_attention)
+
+    def _beam_search(self, hidden_states, max_length, num_beams, length_penalty, early_stopping):
+        """Beam search with the same scoring and stopping rules as transformers' generate()."""
+        import torch
+
+        settings = self.settings
+        eos, pad = settings["eos_token_id"], settings["pad_token_id"]
+        batch_size = hidden_states.shape[0]
+        keep = 2 * num_beams
+
+        fill = pad if pad else eos
+        running = torch.full((batch_size, num_beams, max_length), fill, dtype=torch.long)
+        running[:, :, 0] = settings["start_token_id"]
+        sequences = running.clone()
+        lengths = torch.ones((batch_size, num_beams), dtype=torch.long)
+        running_scores = torch.zeros((batch_size, num_beams))
+        running_scores[:, 1:] = -1e9
+        scores = torch.full((batch_size, num_beams), -1e9)
+        finished = torch.zeros((batch_size, num_beams), dtype=torch.bool)
+        improvable = torch.ones((batch_size, 1), dtype=torch.bool)
+        top_beams = torch.cat([torch.ones(num_beams, dtype=torch.bool), torch.zeros(keep - num_beams, dtype=torch.bool)])
+        batch_offsets = torch.arange(batch_size)[:, None] * num_beams
+
+        # Every beam starts from the same token, so the first step (which also
+        # projects the encoder states for cross-attention) runs once per image.
+        output = self.decoder_init(running[:, 0, :1], hidden_states)
+        output = [tensor.repeat_interleave(num_beams, dim=0) for tensor in output]
+        hidden_states = hidden_states.repeat_interleave(num_beams, dim=0)
+        logits, self_attention = output[0], output[1:1 + 2 * self.layers]
+        cross_attention = output[1 + 2 * self.layers:]
+        length = 1
+        while True:
+            log_probs = torch.log_softmax(logits.float(), dim=-1)
+            vocab_size = log_probs.shape[-1]
+            log_probs = log_probs.view(batch_size, num_beams, vocab_size) + running_scores[:, :, None]
+            topk_scores, topk_indices = torch.topk(log_probs.view(batch_size, -1), k=keep)
+            topk_beams = topk_indices // vocab_size
+            topk_sequences = torch.take_along_dim(running, topk_beams[:, :, None], dim=1)
+            topk_sequences[:, :, length] = topk_indices % vocab_size
+            stopped = (topk_sequences[:, :, length] == eos) | (length + 1 >= max_length)
+
+            # Beams that keep running: the best `num_beams` candidates that didn't stop.
+            running_candidates = topk_scores + stopped.to(torch.float32) * -1.0e9
+            next_beams = torch.topk(running_candidates, k=num_beams)[1]
+            running = torch.take_along_dim(topk_sequences, next_beams[:, :, None], dim=1)
+            running_scores = torch.take_along_dim(running_candidates, next_beams, dim=1)
+            source_beams = torch.take_along_dim(topk_beams, next_beams, dim=1)
+
+            # Finished hypotheses: merge the ones that just stopped into the best `num_beams` so far.
+            just_finished = stopped & top_beams[None, :]
+            finished_scores = topk_scores / (length ** length_penalty)
+            batch_full = torch.all(finished, dim=-1, keepdim=True) & (early_stopping is True)
+            finished_scores += batch_full.to(torch.float32) * -1.0e9
+            finished_scores += (~improvable).to(torch.float32) * -1.0e9
+            finished_scores += (~just_finished) * -1.0e9
+            merged_scores = torch.cat([scores, finished_scores], dim=1)
+            best = torch.topk(merged_scores, k=num_beams)[1]
+            sequences = torch.take_along_dim(torch.cat([sequences, topk_sequences], dim=1), best[:, :, None], dim=1)
+            lengths = torch.take_along_dim(torch.cat([lengths, torch.full_like(topk_scores, length + 1,
+                                                                                  dtype=torch.long)], dim=1),
+                                           best, dim=1)
+            scores = torch.take_along_dim(merged_scores, best, dim=1)
+            finished = torch.take_along_dim(torch.cat([finished, just_finished], dim=1), best, dim=1)
+
+            length += 1
+            if early_stopping == "never" and length_penalty > 0.0:
+                best_length = max_length - 1
+            else:
+                best_length = length - 1
+            best_running = running_scores[:, :1] / (best_length ** length_penalty)
+            worst_finished = torch.where(finished, torch.min(scores, dim=1, keepdim=True)[0], -1.0e9)
+            improvable = improvable & torch.any(best_running > worst_finished, dim=-1, keepdim=True)
+            if (not improvable.any() or (finished.all() and early_stopping is True)) or stopped.all():
+                break
+
+            beam_order = (source_beams + batch_offsets).view(-1)
+            self_attention = [tensor.index_select(0, beam_order) for tensor in self_attention]
+            logits, self_attention = self._step(running[:, :, length - 1].reshape(-1, 1), hidden_states,
+                                                self_attention, cross_attention)
+
+        return sequences[:, 0, :int(lengths[:, 0].max())]
+
+
+def load_graphs(path, runtime):
+    with open(os.path.join(path, "settings.json"), "r", encoding="utf-8") as file:
+        settings = json.load(file)
+    graphs = []
+    for graph_name in ("encoder", "decoder_init", "decoder_step"):
+        graph_path = os.path.join(path, graph_name + GRAPH_EXTENSIONS[runtime])
+        if runtime == "onnxruntime":
+            graphs.append(OnnxGraph(graph_path, graph_input_names(graph_name, settings["layers"])))
+        else:
+            import torch
+            graphs.append(torch.export.load(graph_path).module())
+    if runtime == "torch.export":
+        # Both decoder graphs carry the decoder weights; keep one copy in memory.
+        init_state = graphs[1].state_dict()
+        graphs[2].load_state_dict({name: init_state.get(name, tensor)
+                                   for name, tensor in graphs[2].state_dict().items()}, assign=True)
+    return ExportedCaptioner(*graphs, settings)
+
+
+def load_preprocessing(path):
+    from transformers import AutoProcessor, AutoTokenizer
+
+    processor = AutoProcessor.from_pretrained(os.path.join(path, "processor"))
+    tokenizer_path = os.path.join(path, "tokenizer")
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path) if os.path.isdir(tokenizer_path) else processor
+    return processor, tokenizer
+
+
+def check_parity(model, captioner, pixel_values, generation_settings):
+    """
+    Compare the token ids generate() produces eagerly and from the exported
+    graphs.  Returns a list of (settings, eager ids, exported ids) for every
+    mismatch, so an empty list means the export is faithful.
+    """
+    import torch
+
+    mismatches = []
+    for settings in generation_settings:
+        with torch.no_grad():
+            eager = model.generate(pixel_values=pixel_values, **settings)
+        exported = captioner.generate(pixel_values=pixel_values, **settings)
+        if eager.shape != exported.shape or not torch.equal(eager.cpu(), exported):
+            mismatches.append((settings, eager.tolist(), exported.tolist()))
+    return mismatches
+
+
+def export_model(name, loader, runtime, report, directory=EXPORT_DIR):
+    """
+    Load `name` eagerly on the CPU, export its graphs for `runtime` into
+    `directory` and check them against eager generate() before keeping them.
+    """
+    import torch
+
+    backend = loader(torch.device("cpu"), report)
+    model = backend["model"]
+    path = export_path(directory, name, loader, runtime)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    try:
+        pixel_values = sample_pixel_values(backend, name)
+        settings = export_graphs(model, pixel_values, runtime, temp_path, report)
+        with open(os.path.join(temp_path, "settings.json"), "w", encoding="utf-8") as file:
+            json.dump(settings, file, indent=4)
+        backend["processor"].save_pretrained(os.path.join(temp_path, "processor"))
+        if backend["tokenizer"] is not backend["processor"]:
+            backend["tokenizer"].save_pretrained(os.path.join(temp_path, "tokenizer"))
+
+        report("checking exported graphs against the eager model")
+        captioner = load_graphs(temp_path, runtime)
+        mismatches = check_parity(model, captioner, pixel_values,
+                                  [{}, {"max_length": 16, "num_beams": 1}, {"max_length": 16, "num_beams": 4}])
+        if mismatches:
+            raise ValueError(f"exported {name} doesn't match the eager model: {mismatches[0]}")
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            # Another process finished the same export first.
+            if not os.path.isdir(path):
+                raise
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+    return path
+
+
+def ensure_exported(name, loader, runtime, report, directory=EXPORT_DIR):
+    """Path of the exported graphs of `name`, exporting them first if this is the first time."""
+    if runtime not in GRAPH_EXTENSIONS:
+        raise ValueError(f"Unknown runtime: {runtime}")
+    if runtime == "onnxruntime":
+        import onnxruntime  # noqa: F401  fail before exporting if it isn't installed
+
+    path = export_path(directory, name, loader, runtime)
+    if not os.path.isdir(path):
+        export_model(name, loader, runtime, report, directory)
+    return path
+
+
+def load_exported(name, loader, runtime, report, directory=EXPORT_DIR):
+    """Return a backend for `name` that generates from its exported graphs."""
+    path = ensure_exported(name, loader, runtime, report, directory)
+    report(f"loading exported graphs ({runtime})")
+    processor, tokenizer = load_preprocessing(path)
+    return {"model": load_graphs(path, runtime), "processor": processor, "tokenizer": tokenizer}
@@ -0,0 +1,304 @@
+"""Cache of image encoder outputs for J_Captioneer.
+
+The image encoder is the most expensive part of captioning, and its output
+doesn't depend on the generation settings.  FeatureCache keeps the encoder
+output of captioned images on disk, so captioning the same images again
+with another max_length or num_beams only runs the text decoder.
+
+Features are rows in memory-mapped segment files, one set per model variant
+(model, precision, runtime) and storage dtype, with an SQLite index from
+image path to row.  float32 rows give exactly the captions of an uncached
+run; float16 rows take half the space, and may very rarely change a word.
+A row is only used while the image's mtime and size are the ones it was
+computed from; a changed image is encoded again and its row overwritten.
+
+The cache is capped in bytes and evicts the least recently used rows first,
+like thumbnail_cache.py; recency survives restarts because it is kept in
+the index.  Freed rows are reused.  compact(), run when the cache is opened,
+also frees the rows of images that were deleted or changed since, moves live
+rows out of the last segments and deletes the segment files left empty.
+Segment files are created at full size and never resized, because a file
+can't be resized while it is mapped on Windows.  Keep this module free of
+any PyQt5 imports; torch is only imported once features are read or written.
+"""
+import hashlib
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from app_data import data_path
+
+FEATURE_CACHE_DIR = data_path("feature_cache")
+MAX_FEATURE_CACHE_BYTES = 4 * 2**30
+FEATURE_DTYPES = ("float32", "float16")
+SEGMENT_ROWS = 64
+
+
+class FeatureCache:
+    def __init__(self, directory=FEATURE_CACHE_DIR, max_bytes=MAX_FEATURE_CACHE_BYTES, dtype="float32"):
+        if dtype not in FEATURE_DTYPES:
+            raise ValueError(f"Unknown feature cache dtype: {dtype}")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self.variants = {}
+        self.segments = {}
+        # Rows read since the last flush(), {(variant, path): time}, so a hit doesn't cost an index write.
+        self.touched = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS variants ("
+            "variant TEXT PRIMARY KEY, shape TEXT, rows INTEGER)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS features ("
+            "variant TEXT, path TEXT, mtime_ns INTEGER, size INTEGER, row INTEGER, used REAL, "
+            "PRIMARY KEY (variant, path))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS features_used ON features (used)")
+        self.connection.commit()
+        self.compact()
+
+    def _key(self, variant):
+        return f"{variant} {self.dtype}"
+
+    def _variant(self, key):
+        """
+        [shape, rows, free rows, row bytes] of variant `key`, or None if nothing
+        has been stored for it yet.  Call with the lock held.
+        """
+        if key not in self.variants:
+            row = self.connection.execute("SELECT shape, rows FROM variants WHERE variant = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._add_variant(key, tuple(json.loads(row[0])), row[1])
+        return self.variants[key]
+
+    def _add_variant(self, key, shape, rows):
+        used = {row for row, in self.connection.execute("SELECT row FROM features WHERE variant = ?", (key,))}
+        row_bytes = 2 if self.dtype == "float16" else 4
+        for dimension in shape:
+            row_bytes *= dimension
+        # Free rows are a heap, handed out lowest first so live rows stay packed at the start.
+        free = sorted(set(range(rows)) - used)
+        self.variants[key] = [shape, rows, free, row_bytes]
+
+    def _segment_path(self, key, index):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, f"{name}-{index}.seg")
+
+    def _segment(self, key, shape, index):
+        """Segment `index` of variant `key` as a mapped (SEGMENT_ROWS, *shape) tensor, created if needed."""
+        if (key, index) not in self.segments:
+            import torch
+
+            dtype = getattr(torch, self.dtype)
+            path = self._segment_path(key, index)
+            elements = SEGMENT_ROWS
+            for dimension in shape:
+                elements *= dimension
+            file_bytes = elements * torch.tensor([], dtype=dtype).element_size()
+            if not os.path.exists(path) or os.path.getsize(path) != file_bytes:
+                with open(path, "wb") as file:
+                    file.truncate(file_bytes)
+            self.segments[key, index] = torch.from_file(path, shared=True, size=elements,
+                                                        dtype=dtype).view(SEGMENT_ROWS, *shape)
+        return self.segments[key, index]
+
+    def _row(self, key, shape, row):
+        return self._segment(key, shape, row // SEGMENT_ROWS)[row % SEGMENT_ROWS]
+
+    def get(self, variant, image_path):
+        """The cached features of `image_path` for `variant`, or None if there are none for its current content."""
+        import torch
+
+        path = os.path.abspath(image_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = self._key(variant)
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT mtime_ns, size, row FROM features WHERE variant = ? AND path = ?", (key, path)).fetchone()
+            variant_info = self._variant(key)
+            if row is None or variant_info is None or row[0] != stat.st_mtime_ns or row[1] != stat.st_size:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key, path] = time.time()
+            # A copy: the row may be reused once it is evicted.
+            return self._row(key, variant_info[0], row[2]).to(torch.float32, copy=True)
+
+    def put(self, variant, image_path, features):
+        """
+        Store the encoder output of `image_path`, evicting the least recently
+        used rows if the cache grows past `max_bytes`.  Features of another
+        shape than the ones already stored for `variant` are not cached.
+        Call flush() to make pending index writes durable.
+        """
+        path = os.path.abspath(image_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        key = self._key(variant)
+        with self._lock:
+            variant_info = self._variant(key)
+            if variant_info is None:
+                self._add_variant(key, tuple(features.shape), 0)
+                variant_info = self.variants[key]
+                self.connection.execute("INSERT INTO variants VALUES (?, ?, 0)", (key, json.dumps(variant_info[0])))
+            shape = variant_info[0]
+            if tuple(features.shape) != shape or variant_info[3] > self.max_bytes:
+                return
+            existing = self.connection.execute(
+                "SELECT row FROM features WHERE variant = ? AND path = ?", (key, path)).fetchone()
+            if existing is not None:
+                row = existing[0]
+            else:
+                self._evict(self.max_bytes - variant_info[3])
+                row = self._allocate(key, variant_info)
+                self.total_bytes += variant_info[3]
+            self._row(key, shape, row).copy_(features)
+            self.touched.pop((key, path), None)
+            self.connection.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)",
+                                    (key, path, stat.st_mtime_ns, stat.st_size, row, time.time()))
+
+    def _allocate(self, key, variant_info):
+        if variant_info[2]:
+            return heapq.heappop(variant_info[2])
+        row = variant_info[1]
+        variant_info[1] += 1
+        self.connection.execute("UPDATE variants SET rows = ? WHERE variant = ?", (variant_info[1], key))
+        return row
+
+    def _evict(self, max_bytes):
+        """Free least recently used rows until the live rows take at most `max_bytes`.  Call with the lock held."""
+        if self.total_bytes <= max_bytes:
+            return
+        self._write_touched()
+        evicted = []
+        total = self.total_bytes
+        for key, path, row in self.connection.execute("SELECT variant, path, row FROM features ORDER BY used"):
+            if total <= max_bytes:
+                break
+            total -= self._variant(key)[3]
+            evicted.append((key, path, row))
+        for key, path, row in evicted:
+            self._free(key, path, row)
+            self.evictions += 1
+
+    def _free(self, key, path, row):
+        self.connection.execute("DELETE FROM features WHERE variant = ? AND path = ?", (key, path))
+        self.touched.pop((key, path), None)
+        heapq.heappush(self.variants[key][2], row)
+        self.total_bytes -= self.variants[key][3]
+
+    def _write_touched(self):
+        if self.touched:
+            self.connection.executemany("UPDATE features SET used = ? WHERE variant = ? AND path = ?",
+                                        [(used, key, path) for (key, path), used in self.touched.items()])
+            self.touched.clear()
+
+    def compact(self):
+        """
+        Free the rows of images that are gone or changed, move the last live
+        rows of each variant into free rows further up, and delete the
+        segment files that are left unused.
+        """
+        with self._lock:
+            stale = []
+            for key, path, mtime_ns, size, row in self.connection.execute(
+                    "SELECT variant, path, mtime_ns, size, row FROM features"):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    stale.append((key, path, row))
+                    continue
+                if stat.st_mtime_ns != mtime_ns or stat.st_size != size:
+                    stale.append((key, path, row))
+            self.total_bytes = 0
+            for key, count in self.connection.execute("SELECT variant, COUNT(*) FROM features GROUP BY variant"):
+                if self._variant(key) is not None:
+                    self.total_bytes += count * self.variants[key][3]
+            for key, path, row in stale:
+                if self._variant(key) is not None:
+                    self._free(key, path, row)
+
+            for key in [key for key, in self.connection.execute("SELECT variant FROM variants")]:
+                shape, rows, free, _ = self._variant(key)
+                moves = self.connection.execute(
+                    "SELECT path, row FROM features WHERE variant = ? ORDER BY row DESC", (key,)).fetchall()
+                for path, row in moves:
+                    if not free or free[0] > row:
+                        break
+                    # `row` is above every row still to move, so it ends up past the end: no need to free it.
+                    target = heapq.heappop(free)
+                    self._row(key, shape, target).copy_(self._row(key, shape, row))
+                    self.connection.execute("UPDATE features SET row = ? WHERE variant = ? AND path = ?",
+                                            (target, key, path))
+                live = self.connection.execute("SELECT MAX(row) FROM features WHERE variant = ?", (key,)).fetchone()
+                end = 0 if live[0] is None else live[0] + 1
+                self.variants[key][1] = end
+                free = [row for row in free if row < end]
+                heapq.heapify(free)
+                self.variants[key][2] = free
+                self.connection.execute("UPDATE variants SET rows = ? WHERE variant = ?", (end, key))
+                self.connection.commit()
+                segments = (end + SEGMENT_ROWS - 1) // SEGMENT_ROWS
+                for index in range(segments, (rows + SEGMENT_ROWS - 1) // SEGMENT_ROWS):
+                    self.segments.pop((key, index), None)
+                    try:
+                        os.remove(self._segment_path(key, index))
+                    except OSError:
+                        # Still mapped (Windows); removed by a later compact().
+                        pass
+            self.connection.commit()
+
+    def flush(self):
+        with self._lock:
+            self._write_touched()
+            self.connection.commit()
+
+    def size_bytes(self):
+        """Disk space taken by the segment files."""
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith(".seg"))
+
+    def stats_report(self):
+        return (f"Feature cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions "
+                f"({self.total_bytes / 2**20:.1f} MB in use, {self.size_bytes() / 2**20:.1f} MB on disk)")
+
+    def _remove_segment_files(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".seg"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM features")
+            self.connection.execute("DELETE FROM variants")
+            self.connection.commit()
+            self.variants.clear()
+            self.segments.clear()
+            self.touched.clear()
+            self.total_bytes = 0
+            self._remove_segment_files()
+
+    def close(self):
+        with self._lock:
+            self._write_touched()
+            self.connection.commit()
+            self.connection.close()
+            self.segments.clear()
@@ -0,0 +1,136 @@
+"""Cropping and resizing images in bulk for J_Captioneer.
+
+crop_images() runs crop_image() for many images on a pool of worker
+processes and yields one CropResult per image as they finish, so callers can show progress, stop
+early and report failures without losing the rest of the batch.  JPEGs are
+decoded at a reduced size when the crop still has enough pixels for the
+output, and every image is replaced atomically.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from PIL import Image
+
+OUTPUT_FORMATS = ("Keep", "JPEG", "PNG")
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png"}
+DEFAULT_QUALITY = 95
+
+
+class CropResult:
+    def __init__(self, image_path, output_path=None, error=None):
+        self.image_path = image_path
+        self.output_path = output_path
+        self.error = error
+
+
+def output_path_for(image_path, output_format):
+    """Where the cropped `image_path` is written: in place, or with the extension of `output_format`."""
+    if output_format == "Keep":
+        return image_path
+    root, extension = os.path.splitext(image_path)
+    if Image.registered_extensions().get(extension.lower()) == output_format:
+        return image_path
+    return root + FORMAT_EXTENSIONS[output_format]
+
+
+def default_box(width, height, aspect_ratio):
+    """The largest (x, y, width, height) box of `aspect_ratio` in the top left corner of a width x height image."""
+    if height * aspect_ratio <= width:
+        return 0, 0, height * aspect_ratio, height
+    return 0, 0, width, width / aspect_ratio
+
+
+def crop_image(image_path, box, size, output_format="Keep", quality=DEFAULT_QUALITY):
+    """
+    Crop `box` ((x, y, width, height) in the image's own pixels, or None for
+    default_box() at the aspect ratio of `size`) out of `image_path`, resize
+    it to `size` and write it back.  Returns the path written, which differs
+    from `image_path` if `output_format` changes the extension; the original
+    is then removed.
+    """
+    with Image.open(image_path) as image:
+        if box is None:
+            box = default_box(image.width, image.height, size[0] / size[1])
+        x, y, width, height = box
+        image_format = image.format
+        full_width, full_height = image.size
+        if image_format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale as long as the crop
+            # keeps at least `size` pixels.
+            image.draft(image.mode, (max(1, round(image.width * size[0] / width)),
+                                     max(1, round(image.height * size[1] / height))))
+        # A reduced decode rounds each side up on its own, so the two axes
+        # scale differently; crop() would pad a box past the edge with black.
+        scale_x = image.width / full_width
+        scale_y = image.height / full_height
+        cropped = image.crop((max(0, round(x * scale_x)), max(0, round(y * scale_y)),
+                              min(image.width, round((x + width) * scale_x)),
+                              min(image.height, round((y + height) * scale_y))))
+        resized = cropped.resize(size, Image.Resampling.LANCZOS)
+
+    save_format = image_format if output_format == "Keep" else output_format
+    if save_format == "JPEG" and resized.mode not in ("RGB", "L"):
+        resized = resized.convert("RGB")
+    options = {"quality": quality} if save_format == "JPEG" else {}
+    output_path = output_path_for(image_path, output_format)
+    if output_path != image_path and os.path.exists(output_path):
+        raise FileExistsError(f"{os.path.basename(output_path)} already exists")
+    temporary_path = f"{output_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        resized.save(temporary_path, save_format, **options)
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+    if output_path != image_path:
+        os.remove(image_path)
+    return output_path
+
+
+def crop_task(image_path, box, size, output_format, quality):
+    try:
+        return CropResult(image_path, crop_image(image_path, box, size, output_format, quality))
+    except Exception as e:
+        return CropResult(image_path, error=f"{type(e).__name__}: {e}")
+
+
+def crop_images(jobs, size, output_format="Keep", quality=DEFAULT_QUALITY, workers=None, cancelled=None):
+    """
+    Crop and resize every (image_path, box) in `jobs`, yielding a CropResult
+    per image in completion order.  Images not yet started when
+    `cancelled()` turns true are skipped.  With a single worker everything
+    runs in the calling thread.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        for image_path, box in jobs:
+            if cancelled is not None and cancelled():
+                return
+            yield crop_task(image_path, box, size, output_format, quality)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        # Keep a couple of images per worker in flight so cancelling stops quickly.
+        pending = set()
+        jobs = iter(jobs)
+        try:
+            while True:
+                while len(pending) < workers * 2 and not (cancelled is not None and cancelled()):
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    pending.add(executor.submit(crop_task, job[0], job[1], size, output_format, quality))
+                if not pending:
+                    return
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
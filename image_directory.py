@@ -0,0 +1,197 @@
+"""Listing the images of a dataset directory for J_Captioneer.
+
+DirectoryScan walks a directory (optionally with all its subfolders) with
+os.scandir and hands out the images in chunks as it finds them, already in
+their final order: natural order ("img2" before "img10"), with the images of
+a folder before its subfolders.  A ScanCache remembers every folder's listing
+together with the folder's mtime, so walking an unchanged tree again only
+stats the folders.  compare() turns two scans into the images that were
+added, removed or modified.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+from app_data import data_path
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+SCAN_CACHE_DIR = data_path("scan_cache")
+SCAN_CACHE_VERSION = 1
+CHUNK_SIZE = 500
+# A folder modified this recently may still change within the same mtime tick,
+# so its listing isn't cached yet.
+RACY_SECONDS = 2
+DIGITS = re.compile(r"(\d+)")
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def name_key(name):
+    """Natural sort key of one file or folder name; the name itself breaks ties."""
+    parts = DIGITS.split(name)
+    return tuple(int(part) if index % 2 else part.casefold() for index, part in enumerate(parts)), name
+
+
+def natural_key(path):
+    """
+    Sort key that puts image paths in the order DirectoryScan yields them:
+    natural order within a folder, a folder's images before its subfolders.
+    """
+    *folders, name = os.path.normpath(path).split(os.sep)
+    return tuple((1, name_key(folder)) for folder in folders) + ((0, name_key(name)),)
+
+
+def list_directory(path):
+    """(mtime_ns, {image name: (mtime_ns, size)}, [subfolder names]) of one folder, both in natural order."""
+    mtime_ns = os.stat(path).st_mtime_ns
+    images = {}
+    folders = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith("."):
+                        folders.append(entry.name)
+                    continue
+                if not is_image(entry.name) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            images[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    images = {name: images[name] for name in sorted(images, key=name_key)}
+    return mtime_ns, images, sorted(folders, key=name_key)
+
+
+class ScanCache:
+    """Folder listings of one directory tree from earlier scans, saved in SCAN_CACHE_DIR."""
+
+    def __init__(self, directory, cache_directory=SCAN_CACHE_DIR):
+        self.directory = directory
+        key = os.path.abspath(directory)
+        self.path = os.path.join(cache_directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+        self.listings = {}
+        self.dirty = False
+
+    @classmethod
+    def load(cls, directory, cache_directory=SCAN_CACHE_DIR):
+        cache = cls(directory, cache_directory)
+        try:
+            with open(cache.path, "r", encoding="utf-8") as file:
+                saved = json.load(file)
+            if saved.get("version") == SCAN_CACHE_VERSION:
+                for path, (mtime_ns, images, folders) in saved["listings"].items():
+                    cache.listings[path] = (mtime_ns, {name: tuple(signature) for name, signature in images.items()},
+                                            folders)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return cache
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+            json.dump({"version": SCAN_CACHE_VERSION, "listings": self.listings}, file)
+        os.replace(temporary_path, self.path)
+        self.dirty = False
+
+    def listing(self, path, fresh=False):
+        """list_directory(path), reusing the cached listing if the folder's mtime hasn't changed."""
+        cached = self.listings.get(path)
+        if cached is not None and not fresh and os.stat(path).st_mtime_ns == cached[0]:
+            return cached
+        listing = list_directory(path)
+        if time.time_ns() - listing[0] > RACY_SECONDS * 10**9:
+            self.listings[path] = listing
+        else:
+            self.listings.pop(path, None)
+        self.dirty = True
+        return listing
+
+    def update(self, image_path, signature):
+        """Record the new signature of an image rewritten in place, which leaves its folder's mtime alone."""
+        folder, name = os.path.split(image_path)
+        listing = self.listings.get(folder)
+        if listing is not None and name in listing[1]:
+            listing[1][name] = signature
+            self.dirty = True
+
+    def forget(self, path):
+        """Drop the listings of `path` and everything below it."""
+        prefix = os.path.join(path, "")
+        for listed in [listed for listed in self.listings if listed == path or listed.startswith(prefix)]:
+            del self.listings[listed]
+            self.dirty = True
+
+
+class DirectoryScan:
+    """
+    One walk over `directory`.  Iterating yields lists of at most
+    `chunk_size` (image path, (mtime_ns, size)) in natural_key() order; once
+    it is exhausted, `images` holds every image's signature and `folders`
+    every folder visited.  With a `cache`, unchanged folders aren't listed
+    again (unless `fresh`, which re-lists and re-stats everything).
+    """
+
+    def __init__(self, directory, recursive=False, cache=None, fresh=False, chunk_size=CHUNK_SIZE):
+        self.directory = directory
+        self.recursive = recursive
+        self.cache = cache
+        self.fresh = fresh
+        self.chunk_size = chunk_size
+        self.images = {}
+        self.folders = []
+
+    def listing(self, path):
+        if self.cache is not None:
+            return self.cache.listing(path, self.fresh)
+        return list_directory(path)
+
+    def __iter__(self):
+        chunk = []
+        pending = [self.directory]
+        while pending:
+            path = pending.pop()
+            try:
+                _, images, folders = self.listing(path)
+            except OSError:
+                if self.cache is not None:
+                    self.cache.forget(path)
+                continue
+            self.folders.append(path)
+            for name, signature in images.items():
+                image_path = os.path.join(path, name)
+                self.images[image_path] = signature
+                chunk.append((image_path, signature))
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+            if self.recursive:
+                pending.extend(os.path.join(path, folder) for folder in reversed(folders))
+        if chunk:
+            yield chunk
+
+    def run(self):
+        for _ in self:
+            pass
+        return self.images
+
+
+def scan(directory, recursive=False, cache=None, fresh=False):
+    """{image path: (mtime_ns, size)} for the images in `directory` (and its subfolders if `recursive`)."""
+    return DirectoryScan(directory, recursive, cache, fresh).run()
+
+
+def compare(old, new):
+    """(added, removed, modified) image paths between two scan() results."""
+    added = [path for path in new if path not in old]
+    removed = [path for path in old if path not in new]
+    modified = [path for path, identity in new.items() if path in old and old[path] != identity]
+    return added, removed, modified
@@ -0,0 +1,75 @@
+"""In-memory cache of display-ready images for J_Captioneer's image view.
+
+Holds whatever the caller puts in (the app stores a scaled QImage and the
+caption) under the image path, capped in bytes and evicting the least
+recently used entries first.  Safe to fill from worker threads.
+"""
+import threading
+from collections import OrderedDict
+
+MAX_PREVIEW_BYTES = 128 * 2**20
+
+
+class PreviewCache:
+    def __init__(self, max_bytes=MAX_PREVIEW_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, image_path):
+        with self._lock:
+            return image_path in self.entries
+
+    def get(self, image_path):
+        """The cached value for `image_path` (now the most recently used), or None."""
+        with self._lock:
+            entry = self.entries.get(image_path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(image_path)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, image_path, value, size):
+        with self._lock:
+            self._forget(image_path)
+            self.entries[image_path] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, image_path):
+        with self._lock:
+            self._forget(image_path)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _forget(self, image_path):
+        entry = self.entries.pop(image_path, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+        }
+
+    def stats_report(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0
+        return (f"Preview cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate), "
+                f"{self.evictions} evictions, {len(self.entries)} entries ({self.total_bytes / 2**20:.1f} MB)")
@@ -0,0 +1,60 @@
+"""Exported runtimes must caption exactly like the eager models they were exported from.
+
+Runs on the tiny random models of benchmarks/synthetic.py, so it needs torch
+and transformers but no downloads:
+
+    python -m pytest tests
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+import captioning  # noqa: E402
+import synthetic  # noqa: E402
+
+
+class ExportedRuntimeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        images = os.path.join(cls.directory.name, "images")
+        synthetic.make_image_directory(images, 4, 64, 48, captions=False)
+        cls.images = sorted(os.path.join(images, name) for name in os.listdir(images))
+        cls.eager = synthetic.create_tiny_registry(
+            quantized_dir=os.path.join(cls.directory.name, "quantized"),
+            export_dir=os.path.join(cls.directory.name, "exported"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def assert_same_captions(self, runtime):
+        exported = synthetic.create_tiny_registry(
+            quantized_dir=os.path.join(self.directory.name, "quantized"),
+            export_dir=os.path.join(self.directory.name, "exported"))
+        for model_name in exported.names():
+            exported.set_runtime(model_name, runtime)
+            # The registry falls back to eager if the export fails, which would make this test pass vacuously.
+            self.assertEqual(exported.get(model_name)["runtime"], runtime)
+            for num_beams in (1, 3):
+                with self.subTest(model=model_name, num_beams=num_beams):
+                    gen_kwargs = {"max_length": 12, "num_beams": num_beams}
+                    expected = captioning.predict_step(self.eager, model_name, self.images, gen_kwargs, 2)
+                    captions = captioning.predict_step(exported, model_name, self.images, gen_kwargs, 2)
+                    self.assertEqual(captions, expected)
+
+    def test_torch_export(self):
+        self.assert_same_captions("torch.export")
+
+    @unittest.skipIf(importlib.util.find_spec("onnxruntime") is None, "onnxruntime is not installed")
+    def test_onnxruntime(self):
+        self.assert_same_captions("onnxruntime")
+
+
+if __name__ == "__main__":
+    unittest.main()
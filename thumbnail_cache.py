@@ -0,0 +1,146 @@
+"""On-disk cache of encoded thumbnails for J_Captioneer.
+
+Entries are keyed by file identity (absolute path, mtime and size), so an
+image that is edited or replaced simply misses.  The cache is capped in
+bytes and evicts the least recently used entries first; recency survives
+restarts because a hit touches the entry's mtime.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from app_data import data_path
+
+THUMBNAIL_CACHE_DIR = data_path("thumbnail_cache")
+MAX_CACHE_BYTES = 256 * 2**20
+
+
+def file_identity(image_path):
+    stat = os.stat(image_path)
+    return os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size
+
+
+class ThumbnailCache:
+    def __init__(self, directory=THUMBNAIL_CACHE_DIR, max_bytes=MAX_CACHE_BYTES, extension=".png"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.entries = OrderedDict()
+        self.keys_by_path = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        found = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.extension):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime_ns, entry.name[:-len(self.extension)], stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + self.extension)
+
+    def key_for(self, image_path, size):
+        """Cache key for `image_path` at thumbnail size `size`, or None if the file is gone."""
+        try:
+            path, mtime_ns, file_size = file_identity(image_path)
+        except OSError:
+            return None
+        identity = f"{path}\0{mtime_ns}\0{file_size}\0{size}"
+        key = hashlib.sha1(identity.encode("utf-8")).hexdigest()
+        with self._lock:
+            self.keys_by_path.setdefault(path, set()).add(key)
+        return key
+
+    def get(self, image_path, size):
+        """Return the cached thumbnail bytes for `image_path`, or None on a miss."""
+        key = self.key_for(image_path, size)
+        with self._lock:
+            if key is None or key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self._entry_path(key), "rb") as file:
+                data = file.read()
+            os.utime(self._entry_path(key))
+        except OSError:
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, image_path, size, data):
+        key = self.key_for(image_path, size)
+        if key is None:
+            return
+        entry_path = self._entry_path(key)
+        temp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, entry_path)
+        with self._lock:
+            self._forget(key)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+
+    def invalidate(self, image_path):
+        """Drop every cached thumbnail of `image_path`, e.g. after it was rewritten."""
+        with self._lock:
+            keys = self.keys_by_path.pop(os.path.abspath(image_path), set())
+            for key in keys:
+                if key in self.entries:
+                    self._forget(key)
+                    self._remove_file(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.entries):
+                self._forget(key)
+                self._remove_file(key)
+            self.keys_by_path.clear()
+
+    def _forget(self, key):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            self._remove_file(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+        }
+
+    def stats_report(self):
+        return (f"Thumbnail cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+                f"{len(self.entries)} entries ({self.total_bytes / 2**20:.1f} MB)")